@@ -0,0 +1,96 @@
+# Batched beam search decoding
+# All beams of all images live in one batch of batch * beamWidth rows, so every word costs a
+# single call of the step function no matter how many images or beams are decoded.
+# Top-k selection, beam reordering and length normalization are vectorized in NumPy.
+#
+# step_fn(phraseWords, previousWords, state) -> (probabilities, state)
+#   phraseWords   (rows, phrase_count) int32 - word t of every phrase
+#   previousWords (rows,) int32 - last generated word
+#   probabilities (rows, vocab) - distribution over the next word
+# state may be any nesting of tuples/namedtuples of arrays with 'rows' as first dimension
+# (e.g. the LSTMStateTuples of LSTMNet.step)
+
+import numpy as np
+
+#Applies fn to every array in a (possibly nested) tuple of arrays
+def map_state(fn, state):
+    if isinstance(state, np.ndarray):
+        return fn(state)
+    values = [map_state(fn, value) for value in state]
+    if hasattr(state, '_fields'):
+        return type(state)(*values)
+    return type(state)(values)
+
+#Length normalization of Wu et al. 2016 (GNMT): ((5 + length) / 6) ** alpha
+#alpha = 0 ranks by raw log probability, which favours short captions
+def length_penalty(lengths, alpha):
+    return ((5.0 + lengths) / 6.0) ** alpha
+
+#phrases: (batch, phrase_count, phrase_dimension) word IDs
+#initial_state: step function state for batch * beamWidth rows
+#Returns a list with the best word ID sequence (without <STOP>) for every image, and the
+#(batch, beamWidth) normalized scores of the final beams when returnScores is set
+def beam_search(step_fn, initial_state, phrases, startID, stopID, padID, beamWidth=3,
+                maxLength=None, alpha=0.6, returnScores=False):
+    phrases = np.asarray(phrases, dtype=np.int32)
+    batch, phraseCount, phraseDim = phrases.shape
+    if batch == 0:
+        return ([], np.zeros((0, beamWidth))) if returnScores else []
+    rows = batch * beamWidth
+    maxLength = maxLength or phraseDim
+
+    # Only the first beam of each image is live until the first expansion
+    scores = np.full((batch, beamWidth), -np.inf)
+    scores[:, 0] = 0.0
+    finished = np.zeros((batch, beamWidth), dtype=bool)
+    lengths = np.zeros((batch, beamWidth))
+    history = np.full((batch, beamWidth, maxLength), stopID, dtype=np.int32)
+    words = np.full(rows, startID, dtype=np.int32)
+    state = initial_state
+    offsets = (np.arange(batch) * beamWidth)[:, np.newaxis]
+
+    for t in range(maxLength):
+        if t < phraseDim:
+            phraseWords = np.repeat(phrases[:, :, t], beamWidth, axis=0)
+        else:
+            phraseWords = np.full((rows, phraseCount), padID, dtype=np.int32)
+        probs, state = step_fn(phraseWords, words, state)
+        vocab = probs.shape[1]
+        logp = np.log(np.maximum(probs, 1e-12)).reshape(batch, beamWidth, vocab)
+        # Finished beams can only extend with <STOP>, at no cost
+        logp[finished] = -np.inf
+        logp[finished, stopID] = 0.0
+
+        # k best of beamWidth * vocab candidates per image, best first
+        candidates = (scores[:, :, np.newaxis] + logp).reshape(batch, beamWidth * vocab)
+        select = np.arange(batch)[:, np.newaxis]
+        top = np.argpartition(-candidates, beamWidth - 1, axis=1)[:, :beamWidth]
+        order = np.argsort(-candidates[select, top], axis=1, kind='mergesort')
+        top = top[select, order]
+        scores = candidates[select, top]
+
+        parents = top // vocab
+        words2d = (top % vocab).astype(np.int32)
+        history = history[select, parents]
+        wasFinished = finished[select, parents]
+        lengths = lengths[select, parents] + ~wasFinished
+        history[:, :, t] = np.where(wasFinished, stopID, words2d)
+        finished = wasFinished | (words2d == stopID)
+
+        flat = (offsets + parents).reshape(-1)
+        state = map_state(lambda array: array[flat], state)
+        words = words2d.reshape(-1)
+        if finished.all():
+            break
+
+    normalized = scores / length_penalty(np.maximum(lengths, 1), alpha)
+    best = np.argmax(normalized, axis=1)
+    sequences = []
+    for image in range(batch):
+        tokens = history[image, best[image]].tolist()
+        if stopID in tokens:
+            tokens = tokens[:tokens.index(stopID)]
+        sequences.append(tokens)
+    if returnScores:
+        return sequences, normalized
+    return sequences
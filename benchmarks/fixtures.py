@@ -0,0 +1,98 @@
+# Synthetic stand-ins for the MS-COCO caption annotations and densecap results
+# Benchmarks need files shaped like annotations/captions_train2014.json and densecap's
+# results.json, but not the 13 GB image download or a Torch install. Words are drawn from
+# a Zipf distribution over a fixed vocabulary so frequency pruning behaves like it does on
+# real captions. Everything is derived from the seed, so the same arguments always give
+# byte-identical files.
+#
+# python benchmarks/fixtures.py coco <path> [images] [vocab size]
+# python benchmarks/fixtures.py densecap <path> [images] [boxes per image] [vocab size]
+
+from __future__ import print_function
+
+import json as js
+import sys
+
+import numpy as np
+
+CAPTIONS_PER_IMAGE = 5
+CAPTION_WORDS = (8, 15)
+PHRASE_WORDS = (2, 6)
+IMAGE_DIM = (640, 480)
+
+#Vocabulary of vocabSize distinct words. Word rank i is drawn with probability ~ 1 / (i + 1)
+class ZipfWords(object):
+
+    def __init__(self, vocabSize, seed=0):
+        self.words = ['w%d' % i for i in range(vocabSize)]
+        weights = 1.0 / np.arange(1, vocabSize + 1)
+        self.probabilities = weights / weights.sum()
+        self.rng = np.random.RandomState(seed)
+
+    def sentence(self, minWords, maxWords):
+        count = self.rng.randint(minWords, maxWords)
+        picks = self.rng.choice(len(self.words), count, p=self.probabilities)
+        return ' '.join(self.words[i] for i in picks)
+
+def coco_image_id(index):
+    return index + 1
+
+#COCO caption annotation file with captionsPerImage captions for every image
+def coco_captions(images, vocabSize=1000, captionsPerImage=CAPTIONS_PER_IMAGE, seed=0,
+                  split='train2014', dim=IMAGE_DIM):
+    words = ZipfWords(vocabSize, seed)
+    imageEntries = []
+    annotations = []
+    for index in range(images):
+        imgID = coco_image_id(index)
+        imageEntries.append({'id': imgID, 'width': dim[0], 'height': dim[1],
+                             'file_name': 'COCO_%s_%s.jpg' % (split, str(imgID).zfill(12))})
+        for n in range(captionsPerImage):
+            annotations.append({'id': len(annotations) + 1, 'image_id': imgID,
+                                'caption': 'A ' + words.sentence(*CAPTION_WORDS) + '.'})
+    return {'info': {'description': 'synthetic %s captions' % split}, 'licenses': [],
+            'images': imageEntries, 'annotations': annotations}
+
+#Densecap results for the same images: boxesPerImage boxes with phrases, scores in
+#descending order like densecap emits them, and the image 'dim' used by salience.py
+#withDim=False leaves 'dim' out like real densecap output, salience.py then has to infer
+#the image size
+def densecap_results(images, boxesPerImage=100, vocabSize=1000, seed=0, split='train2014',
+                     dim=IMAGE_DIM, withDim=True):
+    words = ZipfWords(vocabSize, seed + 1)
+    rng = np.random.RandomState(seed + 2)
+    results = []
+    for index in range(images):
+        x = rng.uniform(0, dim[0] - 16, boxesPerImage)
+        y = rng.uniform(0, dim[1] - 16, boxesPerImage)
+        width = rng.uniform(16, dim[0], boxesPerImage).clip(max=dim[0] - x)
+        height = rng.uniform(16, dim[1], boxesPerImage).clip(max=dim[1] - y)
+        boxes = np.round(np.stack([x, y, width, height], axis=1), 2)
+        scores = np.round(np.sort(rng.normal(0, 3, boxesPerImage))[::-1], 4)
+        entry = {'img_name': 'COCO_%s_%s.jpg' % (split, str(coco_image_id(index)).zfill(12)),
+                 'boxes': boxes.tolist(), 'scores': scores.tolist(),
+                 'captions': [words.sentence(*PHRASE_WORDS) for n in range(boxesPerImage)]}
+        if withDim:
+            entry['dim'] = list(dim)
+        results.append(entry)
+    return {'opt': {'synthetic': True, 'seed': seed}, 'results': results}
+
+def write_json(data, path):
+    with open(path, 'w') as f:
+        js.dump(data, f)
+    return path
+
+def write_coco_captions(path, images, vocabSize=1000, **kwargs):
+    return write_json(coco_captions(images, vocabSize, **kwargs), path)
+
+def write_densecap_results(path, images, boxesPerImage=100, vocabSize=1000, **kwargs):
+    return write_json(densecap_results(images, boxesPerImage, vocabSize, **kwargs), path)
+
+if __name__ == '__main__':
+    kind, path = sys.argv[1], sys.argv[2]
+    sizes = [int(arg) for arg in sys.argv[3:]]
+    if kind == 'coco':
+        write_coco_captions(path, *(sizes or [1000]))
+    else:
+        write_densecap_results(path, *(sizes or [100]))
+    print("Wrote %s" % path)
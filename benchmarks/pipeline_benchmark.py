@@ -0,0 +1,369 @@
+# Timed scenarios for every stage of the captioning pipeline on synthetic data
+# Generates COCO caption and densecap result fixtures (see fixtures.py) in a scratch
+# directory, then times each stage and prints one JSON record per scenario:
+#   {"scenario": ..., "images": ..., "boxes": ..., "vocab_size": ..., "seconds": ...,
+#    "ms_per_item": ..., "items": ...}
+# seconds is the best of --repeat runs. Records from runs with the same sizes can be
+# compared directly, e.g. before and after a change. The TensorFlow scenarios (run_epoch,
+# sample) are reported as skipped where TensorFlow is not installed.
+#
+# python benchmarks/pipeline_benchmark.py [--images N] [--boxes N] [--vocab N]
+#                                         [--scenarios a,b,...] [--repeat N] [--output FILE]
+
+from __future__ import print_function
+
+import argparse
+import json as js
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import numpy as np
+
+import densecap_processing as dp
+import salience
+import vocabulary
+from coco_index import CaptionIndex
+from densecap_results import DensecapResults
+import fixtures
+
+PHRASE_COUNT = 5
+PHRASE_LENGTH = 16
+BATCH_SIZE = 32
+LAYER_SIZE = 128
+
+#The library prints progress - keep stdout for the JSON records
+@contextmanager
+def quiet():
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        yield
+    finally:
+        sys.stdout = stdout
+
+#Best wall time of 'repeat' calls and the result of the last one
+#setup runs untimed before every call, e.g. to drop caches built by the previous call
+def timed(fn, repeat, setup=None):
+    best = None
+    result = None
+    for n in range(repeat):
+        if setup is not None:
+            setup()
+        with quiet():
+            started = time.time()
+            result = fn()
+            seconds = time.time() - started
+        best = seconds if best is None else min(best, seconds)
+    return best, result
+
+#Synthetic files plus the intermediate products later stages start from, built on demand
+#and outside of any timing
+class Fixture(object):
+
+    def __init__(self, workDir, images, boxes, vocabSize, seed=0):
+        self.work_dir = workDir
+        self.images = images
+        self.boxes = boxes
+        self.vocab_size = vocabSize
+        self.seed = seed
+        self.ann_file = os.path.join(workDir, 'captions_train2014.json')
+        self.results_file = os.path.join(workDir, 'results.json')
+        with quiet():
+            fixtures.write_coco_captions(self.ann_file, images, vocabSize, seed=seed)
+            fixtures.write_densecap_results(self.results_file, images, boxes, vocabSize, seed=seed)
+        self._cache = {}
+
+    def _cached(self, key, build):
+        if key not in self._cache:
+            with quiet():
+                self._cache[key] = build()
+        return self._cache[key]
+
+    @property
+    def index(self):
+        return self._cached('index', lambda: CaptionIndex(self.ann_file))
+
+    @property
+    def annotations(self):
+        return self._cached('annotations', lambda: self.index.captions(self.index.img_ids()))
+
+    @property
+    def vocab(self):
+        return self._cached('vocab', lambda: vocabulary.build_vocabulary(
+            x['caption'] for x in self.annotations))
+
+    @property
+    def image_props(self):
+        return self._cached('image_props',
+                            lambda: dp.dict_to_imgs(dp.json_to_dict(self.results_file)))
+
+    #Densecap entries without 'dim', like real densecap output
+    @property
+    def undimensioned_props(self):
+        return self._cached('undimensioned_props', lambda: fixtures.densecap_results(
+            self.images, self.boxes, self.vocab_size, seed=self.seed, withDim=False)['results'])
+
+    @property
+    def phrases(self):
+        return self._cached('phrases', lambda: dp.extract_phrase_vectors(
+            PHRASE_COUNT, PHRASE_LENGTH, self.images, self.image_props, self.vocab.word2index))
+
+    @property
+    def captions(self):
+        return self._cached('captions', lambda: dp.extract_caption_vectors(
+            PHRASE_LENGTH, self.images, self.vocab.word2index,
+            dp.get_coco_captions(self.annotations)))
+
+    def close(self):
+        if 'index' in self._cache:
+            self._cache['index'].close()
+
+################################### SCENARIOS ###########################################
+# Each takes (fixture, repeat) and returns (seconds, items processed)
+
+def bench_coco_index_build(fixture, repeat):
+    indexFile = os.path.join(fixture.work_dir, 'bench_index.sqlite')
+    def drop():
+        if os.path.exists(indexFile):
+            os.remove(indexFile)
+    seconds, index = timed(lambda: CaptionIndex(fixture.ann_file, indexFile).build(),
+                           repeat, drop)
+    return seconds, fixture.images
+
+def bench_coco_captions(fixture, repeat):
+    imgIDs = fixture.index.img_ids()
+    seconds, anns = timed(lambda: dp.get_coco_captions(fixture.index.captions(imgIDs)), repeat)
+    return seconds, len(imgIDs)
+
+def bench_vocabulary(fixture, repeat):
+    captions = [x['caption'] for x in fixture.annotations]
+    seconds, vocab = timed(lambda: vocabulary.build_vocabulary(captions, minCount=2), repeat)
+    return seconds, len(captions)
+
+def bench_json_to_dict(fixture, repeat):
+    seconds, images = timed(lambda: dp.dict_to_imgs(dp.json_to_dict(fixture.results_file)),
+                            repeat)
+    return seconds, fixture.images
+
+def bench_densecap_index(fixture, repeat):
+    indexFile = os.path.join(fixture.work_dir, 'bench_results.index')
+    def drop():
+        if os.path.exists(indexFile):
+            os.remove(indexFile)
+    def scan():
+        results = DensecapResults(fixture.results_file, indexFile)
+        results.build_index()
+        results.close()
+    seconds, unused = timed(scan, repeat, drop)
+    return seconds, fixture.images
+
+def bench_densecap_lookup(fixture, repeat):
+    results = DensecapResults(fixture.results_file,
+                              os.path.join(fixture.work_dir, 'bench_results.index'))
+    names = results.names()
+    seconds, images = timed(lambda: [results[name] for name in names], repeat)
+    results.close()
+    return seconds, len(names)
+
+def bench_false_color_salience(fixture, repeat):
+    images = [fixture.image_props[i] for i in range(fixture.images)]
+    def run():
+        salience.clear_cache()
+        return [salience.false_color_salience(image, PHRASE_COUNT) for image in images]
+    seconds, ranked = timed(run, repeat)
+    return seconds, len(images)
+
+def bench_false_color_salience_batch(fixture, repeat):
+    images = [fixture.image_props[i] for i in range(fixture.images)]
+    def run():
+        salience.clear_cache()
+        return salience.false_color_salience_batch(images, PHRASE_COUNT)
+    seconds, ranked = timed(run, repeat)
+    return seconds, len(images)
+
+def bench_select_phrases(fixture, repeat):
+    images = [fixture.image_props[i] for i in range(fixture.images)]
+    def run():
+        salience.clear_cache()
+        return salience.select_phrase_indices(images, PHRASE_COUNT)
+    seconds, selected = timed(run, repeat)
+    return seconds, len(images)
+
+#Without 'dim' the image sizes are inferred from the boxes
+def bench_select_phrases_no_dim(fixture, repeat):
+    images = fixture.undimensioned_props
+    def run():
+        salience.clear_cache()
+        return salience.select_phrase_indices(images, PHRASE_COUNT)
+    seconds, selected = timed(run, repeat)
+    return seconds, len(images)
+
+#Without 'dim' but with the sizes from the COCO index, as preprocessing runs
+def bench_select_phrases_coco_dims(fixture, repeat):
+    images = fixture.undimensioned_props
+    dims = fixture.index.image_sizes(fixture.index.img_ids())
+    def run():
+        salience.clear_cache()
+        return salience.select_phrase_indices(images, PHRASE_COUNT, dims=dims)
+    seconds, selected = timed(run, repeat)
+    return seconds, len(images)
+
+#Selection alone, on arrays already padded
+def bench_select_padded(fixture, repeat):
+    images = [fixture.image_props[i] for i in range(fixture.images)]
+    boxes, scores, valid = salience.pad_images(images)
+    dims, known = salience.image_dims(images, boxes, valid)
+    seconds, selected = timed(lambda: salience.select_padded(boxes, scores, valid, dims,
+                                                             PHRASE_COUNT, known=known), repeat)
+    return seconds, len(images)
+
+def bench_extract_phrase_vectors(fixture, repeat):
+    encoder = fixture.vocab.word2index
+    seconds, ids = timed(lambda: dp.extract_phrase_vectors(
+        PHRASE_COUNT, PHRASE_LENGTH, fixture.images, fixture.image_props, encoder), repeat)
+    return seconds, fixture.images
+
+def bench_extract_caption_vectors(fixture, repeat):
+    captions = dp.get_coco_captions(fixture.annotations)
+    encoder = fixture.vocab.word2index
+    seconds, ids = timed(lambda: dp.extract_caption_vectors(
+        PHRASE_LENGTH, fixture.images, encoder, captions), repeat)
+    return seconds, fixture.images
+
+#LSTMNet on the extracted fixture arrays, metrics are not written to results/masterlog
+@contextmanager
+def lstm_session(fixture):
+    import tensorflow as tf
+    import recurrent_network as rn
+    vocab = fixture.vocab
+    with tf.Graph().as_default():
+        inputs = rn.NetworkInput(min(BATCH_SIZE, fixture.images), PHRASE_COUNT, PHRASE_LENGTH,
+                                 vocab.size, [fixture.phrases, fixture.captions], 1, 1)
+        params = rn.NetworkParameters(LAYER_SIZE, 1, 0.001)
+        ann = rn.LSTMNet(inputs, params, [vocab.index2word, vocab.word2index])
+        ann.results.log_file = None
+        with tf.Session() as session:
+            session.run(tf.initialize_all_variables())
+            try:
+                yield ann, session
+            finally:
+                ann.close_pipeline()
+
+def bench_run_epoch(fixture, repeat):
+    with lstm_session(fixture) as (ann, session):
+        # First epoch pays for graph warm-up
+        with quiet():
+            ann.run_epoch(session)
+        seconds, cost = timed(lambda: ann.run_epoch(session), repeat)
+        return seconds, ann.training_iterations * ann.inputs.batch_size
+
+def bench_sample(fixture, repeat):
+    count = min(fixture.images, 20)
+    with lstm_session(fixture) as (ann, session):
+        with quiet():
+            ann.sample(session, fixture.phrases[0])
+        seconds, captions = timed(
+            lambda: [ann.sample(session, fixture.phrases[i]) for i in range(count)], repeat)
+        return seconds, count
+
+SCENARIOS = OrderedDict([
+    ('coco_index_build', bench_coco_index_build),
+    ('coco_captions', bench_coco_captions),
+    ('vocabulary', bench_vocabulary),
+    ('json_to_dict', bench_json_to_dict),
+    ('densecap_index', bench_densecap_index),
+    ('densecap_lookup', bench_densecap_lookup),
+    ('false_color_salience', bench_false_color_salience),
+    ('false_color_salience_batch', bench_false_color_salience_batch),
+    ('select_phrases', bench_select_phrases),
+    ('select_phrases_no_dim', bench_select_phrases_no_dim),
+    ('select_phrases_coco_dims', bench_select_phrases_coco_dims),
+    ('select_padded', bench_select_padded),
+    ('extract_phrase_vectors', bench_extract_phrase_vectors),
+    ('extract_caption_vectors', bench_extract_caption_vectors),
+    ('run_epoch', bench_run_epoch),
+    ('sample', bench_sample),
+])
+
+TENSORFLOW_SCENARIOS = ('run_epoch', 'sample')
+
+def tensorflow_available():
+    try:
+        import tensorflow
+        return True
+    except ImportError:
+        return False
+
+def run(images=1000, boxes=100, vocabSize=1000, scenarios=None, repeat=3, workDir=None,
+        seed=0, output=None):
+    scenarios = scenarios or list(SCENARIOS.keys())
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if unknown:
+        raise ValueError("Unknown scenarios %s, choose from %s" % (unknown, list(SCENARIOS)))
+    scratch = workDir is None
+    workDir = workDir or tempfile.mkdtemp(prefix='captiongen-bench-')
+    if not os.path.isdir(workDir):
+        os.makedirs(workDir)
+    haveTF = None
+    records = []
+    out = open(output, 'a') if output else None
+    try:
+        started = time.time()
+        fixture = Fixture(workDir, images, boxes, vocabSize, seed)
+        print("Fixtures written to %s in %.2fs" % (workDir, time.time() - started),
+              file=sys.stderr)
+        for name in scenarios:
+            record = OrderedDict([('scenario', name), ('images', images), ('boxes', boxes),
+                                  ('vocab_size', vocabSize), ('repeat', repeat),
+                                  ('python', platform.python_version())])
+            if name in TENSORFLOW_SCENARIOS:
+                if haveTF is None:
+                    haveTF = tensorflow_available()
+                if not haveTF:
+                    record['skipped'] = 'tensorflow not installed'
+            if 'skipped' not in record:
+                seconds, items = SCENARIOS[name](fixture, repeat)
+                record['seconds'] = seconds
+                record['items'] = items
+                record['ms_per_item'] = seconds * 1000.0 / max(items, 1)
+            line = js.dumps(record)
+            print(line)
+            if out is not None:
+                out.write(line + '\n')
+                out.flush()
+            records.append(record)
+        fixture.close()
+    finally:
+        if out is not None:
+            out.close()
+        if scratch:
+            shutil.rmtree(workDir, ignore_errors=True)
+    return records
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time the captioning pipeline on synthetic data')
+    parser.add_argument('--images', type=int, default=1000)
+    parser.add_argument('--boxes', type=int, default=100, help='densecap boxes per image')
+    parser.add_argument('--vocab', type=int, default=1000, help='synthetic vocabulary size')
+    parser.add_argument('--scenarios', help='comma separated, default all: %s' %
+                        ','.join(SCENARIOS))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work-dir', help='keep fixtures here instead of a temporary directory')
+    parser.add_argument('--output', help='also append the JSON records to this file')
+    args = parser.parse_args(argv)
+    scenarios = args.scenarios.split(',') if args.scenarios else None
+    return run(args.images, args.boxes, args.vocab, scenarios, args.repeat, args.work_dir,
+               args.seed, args.output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+# Training throughput vs number of data parallel towers (NetworkParameters.towers)
+# Builds LSTMNet on random word IDs with the same global batch for every tower count,
+# times training steps after a warm-up and prints one JSON record per tower count with
+# examples/sec and the speedup over a single tower.
+#
+# python benchmarks/scaling_benchmark.py [tower counts...]
+#   e.g. python benchmarks/scaling_benchmark.py 1 2 4 8
+
+from __future__ import print_function
+
+import json as js
+import multiprocessing
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from training_steps import time_steps
+
+BATCH_SIZE = 64
+PHRASE_COUNT = 5
+PHRASE_LENGTH = 16
+VOCAB_SIZE = 5000
+
+def main(towerCounts):
+    records = []
+    baseline = None
+    for towers in towerCounts:
+        seconds = time_steps(BATCH_SIZE, PHRASE_COUNT, PHRASE_LENGTH, VOCAB_SIZE,
+                             towers=towers)
+        throughput = BATCH_SIZE / seconds
+        baseline = baseline or throughput
+        record = {'towers': towers, 'batch_size': BATCH_SIZE, 'step_ms': seconds * 1000.0,
+                  'examples_per_sec': throughput, 'speedup': throughput / baseline,
+                  'cpu_count': multiprocessing.cpu_count()}
+        print(js.dumps(record))
+        records.append(record)
+    return records
+
+if __name__ == '__main__':
+    main([int(count) for count in sys.argv[1:]] or [1, 2, 4, 8])
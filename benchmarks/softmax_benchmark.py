@@ -0,0 +1,36 @@
+# Training step time vs vocabulary size for each NetworkParameters.loss
+# Builds LSTMNet on random word IDs for every (vocab size, loss) pair, times training
+# steps after a warm-up, and prints one JSON record per pair.
+#
+# python benchmarks/softmax_benchmark.py [vocab sizes...]
+#   e.g. python benchmarks/softmax_benchmark.py 1000 5000 10000 25000
+
+from __future__ import print_function
+
+import json as js
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from training_steps import time_steps
+
+import recurrent_network as rn
+
+BATCH_SIZE = 32
+PHRASE_COUNT = 5
+PHRASE_LENGTH = 10
+
+def main(vocabSizes):
+    records = []
+    for vocabSize in vocabSizes:
+        for loss in rn.NetworkParameters.LOSSES:
+            seconds = time_steps(BATCH_SIZE, PHRASE_COUNT, PHRASE_LENGTH, vocabSize, loss=loss)
+            record = {'vocab_size': vocabSize, 'loss': loss, 'step_ms': seconds * 1000.0,
+                      'examples_per_sec': BATCH_SIZE / seconds}
+            print(js.dumps(record))
+            records.append(record)
+    return records
+
+if __name__ == '__main__':
+    main([int(size) for size in sys.argv[1:]] or [1000, 5000, 10000, 25000])
@@ -0,0 +1,49 @@
+# Shared timing loop of the TensorFlow training benchmarks (softmax_benchmark.py,
+# scaling_benchmark.py): LSTMNet on random word IDs, a few warm-up steps, then the mean
+# time of timedSteps training steps on one fixed batch.
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import tensorflow as tf
+
+import recurrent_network as rn
+import vocabulary
+
+LAYER_SIZE = 256
+WARMUP_STEPS = 5
+TIMED_STEPS = 30
+
+#[decoder, encoder] of a vocabulary of vocabSize made-up words
+def synthetic_codex(vocabSize):
+    words = vocabulary.RESERVED + ['w%d' % i for i in range(vocabSize - len(vocabulary.RESERVED))]
+    vocab = vocabulary.Vocabulary(words)
+    return [vocab.index2word, vocab.word2index]
+
+#Mean seconds per training step of one batch. Extra keyword arguments go to
+#NetworkParameters, e.g. loss='sampled' or towers=4
+def time_steps(batchSize, phraseCount, phraseLength, vocabSize, layerSize=LAYER_SIZE,
+               warmupSteps=WARMUP_STEPS, timedSteps=TIMED_STEPS, seed=0, **parameters):
+    rng = np.random.RandomState(seed)
+    phrases = rng.randint(0, vocabSize, (batchSize, phraseCount, phraseLength)).astype(np.int32)
+    captions = rng.randint(0, vocabSize, (batchSize, phraseLength)).astype(np.int32)
+    with tf.Graph().as_default():
+        inputs = rn.NetworkInput(batchSize, phraseCount, phraseLength, vocabSize,
+                                 [phrases, captions], 1, 1)
+        params = rn.NetworkParameters(layerSize, 1, 0.001, **parameters)
+        ann = rn.LSTMNet(inputs, params, synthetic_codex(vocabSize))
+        feed = {ann._x: phrases, ann._y: captions, ann._lengths: inputs.lengths}
+        with tf.Session() as session:
+            session.run(tf.initialize_all_variables())
+            for step in range(warmupSteps):
+                session.run([ann.train_cost, ann.optimizer], feed)
+            started = time.time()
+            for step in range(timedSteps):
+                session.run([ann.train_cost, ann.optimizer], feed)
+            return (time.time() - started) / timedSteps
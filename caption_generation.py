@@ -1,157 +1,333 @@
-import recurrent_network as rn
+# Command line entry point for every phase of the pipeline
+#   python caption_generation.py densecap   [--val] [--images N] [--workers N]
+#   python caption_generation.py preprocess [--val] [--images N] [--vocab FILE] ...
+#   python caption_generation.py train      [DATASET] [--epochs N] [--towers N] ...
+#   python caption_generation.py export     [DATASET] [--out FILE] [--int8]
+#   python caption_generation.py sample     [DATASET] [--engine FILE] [--images N]
+#   python caption_generation.py serve      [DATASET] [--engine FILE] [--port N]
+#   python caption_generation.py evaluate   [DATASET] [--engine FILE] [--images N]
+# python caption_generation.py <subcommand> -h lists every option.
+#
+# Each subcommand imports only what it needs. TensorFlow and matplotlib are only loaded by
+# train, export, and sample/serve/evaluate without --engine. --startup-report prints how long the
+# subcommand took to be ready to work (imports plus dataset/model loading); startups over
+# their budget are always reported.
+
+from __future__ import print_function
+
+import time
+STARTED = time.time()
+
+import argparse
+import json as js
 import os
+import shlex
 import sys
-import code
-import re
-import pickle
 
-#Use if images need re-processing by densecap
-#Run as python caption_generation.py 1
-processImages = int(sys.argv[1])
-read = int(sys.argv[2])
-train = int(sys.argv[3])
-
-
-if read:
-
-    if train:
-        fileApp = os.getcwd() + "/train"
-    else:
-        fileApp = os.getcwd() + "/test"
-
-    phraseFile = open(fileApp + "/phrases", 'r')
-    flatPhraseIDs = pickle.load(phraseFile)
-    
-    capFile = open(fileApp + "/caps", 'r')
-    flatCaptionIDs = pickle.load(capFile)
-
-    inFile = open(fileApp + "/inputs", 'r')
-    inputs = pickle.load(inFile)
-
-    paramFile = open(fileApp + "/params", 'r')
-    params = pickle.load(paramFile)
-
-    encFile = open(fileApp + "/encoder", 'r')
-    encoder = pickle.load(encFile)
-
-    decFile = open(fileApp + "/decoder", 'r')
-    decoder = pickle.load(decFile)
-
-    import reader
-    batchedPhrases, batchedCaptions, epochSize = reader.ptb_id_producer(flatPhraseIDs, 
-                flatCaptionIDs, inputs.batch_size, inputs.phraseCount, inputs.phrase_dimension)
-    results = rn.NetworkResults(1)
-    ann = rn.LSTMNet(inputs, params, results, [encoder, decoder], train)
-    ann.run_network(train)
-
-else:
+LOG_DIR = 'results/masterlog'
+ENGINE_FILE = 'results/engine.npz'
+
+# Seconds from process start until a subcommand is ready. Cheap phases must not pay
+# for TensorFlow
+STARTUP_BUDGETS = {'densecap': 1.0, 'preprocess': 1.0, 'sample-engine': 1.0,
+                   'serve-engine': 1.0, 'train': 15.0, 'export': 15.0, 'sample': 15.0,
+                   'serve': 15.0, 'evaluate-engine': 5.0, 'evaluate': 20.0}
+
+class Startup(object):
+
+    def __init__(self, phase, report=False):
+        self.phase = phase
+        self.report = report
+        self.seconds = None
+
+    #Called by a subcommand once its imports and loading are done
+    def ready(self):
+        self.seconds = time.time() - STARTED
+        budget = STARTUP_BUDGETS.get(self.phase)
+        record = {'subcommand': self.phase, 'startup_s': round(self.seconds, 3),
+                  'budget_s': budget, 'within_budget': budget is None or self.seconds <= budget,
+                  'modules_loaded': len(sys.modules),
+                  'tensorflow_loaded': 'tensorflow' in sys.modules,
+                  'matplotlib_loaded': 'matplotlib' in sys.modules}
+        if self.report:
+            print(js.dumps(record, sort_keys=True), file=sys.stderr)
+        elif not record['within_budget']:
+            print("Startup of %s took %.2fs, over its %.1fs budget" %
+                  (self.phase, self.seconds, budget), file=sys.stderr)
+        return record
+
+def dataset_dir(train):
+    return 'train' if train else 'test'
+
+def results_file(train):
+    return 'results/train_results.json' if train else 'results/val_results.json'
+
+############################### SUBCOMMANDS ##############################################
+
+#Runs densecap on the first N MS-COCO images, see densecap_processing.coco_to_densecap
+def run_densecap(args, startup):
+    import densecap_processing as dp
+    startup.ready()
+    train = not args.val
+    dp.set_coco_dataset(train)
+    imgIDs = dp.get_coco_imgs(args.images)
+    command = shlex.split(args.densecap_command) if args.densecap_command else None
+    dp.coco_to_densecap(imgIDs, train, command=command, workers=args.workers)
 
+#Encodes the first N images' densecap phrases and every caption into a dataset directory
+def run_preprocess(args, startup):
     import densecap_processing as dp
+    import dataset
+    import preprocessing
+    startup.ready()
+    train = not args.val
 
     ##########MS-COCO TRAINING CAPTION EXTRACTION##############
-    inputImgCount = 50
-
-    dp.save_full_coco_lexicon(inputImgCount)
+    #Shared train/test vocabulary, words seen less than min_count times become <UNK>
+    #The val split reuses the vocabulary saved by the train split, so both datasets (and
+    #the model trained on one and evaluated on the other) share word IDs
+    if args.vocab:
+        vocab = dp.load_coco_vocabulary(args.vocab)
+    elif args.val:
+        if not os.path.exists(dp.VOCAB_FILE):
+            sys.exit("No %s - preprocess the train split first or pass --vocab" %
+                     dp.VOCAB_FILE)
+        vocab = dp.load_coco_vocabulary()
+    else:
+        vocab = dp.save_full_coco_lexicon(args.vocab_images or args.images,
+                                          minCount=args.min_count)
     dp.set_coco_dataset(train)
-
-    #get three img IDs from MS-COCO
-    imgIDs = dp.get_coco_imgs(inputImgCount)
-
-    imgFiles = {}
-    invertFiles = {}
-    for x in imgIDs:
-        if train:
-            name = 'COCO_train2014_%s.jpg'%(str(x).zfill(12))
-        else:
-            name = 'COCO_val2014_%s.jpg'%(str(x).zfill(12))
-        imgFiles[x] = name
-        invertFiles[name] = x
-
-    #get caption sets for each image
-    capDict = dp.coco_to_captions(imgIDs)
-
-    #get one training caption per image
-    captions = dp.get_coco_captions(capDict)
-
-    #Build a lexicon and encoder/decoder dictionaries - EDIT :: We load these dictionaries
-    #lex = dp.get_coco_lexicon(capDict)                        manually to merge train/test corpora
-    #wordDict = {}
-    #invertDict = {}
-    #dp.build_lookup_lexicon(lex, wordDict, invertDict)
-
-    ###########DENSECAP PHRASE EXTRACTION######################
-
-    if(processImages):
-        dp.coco_to_densecap(imgIDs, train)
-
-    ###########NETWORK CONSTRUCTION AND EXECUTION################
-
-    from itertools import chain
-    def flatten(listOfLists):
-        return list(chain(*listOfLists))
-
-    # Network Parameters 
-    n_hidden = 64 # hidden layer num of features (# of 'neurons')
-    n_layers = 1 # number of stacked layers
-    learning_rate = 0.001 # SGD magnitude
-    initializationScale = 0.1 # scale of weight intializations
-
-    # Input Parameters
-    batch_size = 1 # of images to show per training iteration
-    phraseCount = 5 # of densecap phrases to use in tensor input per epoch
-    phraseLength = 10 # of words per phrase. This will become a function of phrase inputs
-    LEX_DIM = (len(encoder))
-    num_epochs = 100
-    display_step = 2
-
-    if train:
-        results = dp.json_to_dict("results/train_results.json")
+    imgIDs = dp.get_coco_imgs(args.images)
+    names = [dp.coco_image_name(x, train) for x in imgIDs]
+    #The salience of phrases needs image sizes, which not every densecap entry records
+    sizes = dp.densecap_image_sizes(dp.get_coco_image_sizes(imgIDs))
+
+    #get every training caption of each image (5 for MS-COCO)
+    captions = dp.get_coco_captions(dp.coco_to_captions(imgIDs), caption_count=None)
+
+    ###########DENSECAP PHRASE ENCODING######################
+    #Each image's densecap entry is looked up by name, in the same order as imgIDs and
+    #captions. Chunks of images are encoded in parallel into resumable shards
+    phrases, captionIDs, captionImages, rowImgIDs = preprocessing.preprocess(
+        imgIDs, names, [captions[x] for x in imgIDs], results_file(train), vocab.word2index,
+        args.phrase_count, args.phrase_length, 'results/shards/' + dataset_dir(train),
+        args.chunk_size, args.workers, sizes)
+
+    # NetworkInput / NetworkParameters settings the train subcommand starts from
+    inputs = {'batch_size': args.batch_size, 'phrase_count': args.phrase_count,
+              'phrase_dimension': args.phrase_length, 'word_dimension': vocab.size,
+              'num_epochs': args.epochs, 'display_step': args.display_step, 'seed': args.seed}
+    params = {'layer_size': args.layer_size, 'num_layers': args.layers,
+              'learning_rate': args.learning_rate, 'init_scale': args.init_scale,
+              'loss': args.loss, 'num_sampled': args.num_sampled, 'towers': args.towers}
+
+    #Memory-mapped arrays plus a JSON manifest, see dataset.py
+    directory = args.out or dataset_dir(train)
+    dataset.save_dataset(directory, {
+        'phrases': phrases, 'captions': captionIDs, 'caption_images': captionImages,
+        'caption_lengths': dp.sequence_lengths(captionIDs, vocab.pad_id),
+        'image_ids': rowImgIDs}, vocab.words, inputs, params, dp.coco_ann_file(train))
+    print("Saved %d images and %d captions to %s" % (len(phrases), len(captionIDs), directory))
+
+#LSTMNet for a dataset (default args.dataset), with manifest settings overridden from the
+#command line
+def load_network(args, directory=None):
+    import dataset
+    import recurrent_network as rn
+    data = dataset.load_dataset(directory or args.dataset)
+    inputOverrides = {}
+    if getattr(args, 'epochs', None):
+        inputOverrides['num_epochs'] = args.epochs
+    paramOverrides = {}
+    if getattr(args, 'towers', None):
+        paramOverrides['towers'] = args.towers
+    ann = rn.LSTMNet(data.network_input(**inputOverrides),
+                     data.network_parameters(**paramOverrides), [data.decoder, data.encoder])
+    return data, ann
+
+def restore_session(logDir):
+    import tensorflow as tf
+    session = tf.Session()
+    checkpoint = tf.train.latest_checkpoint(logDir)
+    if checkpoint is None:
+        raise IOError("No checkpoint found in %s" % logDir)
+    tf.train.Saver().restore(session, checkpoint)
+    return session
+
+def run_train(args, startup):
+    data, ann = load_network(args)
+    ann.results.trace_every = args.trace_every
+    evaluator = None
+    if args.eval_steps:
+        import evaluation
+        evaluator = evaluation.load_evaluator(args.eval_dataset, args.eval_images,
+                                              beamWidth=args.beam, vocab=data.vocab)
+    startup.ready()
+    ann.train_network(saveSteps=args.save_steps, saveSecs=args.save_secs,
+                      keepCheckpoints=args.keep, resume=not args.restart,
+                      evaluator=evaluator, evaluateSteps=args.eval_steps)
+
+def run_export(args, startup):
+    import numpy_engine
+    startup.ready()
+    numpy_engine.export_checkpoint(args.dataset, args.log_dir, args.out, args.int8)
+
+#Captions the first N dataset images next to their first reference caption
+def run_sample(args, startup):
+    if args.engine:
+        import dataset
+        import numpy_engine
+        data = dataset.load_dataset(args.dataset)
+        engine = numpy_engine.load_engine(args.engine)
+        startup.ready()
+        captions = engine.decode(data.phrases[:args.images], args.beam)
     else:
-        results = dp.json_to_dict("results/val_results.json")
-
-    image_props = dp.dict_to_imgs(results)
-
-    phraseCapCorrespondence = {}
-    for x in image_props.keys():
-        name = image_props[x]['img_name']
-        if name in imgFiles.values():
-            phraseCapCorrespondence[invertFiles[name]] = x
-
-    flatPhraseIDs = dp.extract_phrase_id_vectors(phraseCount, phraseLength, inputImgCount, phraseCapCorrespondence, image_props, decoder)
-    flatCaptionIDs = dp.extract_caption_id_vectors(phraseLength, inputImgCount, decoder, captions)
-
-    inputs = rn.NetworkInput(batch_size, phraseCount, phraseLength, LEX_DIM, batchedPhrases, batchedCaptions, num_epochs, epochSize)
-    params = rn.NetworkParameters(n_hidden, n_layers, learning_rate, initializationScale)
-
-    if train:
-        fileApp = os.getcwd() + "/train"
+        data, ann = load_network(args)
+        session = restore_session(args.log_dir)
+        startup.ready()
+        captions = ann.decode(session, data.phrases[:args.images], args.beam)
+        session.close()
+    decoder = data.decoder
+    captionImages = data.arrays.get('caption_images')
+    imageIDs = data.arrays.get('image_ids')
+    for image, caption in enumerate(captions):
+        row = image if captionImages is None else int((captionImages == image).argmax())
+        reference = ' '.join(decoder[i] for i in data.captions[row] if i < len(decoder))
+        label = image if imageIDs is None else int(imageIDs[image])
+        print("%s: %s\n    reference: %s" % (label, caption, reference))
+
+#BLEU and CIDEr of the dataset's captions against all of its reference captions
+#The model comes from --engine or the checkpoint of a network built from --model-dataset,
+#whose vocabulary must be the evaluated dataset's
+def run_evaluate(args, startup):
+    import evaluation
+    if args.engine:
+        import numpy_engine
+        engine = numpy_engine.load_engine(args.engine)
+        evaluator = evaluation.load_evaluator(args.dataset, args.images, args.batch_size,
+                                              args.beam, vocab=engine.words,
+                                              annFile=args.annotations)
+        startup.ready()
+        scores = evaluator.evaluate(lambda phrases: engine.decode(phrases, args.beam))
     else:
-        fileApp = os.getcwd() + "/test"
-
-    phraseFile = open(fileApp + "/phrases", 'w')
-    pickle.dump(flatPhraseIDs, phraseFile)
-    phraseFile.close()
-
-    capFile = open(fileApp + "/caps", 'w')
-    pickle.dump(flatCaptionIDs, capFile)
-    capFile.close()
-
-    inputs = open(fileApp + "/inputs", 'w')
-    rni = rn.NetworkInput(batch_size, phraseCount, phraseLength, LEX_DIM, None, None, num_epochs, None)
-    pickle.dump(rni, inputs)
-    inputs.close()
-
-    params = open(fileApp + "/params", 'w')
-    rnp = rn.NetworkParameters(n_hidden, n_layers, learning_rate, initializationScale)
-    pickle.dump(rnp, params)
-    params.close()
-
-    encoder = open(fileApp + "/encoder", 'w')
-    renc = wordDict
-    pickle.dump(renc, encoder)
-    encoder.close()
-    
-    decoder = open(fileApp + "/decoder", 'w')
-    rdec = invertDict
-    pickle.dump(rdec, decoder)
-    decoder.close()
+        data, ann = load_network(args, args.model_dataset)
+        evaluator = evaluation.load_evaluator(args.dataset, args.images, args.batch_size,
+                                              args.beam, vocab=data.vocab,
+                                              annFile=args.annotations)
+        session = restore_session(args.log_dir)
+        startup.ready()
+        scores = evaluator(ann, session)
+        session.close()
+    print(js.dumps(scores))
+
+def run_serve(args, startup):
+    import caption_server
+    if args.engine:
+        captioner = caption_server.load_engine_captioner(args.engine, args.beam)
+    else:
+        captioner = caption_server.load_captioner(args.dataset, args.log_dir, args.beam)
+    startup.ready()
+    caption_server.serve(captioner, args.port, args.max_batch, args.max_wait)
+
+def parser():
+    parser = argparse.ArgumentParser(description='Image caption generation from densecap phrases')
+    parser.add_argument('--startup-report', action='store_true',
+                        help='print the startup time of the subcommand as JSON on stderr')
+    commands = parser.add_subparsers(dest='subcommand')
+    # Python 3 subparsers are optional by default, no subcommand would reach args.run unset
+    commands.required = True
+
+    densecap = commands.add_parser('densecap', help='run densecap on MS-COCO images')
+    densecap.add_argument('--val', action='store_true', help='val2014 instead of train2014')
+    densecap.add_argument('--images', type=int, default=50)
+    densecap.add_argument('--workers', type=int, help='parallel densecap processes')
+    densecap.add_argument('--command', dest='densecap_command',
+                          help='replaces "th run_model.lua", e.g. "sh stub.sh"')
+    densecap.set_defaults(run=run_densecap)
+
+    preprocess = commands.add_parser('preprocess', help='encode phrases and captions')
+    preprocess.add_argument('--val', action='store_true', help='val2014 instead of train2014')
+    preprocess.add_argument('--images', type=int, default=50)
+    preprocess.add_argument('--out', help='dataset directory, default train or test')
+    preprocess.add_argument('--vocab', help='use this vocabulary file instead of building one '
+                            '(--val uses the saved train vocabulary by default)')
+    preprocess.add_argument('--vocab-images', type=int,
+                            help='train and val images to count words over, default --images')
+    preprocess.add_argument('--min-count', type=int, default=2)
+    preprocess.add_argument('--phrase-count', type=int, default=5)
+    preprocess.add_argument('--phrase-length', type=int, default=16)
+    preprocess.add_argument('--workers', type=int)
+    preprocess.add_argument('--chunk-size', type=int, default=1000)
+    preprocess.add_argument('--batch-size', type=int, default=10)
+    preprocess.add_argument('--epochs', type=int, default=100)
+    preprocess.add_argument('--display-step', type=int, default=2)
+    preprocess.add_argument('--seed', type=int, default=0)
+    preprocess.add_argument('--layer-size', type=int, default=64)
+    preprocess.add_argument('--layers', type=int, default=1)
+    preprocess.add_argument('--learning-rate', type=float, default=0.001)
+    preprocess.add_argument('--init-scale', type=float, default=0.1)
+    preprocess.add_argument('--loss', default='softmax', choices=['softmax', 'sampled', 'nce'])
+    preprocess.add_argument('--num-sampled', type=int, default=64)
+    preprocess.add_argument('--towers', type=int, default=1)
+    preprocess.set_defaults(run=run_preprocess)
+
+    train = commands.add_parser('train', help='train LSTMNet on a dataset')
+    train.add_argument('dataset', nargs='?', default='train')
+    train.add_argument('--epochs', type=int, help='override the dataset num_epochs')
+    train.add_argument('--towers', type=int, help='override the dataset towers')
+    train.add_argument('--save-steps', type=int, help='checkpoint every N steps')
+    train.add_argument('--save-secs', type=float, default=600, help='checkpoint every N seconds')
+    train.add_argument('--keep', type=int, default=5, help='checkpoints to keep')
+    train.add_argument('--restart', action='store_true', help="don't resume from checkpoints")
+    train.add_argument('--trace-every', type=int, default=0,
+                       help='write a TensorFlow trace every N steps')
+    train.add_argument('--eval-steps', type=int, help='evaluate BLEU/CIDEr every N steps')
+    train.add_argument('--eval-dataset', default='test', help='dataset to evaluate on')
+    train.add_argument('--eval-images', type=int, help='first N images, default all')
+    train.add_argument('--beam', type=int, default=3, help='beam width when evaluating')
+    train.set_defaults(run=run_train)
+
+    export = commands.add_parser('export', help='export the newest checkpoint for numpy_engine')
+    export.add_argument('dataset', nargs='?', default='train')
+    export.add_argument('--log-dir', default=LOG_DIR)
+    export.add_argument('--out', default=ENGINE_FILE)
+    export.add_argument('--int8', action='store_true', help='per-channel int8 weights')
+    export.set_defaults(run=run_export)
+
+    for name, description in (('sample', 'caption dataset images'),
+                              ('serve', 'serve captions over HTTP, see caption_server.py'),
+                              ('evaluate', 'BLEU and CIDEr on a dataset, see evaluation.py')):
+        command = commands.add_parser(name, help=description)
+        command.add_argument('dataset', nargs='?', default='test' if name == 'evaluate'
+                             else 'train')
+        command.add_argument('--log-dir', default=LOG_DIR)
+        command.add_argument('--engine', help='decode with this numpy_engine file, no TensorFlow')
+        command.add_argument('--beam', type=int, default=3)
+        if name == 'sample':
+            command.add_argument('--images', type=int, default=10)
+            command.set_defaults(run=run_sample)
+        elif name == 'evaluate':
+            command.add_argument('--images', type=int, help='first N images, default all')
+            command.add_argument('--batch-size', type=int, default=64)
+            command.add_argument('--model-dataset', default='train',
+                                 help='dataset the checkpoint was trained on')
+            command.add_argument('--annotations',
+                                 help="MS-COCO caption file of the dataset's images, default "
+                                      "the one it was preprocessed from")
+            command.set_defaults(run=run_evaluate)
+        else:
+            command.add_argument('--port', type=int, default=8642)
+            command.add_argument('--max-batch', type=int, default=32)
+            command.add_argument('--max-wait', type=float, default=0.01)
+            command.set_defaults(run=run_serve)
+    return parser
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    phase = args.subcommand
+    if phase in ('sample', 'serve', 'evaluate') and args.engine:
+        phase += '-engine'
+    args.run(args, Startup(phase, args.startup_report))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,328 @@
+# Long-running caption service
+# Loads the dataset manifest (vocab and network settings) and the latest checkpoint once,
+# then answers HTTP requests carrying densecap results:
+#   POST /caption  body: one densecap image entry {"img_name", "boxes", "captions", "scores"}
+#                  or a densecap results file {"results": [...]}
+#                  reply: {"captions": [...]} in request order, 400 for a malformed image,
+#                  500 if any image fails to decode
+#   GET  /stats    latency percentiles, queue depth and batch sizes
+# Concurrent requests are grouped into micro-batches: the decoder thread takes the first
+# waiting image, then keeps collecting until maxBatch images are queued or maxWait seconds
+# have passed since the first one arrived, and decodes them all in one beam search.
+# Images are checked and encoded to phrase IDs by the request's own handler before they
+# are queued, so a malformed image gets a 400 and never fails a batch shared with others.
+#
+# python caption_server.py serve train results/masterlog [port]
+# python caption_server.py serve-engine results/engine.npz [port]   (no TensorFlow, see
+#                                                                    numpy_engine.py)
+# python caption_server.py client [results file] [url] [concurrency]
+#   the results file defaults to results/sample_results.json, densecap's output for six
+#   COCO train2014 images
+
+from __future__ import print_function
+
+import json as js
+import sys
+import threading
+import time
+from collections import deque
+
+try:
+    import Queue as queue
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib2 import Request, urlopen
+except ImportError:
+    import queue
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.request import Request, urlopen
+
+import numpy as np
+
+DEFAULT_PORT = 8642
+# Recorded densecap output the stub client posts by default
+SAMPLE_RESULTS = 'results/sample_results.json'
+
+class _Pending(object):
+    def __init__(self, item):
+        self.item = item
+        self.arrival = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class MicroBatcher(object):
+
+    #decode_fn takes a list of items and returns one result per item
+    def __init__(self, decode_fn, maxBatch=32, maxWait=0.01, historySize=10000):
+        self.decode_fn = decode_fn
+        self.max_batch = maxBatch
+        self.max_wait = maxWait
+        self._queue = queue.Queue()
+        self._latencies = deque(maxlen=historySize)
+        self._batch_sizes = deque(maxlen=historySize)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    #Blocks until the item has been decoded as part of some batch
+    def submit(self, item):
+        pending = _Pending(item)
+        self._queue.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _collect(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = first.arrival + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.time()
+            try:
+                if remaining <= 0:
+                    pending = self._queue.get_nowait()
+                else:
+                    pending = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if pending is None:
+                self._stop.set()
+                break
+            batch.append(pending)
+        return batch
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._collect()
+            if batch is None:
+                break
+            try:
+                results = self.decode_fn([pending.item for pending in batch])
+                errors = [None] * len(batch)
+            except Exception as error:
+                results = [None] * len(batch)
+                errors = [error] * len(batch)
+            finished = time.time()
+            with self._lock:
+                self._batch_sizes.append(len(batch))
+                for pending, result, error in zip(batch, results, errors):
+                    pending.result = result
+                    pending.error = error
+                    self._latencies.append(finished - pending.arrival)
+                    self.requests += 1
+            for pending in batch:
+                pending.done.set()
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    #Latencies in milliseconds over the most recent requests
+    def stats(self):
+        with self._lock:
+            latencies = np.array(self._latencies) * 1000.0
+            sizes = np.array(self._batch_sizes)
+            requests = self.requests
+        stats = {'requests': requests, 'queue_depth': self.queue_depth,
+                 'max_batch': self.max_batch, 'max_wait_ms': self.max_wait * 1000.0}
+        if len(latencies):
+            for percentile in (50, 90, 99):
+                stats['latency_p%d_ms' % percentile] = float(np.percentile(latencies, percentile))
+            stats['latency_mean_ms'] = float(latencies.mean())
+            stats['batches'] = len(sizes)
+            stats['mean_batch_size'] = float(sizes.mean())
+        return stats
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+#Raises ValueError unless image is a densecap entry with one box and score per caption
+def check_image(image):
+    if not isinstance(image, dict):
+        raise ValueError("An image must be a JSON object, got %s" % type(image).__name__)
+    name = image.get('img_name', 'without img_name')
+    for key in ('boxes', 'captions', 'scores'):
+        if not isinstance(image.get(key), list):
+            raise ValueError("Image %s has no '%s' list" % (name, key))
+    boxes = np.asarray(image['boxes'], dtype=np.float64)
+    if boxes.size != 4 * len(image['captions']) or len(image['scores']) != len(image['captions']):
+        raise ValueError("Image %s needs 4 box coordinates and a score per caption" % name)
+
+#encode turns one densecap image entry into its phrase IDs (ValueError if it is malformed),
+#decode captions a list of encoded images
+class Captioner(object):
+
+    def __init__(self, encode, decode):
+        self.encode = encode
+        self.decode = decode
+
+#Restores LSTMNet from the newest checkpoint in logDir and returns its Captioner
+def load_captioner(datasetDir, logDir, beamWidth=3):
+    import tensorflow as tf
+    import densecap_processing as dp
+    import dataset
+    import recurrent_network as rn
+    data = dataset.load_dataset(datasetDir)
+    inputs = data.network_input()
+    params = data.network_parameters()
+    encoder = data.encoder
+    ann = rn.LSTMNet(inputs, params, [data.decoder, encoder])
+    session = tf.Session()
+    checkpoint = tf.train.latest_checkpoint(logDir)
+    if checkpoint is None:
+        raise IOError("No checkpoint found in %s" % logDir)
+    tf.train.Saver().restore(session, checkpoint)
+    print("Restored %s" % checkpoint)
+
+    def encode(image):
+        check_image(image)
+        return dp.extract_image_phrase_vectors(inputs.phrase_count, inputs.phrase_dimension,
+                                               image, encoder)
+    return Captioner(encode, lambda phrases: ann.decode(session, np.stack(phrases), beamWidth))
+
+#Same as load_captioner, but decodes with an exported NumPy engine - TensorFlow is never
+#imported and there is no training graph to build
+def load_engine_captioner(enginePath, beamWidth=3):
+    import densecap_processing as dp
+    import numpy_engine
+    engine = numpy_engine.load_engine(enginePath)
+    encoder = engine.encoder
+    print("Loaded %s (%s weights)" % (enginePath, 'int8' if engine.quantized else 'float32'))
+
+    def encode(image):
+        check_image(image)
+        return dp.extract_image_phrase_vectors(engine.phrase_count, engine.phrase_dimension,
+                                               image, encoder)
+    return Captioner(encode, lambda phrases: engine.decode(np.stack(phrases), beamWidth))
+
+class CaptionServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, batcher, encode):
+        HTTPServer.__init__(self, address, CaptionHandler)
+        self.batcher = batcher
+        self.encode = encode
+
+class CaptionHandler(BaseHTTPRequestHandler):
+
+    def _reply(self, code, body):
+        data = js.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._reply(200, self.server.batcher.stats())
+        else:
+            self._reply(404, {'error': 'unknown path %s' % self.path})
+
+    def do_POST(self):
+        if self.path != '/caption':
+            self._reply(404, {'error': 'unknown path %s' % self.path})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = js.loads(self.rfile.read(length).decode('utf-8'))
+            images = body['results'] if isinstance(body, dict) and 'results' in body else [body]
+            if not isinstance(images, list):
+                raise ValueError("'results' must be a list of images")
+            phrases = [self.server.encode(image) for image in images]
+        except (ValueError, KeyError, TypeError) as error:
+            self._reply(400, {'error': str(error)})
+            return
+        # Each image is queued on its own so it can share a batch with other requests
+        captions = [None] * len(images)
+        errors = [None] * len(images)
+        threads = []
+        for i in range(1, len(phrases)):
+            thread = threading.Thread(target=self._submit, args=(phrases[i], captions, errors, i))
+            thread.start()
+            threads.append(thread)
+        if phrases:
+            self._submit(phrases[0], captions, errors, 0)
+        for thread in threads:
+            thread.join()
+        failed = [(i, error) for i, error in enumerate(errors) if error is not None]
+        if failed:
+            self._reply(500, {'error': '; '.join('image %d: %s' % (i, error)
+                                                 for i, error in failed)})
+            return
+        self._reply(200, {'captions': captions})
+
+    def _submit(self, phrases, captions, errors, index):
+        try:
+            captions[index] = self.server.batcher.submit(phrases)
+        except Exception as error:
+            errors[index] = error
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(captioner, port=DEFAULT_PORT, maxBatch=32, maxWait=0.01):
+    batcher = MicroBatcher(captioner.decode, maxBatch, maxWait)
+    server = CaptionServer(('127.0.0.1', port), batcher, captioner.encode)
+    print("Serving captions on http://127.0.0.1:%d" % port)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        batcher.close()
+
+#Stub client: posts every image of a densecap results file with 'concurrency' parallel
+#requests, then prints the captions and the server's stats
+def request_captions(resultsFile=SAMPLE_RESULTS, url='http://127.0.0.1:%d' % DEFAULT_PORT,
+                     concurrency=8):
+    import densecap_results
+    images = list(densecap_results.iter_images(resultsFile))
+    captions = [None] * len(images)
+    work = queue.Queue()
+    for i in range(len(images)):
+        work.put(i)
+
+    def post():
+        while True:
+            try:
+                i = work.get_nowait()
+            except queue.Empty:
+                return
+            request = Request(url + '/caption', js.dumps(images[i]).encode('utf-8'),
+                              {'Content-Type': 'application/json'})
+            captions[i] = js.loads(urlopen(request).read().decode('utf-8'))['captions'][0]
+
+    started = time.time()
+    threads = [threading.Thread(target=post) for n in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+    for image, caption in zip(images, captions):
+        print("%s: %s" % (image['img_name'], caption))
+    print("%d images in %.2fs" % (len(images), elapsed))
+    print(js.dumps(js.loads(urlopen(url + '/stats').read().decode('utf-8')), indent=1))
+    return captions
+
+if __name__ == '__main__':
+    if sys.argv[1] == 'serve':
+        port = int(sys.argv[4]) if len(sys.argv) > 4 else DEFAULT_PORT
+        serve(load_captioner(sys.argv[2], sys.argv[3]), port)
+    elif sys.argv[1] == 'serve-engine':
+        port = int(sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_PORT
+        serve(load_engine_captioner(sys.argv[2]), port)
+    else:
+        resultsFile = sys.argv[2] if len(sys.argv) > 2 else SAMPLE_RESULTS
+        url = sys.argv[3] if len(sys.argv) > 3 else 'http://127.0.0.1:%d' % DEFAULT_PORT
+        concurrency = int(sys.argv[4]) if len(sys.argv) > 4 else 8
+        request_captions(resultsFile, url, concurrency)
@@ -0,0 +1,167 @@
+# Asynchronous checkpoints for LSTMNet training
+# Writing a checkpoint used to block the training loop for as long as the disk took. Here
+# the training thread only copies every variable into an in-graph shadow copy (one
+# session.run of assign ops, no I/O), and a background thread saves the shadows under the
+# original variable names - the files restore with a plain tf.train.Saver.
+# Next to every checkpoint a small JSON file keeps the Python side of the training state:
+# epoch, position in the epoch, seed and cost history. With input_pipeline's (seed, epoch)
+# shuffling that is enough to continue an interrupted run with exactly the batches it
+# would have seen.
+# Only the newest 'keep' checkpoints (and their state files) are retained, counting those
+# already in logDir from earlier runs.
+
+from __future__ import print_function
+
+import glob
+import json as js
+import os
+import threading
+import time
+
+import tensorflow as tf
+
+CHECKPOINT_NAME = 'model.ckpt'
+
+#Training state stored next to checkpoint 'path'
+def state_file(path):
+    return path + '.state.json'
+
+def read_state(path):
+    stateFile = state_file(path)
+    if not os.path.exists(stateFile):
+        return None
+    with open(stateFile, 'r') as f:
+        return js.load(f)
+
+def write_state(path, state):
+    tmpFile = state_file(path) + '.tmp'
+    with open(tmpFile, 'w') as f:
+        js.dump(state, f, sort_keys=True)
+    os.rename(tmpFile, state_file(path))
+
+class AsyncCheckpointer(object):
+
+    #Checkpoints are due every saveSteps global steps or saveSecs seconds, whichever
+    #comes first. Either may be None
+    def __init__(self, logDir, variables=None, saveSteps=None, saveSecs=600, keep=5):
+        self.log_dir = logDir
+        self.prefix = os.path.join(logDir, CHECKPOINT_NAME)
+        self.save_steps = saveSteps
+        self.save_secs = saveSecs
+        self.keep = keep
+        variables = variables or tf.all_variables()
+        with tf.name_scope('checkpoint'):
+            self._shadows = [tf.Variable(tf.zeros(variable.get_shape(),
+                                                  variable.dtype.base_dtype),
+                                         trainable=False, collections=[],
+                                         name=variable.op.name.replace('/', '_'))
+                             for variable in variables]
+            self._snapshot = tf.group(*[shadow.assign(variable) for shadow, variable
+                                        in zip(self._shadows, variables)])
+        self._saver = tf.train.Saver(
+            dict((variable.op.name, shadow) for variable, shadow
+                 in zip(variables, self._shadows)),
+            max_to_keep=keep, write_version=tf.train.SaverDef.V2)
+        self._restorer = tf.train.Saver(variables, write_version=tf.train.SaverDef.V2)
+        self._recover_checkpoints()
+        self.last_step = None
+        self.last_time = time.time()
+        self.saves = 0
+        self._error = None
+        self._idle = threading.Event()
+        self._idle.set()
+        self._thread = None
+
+    #A new Saver only counts its own saves towards max_to_keep. Hands it the checkpoints
+    #already in log_dir so that keep holds across restarts, deleting those (and their state
+    #files) beyond the newest 'keep' right away
+    def _recover_checkpoints(self):
+        state = tf.train.get_checkpoint_state(self.log_dir)
+        if state is None:
+            return
+        # Checkpoints always live in log_dir, however their paths were recorded
+        paths = [os.path.join(self.log_dir, os.path.basename(path))
+                 for path in state.all_model_checkpoint_paths]
+        stale = paths[:-self.keep] if self.keep else []
+        for path in stale:
+            for name in glob.glob(path + '.*'):
+                os.remove(name)
+        self._saver.recover_last_checkpoints(paths[len(stale):])
+
+    #Restores the newest checkpoint in log_dir, returns its training state (None if there is
+    #no checkpoint, {} if its state file is missing)
+    def restore(self, session):
+        checkpoint = tf.train.latest_checkpoint(self.log_dir)
+        if checkpoint is None:
+            return None
+        self._restorer.restore(session, checkpoint)
+        self.last_step = int(checkpoint.rsplit('-', 1)[1])
+        print("Restored %s" % checkpoint)
+        return read_state(checkpoint) or {}
+
+    def due(self, globalStep):
+        if self.last_step is not None and globalStep <= self.last_step:
+            return False
+        if self.save_steps and globalStep % self.save_steps == 0:
+            return True
+        return self.save_secs is not None and time.time() - self.last_time >= self.save_secs
+
+    #Called by the training loop between steps. Starts a background save if one is due
+    #and the previous one has finished - training never waits on the disk
+    def maybe_save(self, session, globalStep, state):
+        self._check()
+        if not self.due(globalStep) or not self._idle.is_set():
+            return False
+        self.save(session, globalStep, state)
+        return True
+
+    #Snapshots the variables now and writes them in the background
+    def save(self, session, globalStep, state, wait=False):
+        self.wait()
+        session.run(self._snapshot)
+        self.last_step = globalStep
+        self.last_time = time.time()
+        self._idle.clear()
+        self._thread = threading.Thread(target=self._write, args=(session, globalStep, state))
+        self._thread.daemon = True
+        self._thread.start()
+        if wait:
+            self.wait()
+
+    def _write(self, session, globalStep, state):
+        try:
+            if not os.path.isdir(self.log_dir):
+                os.makedirs(self.log_dir)
+            # State first - a checkpoint is never listed without its state file
+            write_state('%s-%d' % (self.prefix, globalStep), state)
+            self._saver.save(session, self.prefix, global_step=globalStep,
+                             write_meta_graph=False)
+            self._prune_states()
+            self.saves += 1
+        except Exception as error:
+            self._error = error
+        finally:
+            self._idle.set()
+
+    def _prune_states(self):
+        kept = set(os.path.basename(path) for path in self._saver.last_checkpoints)
+        for name in os.listdir(self.log_dir):
+            if name.startswith(CHECKPOINT_NAME) and name.endswith('.state.json'):
+                if name[:-len('.state.json')] not in kept:
+                    os.remove(os.path.join(self.log_dir, name))
+
+    def _check(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    #Blocks until the save in flight (if any) is on disk
+    def wait(self):
+        self._idle.wait()
+        self._check()
+
+    #Final synchronous save, e.g. at the end of training or on interrupt
+    def close(self, session=None, globalStep=None, state=None):
+        if session is not None and globalStep is not None and globalStep != self.last_step:
+            self.save(session, globalStep, state, wait=True)
+        self.wait()
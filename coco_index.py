@@ -0,0 +1,136 @@
+# MS-COCO caption annotations ship as one large JSON file (~80 MB for train2014)
+# Parsing it takes seconds and holds every annotation in memory, so we parse it once
+# and keep a SQLite copy next to it keyed by image_id. Later runs only open the index.
+
+import json as js
+import os
+import sqlite3
+
+# Bump when the table layout changes so old indexes are rebuilt
+INDEX_VERSION = 2
+
+# SQLite limits the number of bound parameters per statement
+_QUERY_CHUNK = 500
+
+class CaptionIndex(object):
+
+    def __init__(self, annFile, indexFile=None):
+        self.ann_file = annFile
+        if indexFile is None:
+            indexFile = os.path.splitext(annFile)[0] + '.sqlite'
+        self.index_file = indexFile
+        self._db = None
+
+    #Connection is opened (and the index built if needed) on first use
+    @property
+    def db(self):
+        if self._db is None:
+            if not self.is_current():
+                self.build()
+            self._db = sqlite3.connect(self.index_file, check_same_thread=False)
+        return self._db
+
+    def _source_stamp(self):
+        stat = os.stat(self.ann_file)
+        return '%d:%d:%d' % (INDEX_VERSION, stat.st_size, int(stat.st_mtime))
+
+    #An index is current if it was built by this version from the same annotation file
+    #If the annotation file is gone we trust whatever index exists
+    def is_current(self):
+        if not os.path.exists(self.index_file):
+            return False
+        if not os.path.exists(self.ann_file):
+            return True
+        db = sqlite3.connect(self.index_file)
+        try:
+            row = db.execute("SELECT value FROM meta WHERE key = 'source'").fetchone()
+        except sqlite3.DatabaseError:
+            row = None
+        finally:
+            db.close()
+        return row is not None and row[0] == self._source_stamp()
+
+    #Parse the annotation JSON once and write the index. We build into a temporary file
+    #and rename it so an interrupted build never leaves a half-written index behind
+    def build(self):
+        print("Building caption index %s from %s" % (self.index_file, self.ann_file))
+        with open(self.ann_file, 'r') as annotations:
+            dataset = js.load(annotations)
+        tmpFile = self.index_file + '.tmp'
+        if os.path.exists(tmpFile):
+            os.remove(tmpFile)
+        db = sqlite3.connect(tmpFile)
+        db.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+        db.execute("CREATE TABLE images (id INTEGER PRIMARY KEY, file_name TEXT, "
+                   "width INTEGER, height INTEGER)")
+        # seq is the annotation's position in the file. An INTEGER PRIMARY KEY on id would
+        # make id the rowid and order captions by annotation ID instead
+        db.execute("CREATE TABLE captions (seq INTEGER PRIMARY KEY, id INTEGER, "
+                   "image_id INTEGER, caption TEXT)")
+        db.executemany("INSERT INTO images VALUES (?, ?, ?, ?)",
+                       ((img['id'], img.get('file_name'), img.get('width'), img.get('height'))
+                        for img in dataset['images']))
+        db.executemany("INSERT INTO captions VALUES (?, ?, ?, ?)",
+                       ((seq, ann['id'], ann['image_id'], ann['caption'])
+                        for seq, ann in enumerate(dataset['annotations'])))
+        db.execute("CREATE INDEX captions_by_image ON captions (image_id)")
+        db.execute("INSERT INTO meta VALUES ('source', ?)", (self._source_stamp(),))
+        db.commit()
+        db.close()
+        del dataset
+        os.rename(tmpFile, self.index_file)
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    #Sorted image IDs, optionally only the first 'limit'
+    def img_ids(self, limit=None):
+        if limit is None:
+            rows = self.db.execute("SELECT id FROM images ORDER BY id")
+        else:
+            rows = self.db.execute("SELECT id FROM images ORDER BY id LIMIT ?", (limit,))
+        return [row[0] for row in rows]
+
+    def image_info(self, imgID):
+        row = self.db.execute("SELECT id, file_name, width, height FROM images WHERE id = ?",
+                              (imgID,)).fetchone()
+        if row is None:
+            raise KeyError(imgID)
+        return {'id': row[0], 'file_name': row[1], 'width': row[2], 'height': row[3]}
+
+    #(width, height) of every image ID, None for images missing from the index or their size
+    def image_sizes(self, imgIDs):
+        imgIDs = list(imgIDs)
+        sizes = {}
+        for start in range(0, len(imgIDs), _QUERY_CHUNK):
+            chunk = imgIDs[start:start + _QUERY_CHUNK]
+            query = ("SELECT id, width, height FROM images WHERE id IN (%s)" %
+                     ','.join('?' * len(chunk)))
+            for row in self.db.execute(query, chunk):
+                if row[1] and row[2]:
+                    sizes[row[0]] = (row[1], row[2])
+        return [sizes.get(imgID) for imgID in imgIDs]
+
+    #Caption annotations for a set of image IDs, in the same format and order as
+    #COCO.loadAnns(COCO.getAnnIds(imgIDs))
+    def captions(self, imgIDs):
+        imgIDs = list(imgIDs)
+        byImage = {}
+        for start in range(0, len(imgIDs), _QUERY_CHUNK):
+            chunk = imgIDs[start:start + _QUERY_CHUNK]
+            query = ("SELECT id, image_id, caption FROM captions WHERE image_id IN (%s) "
+                     "ORDER BY seq" % ','.join('?' * len(chunk)))
+            for row in self.db.execute(query, chunk):
+                byImage.setdefault(row[1], []).append(
+                    {'id': row[0], 'image_id': row[1], 'caption': row[2]})
+        anns = []
+        for imgID in imgIDs:
+            anns.extend(byImage.get(imgID, []))
+        return anns
+
+    #Streams every caption annotation without loading them all at once
+    def iter_captions(self):
+        for row in self.db.execute("SELECT id, image_id, caption FROM captions ORDER BY seq"):
+            yield {'id': row[0], 'image_id': row[1], 'caption': row[2]}
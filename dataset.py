@@ -0,0 +1,171 @@
+# On-disk training/test dataset format
+# A dataset is a directory holding one .npy file per array plus manifest.json:
+#   {"format": "captiongen-dataset", "version": 1,
+#    "arrays": {"phrases": {"file": "phrases.npy", "dtype": "int32", "shape": [N, P, L]}, ...},
+#    "vocab": [word for each ID], "input": {...}, "parameters": {...},
+#    "annotations": "annotations/captions_val2014.json"}
+# annotations (optional) is the MS-COCO caption file the image_ids come from
+# Arrays are opened with np.load(mmap_mode='r'), so loading is zero-copy and the network
+# only pages in the rows it slices - datasets can be larger than RAM.
+
+import json as js
+import os
+
+import numpy as np
+
+FORMAT = 'captiongen-dataset'
+VERSION = 1
+MANIFEST = 'manifest.json'
+
+# Arrays every dataset must have, with their dtype and number of dimensions
+REQUIRED_ARRAYS = {
+    'phrases': ('int32', 3),   # (images, phrase_count, phrase_dimension) word IDs
+    'captions': ('int32', 2),  # (captions, phrase_dimension) word IDs
+}
+# Optional arrays:
+#   caption_images int32 (captions,) - phrases row of every caption. Without it there is
+#                   one caption per image, caption i belonging to image i
+#   caption_lengths int32 (captions,) - caption length including <STOP>, computed if missing
+#   image_ids int64 (images,) - MS-COCO image ID of every phrases row
+
+# NetworkInput / NetworkParameters settings kept in the manifest
+INPUT_FIELDS = ['batch_size', 'phrase_count', 'phrase_dimension', 'word_dimension',
+                'num_epochs', 'display_step', 'seed']
+PARAMETER_FIELDS = ['layer_size', 'num_layers', 'learning_rate', 'init_scale', 'embedding_size',
+                    'loss', 'num_sampled', 'towers']
+
+class DatasetError(Exception):
+    pass
+
+#Writes arrays and manifest to 'directory'. vocab lists the word of every ID in order
+#inputs and params are NetworkInput / NetworkParameters or plain dicts of their fields
+#annotations optionally names the MS-COCO caption file of the image_ids
+def save_dataset(directory, arrays, vocab, inputs, params, annotations=None):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    manifest = {'format': FORMAT, 'version': VERSION, 'arrays': {},
+                'vocab': list(vocab),
+                'input': _fields(inputs, INPUT_FIELDS),
+                'parameters': _fields(params, PARAMETER_FIELDS)}
+    if annotations is not None:
+        manifest['annotations'] = annotations
+    for name in sorted(arrays):
+        array = np.asarray(arrays[name])
+        if name in REQUIRED_ARRAYS:
+            array = array.astype(REQUIRED_ARRAYS[name][0], copy=False)
+        fileName = name + '.npy'
+        np.save(os.path.join(directory, fileName), array)
+        manifest['arrays'][name] = {'file': fileName, 'dtype': array.dtype.name,
+                                    'shape': list(array.shape)}
+    # Manifest goes last - a directory without one is an incomplete write
+    tmpFile = os.path.join(directory, MANIFEST + '.tmp')
+    with open(tmpFile, 'w') as f:
+        js.dump(manifest, f, indent=1)
+    os.rename(tmpFile, os.path.join(directory, MANIFEST))
+
+def _fields(obj, names):
+    if isinstance(obj, dict):
+        return dict((name, obj[name]) for name in names if name in obj)
+    return dict((name, getattr(obj, name)) for name in names if hasattr(obj, name))
+
+def load_dataset(directory, mmap=True):
+    return Dataset(directory, mmap)
+
+class Dataset(object):
+
+    def __init__(self, directory, mmap=True):
+        self.directory = directory
+        path = os.path.join(directory, MANIFEST)
+        if not os.path.exists(path):
+            raise DatasetError("%s has no %s" % (directory, MANIFEST))
+        with open(path, 'r') as f:
+            self.manifest = js.load(f)
+        self._validate_manifest()
+        self.arrays = {}
+        for name, spec in self.manifest['arrays'].items():
+            array = np.load(os.path.join(directory, spec['file']),
+                            mmap_mode='r' if mmap else None)
+            if array.dtype.name != spec['dtype'] or list(array.shape) != spec['shape']:
+                raise DatasetError("%s: array '%s' is %s %s, manifest says %s %s" % (
+                    directory, name, array.dtype.name, list(array.shape),
+                    spec['dtype'], spec['shape']))
+            self.arrays[name] = array
+        captionImages = self.arrays.get('caption_images')
+        if captionImages is None:
+            if len(self.phrases) != len(self.captions):
+                raise DatasetError("%s: %d phrase rows but %d caption rows" % (
+                    directory, len(self.phrases), len(self.captions)))
+        elif len(captionImages) != len(self.captions):
+            raise DatasetError("%s: %d caption rows but %d caption_images" % (
+                directory, len(self.captions), len(captionImages)))
+        elif len(captionImages) and (captionImages.min() < 0 or
+                                     captionImages.max() >= len(self.phrases)):
+            raise DatasetError("%s: caption_images point outside of the %d phrase rows" % (
+                directory, len(self.phrases)))
+
+    def _validate_manifest(self):
+        if self.manifest.get('format') != FORMAT:
+            raise DatasetError("%s is not a %s directory" % (self.directory, FORMAT))
+        if self.manifest.get('version') != VERSION:
+            raise DatasetError("%s has version %s, expected %d" % (
+                self.directory, self.manifest.get('version'), VERSION))
+        for name, (dtype, ndim) in REQUIRED_ARRAYS.items():
+            spec = self.manifest['arrays'].get(name)
+            if spec is None:
+                raise DatasetError("%s is missing array '%s'" % (self.directory, name))
+            if spec['dtype'] != dtype or len(spec['shape']) != ndim:
+                raise DatasetError("%s: array '%s' must be %dD %s" % (
+                    self.directory, name, ndim, dtype))
+
+    def __len__(self):
+        return len(self.phrases)
+
+    @property
+    def phrases(self):
+        return self.arrays['phrases']
+
+    @property
+    def captions(self):
+        return self.arrays['captions']
+
+    @property
+    def vocab(self):
+        return self.manifest['vocab']
+
+    #MS-COCO caption file of the image_ids, None if not recorded
+    @property
+    def annotations(self):
+        return self.manifest.get('annotations')
+
+    #ID -> word
+    @property
+    def decoder(self):
+        return dict(enumerate(self.vocab))
+
+    #word -> ID
+    @property
+    def encoder(self):
+        return dict((word, index) for index, word in enumerate(self.vocab))
+
+    #Settings in the manifest can be overridden, e.g. num_epochs for a longer run
+    def network_input(self, **overrides):
+        import recurrent_network as rn
+        settings = dict(self.manifest['input'])
+        settings.update(overrides)
+        return rn.NetworkInput(settings['batch_size'], settings['phrase_count'],
+                               settings['phrase_dimension'], settings['word_dimension'],
+                               [self.phrases, self.captions],
+                               settings['num_epochs'], settings['display_step'],
+                               settings.get('seed', 0), self.arrays.get('caption_lengths'),
+                               self.arrays.get('caption_images'))
+
+    def network_parameters(self, **overrides):
+        import recurrent_network as rn
+        settings = dict(self.manifest['parameters'])
+        settings.update(overrides)
+        return rn.NetworkParameters(settings['layer_size'], settings['num_layers'],
+                                    settings['learning_rate'], settings.get('init_scale', 0.1),
+                                    settings.get('embedding_size'),
+                                    settings.get('loss', 'softmax'),
+                                    settings.get('num_sampled', 64),
+                                    settings.get('towers', 1))
@@ -0,0 +1,125 @@
+# Densecap is by far the slowest preprocessing step, so its per-image results are cached.
+# Entries are keyed by the SHA-1 of the image bytes under a directory keyed by the densecap
+# options that affect the output, so renamed or re-copied images are never reprocessed and
+# changing the checkpoint or thresholds starts a fresh cache:
+#   results/cache/<opt hash>/<image hash[:2]>/<image hash>.json
+# Only uncached images are handed to densecap. Its output is merged into the cache and
+# a regular densecap results.json is written for the requested images.
+
+from __future__ import print_function
+
+import hashlib
+import json as js
+import os
+import shutil
+import tempfile
+
+import densecap_results
+import densecap_runner
+from densecap_runner import DEFAULT_OPT
+
+CACHE_DIR = 'results/cache'
+
+def _sha1(data):
+    return hashlib.sha1(data).hexdigest()
+
+def opt_key(opt):
+    return _sha1(js.dumps(opt, sort_keys=True).encode('utf-8'))
+
+def image_key(path, chunkSize=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        chunk = f.read(chunkSize)
+        while chunk:
+            digest.update(chunk)
+            chunk = f.read(chunkSize)
+    return digest.hexdigest()
+
+class DensecapCache(object):
+
+    def __init__(self, opt=None, cacheDir=CACHE_DIR):
+        self.opt = dict(DEFAULT_OPT if opt is None else opt)
+        self.directory = os.path.join(cacheDir, opt_key(self.opt))
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.json')
+
+    def __contains__(self, key):
+        return os.path.exists(self._entry_path(key))
+
+    #Cached entries are stored without img_name, the same image may go by several names
+    def lookup(self, key, name):
+        with open(self._entry_path(key), 'r') as f:
+            entry = js.load(f)
+        entry['img_name'] = name
+        return entry
+
+    def store(self, key, entry):
+        path = self._entry_path(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        entry = dict(entry)
+        entry.pop('img_name', None)
+        with open(path + '.tmp', 'w') as f:
+            js.dump(entry, f)
+        os.rename(path + '.tmp', path)
+
+    #Runs densecap over 'paths' (a list of image files), writing them into the cache
+    #keys maps each path to its content hash. Extra arguments go to densecap_runner.run_sharded
+    def process(self, paths, keys, **kwargs):
+        workDir = tempfile.mkdtemp(prefix='densecap_')
+        try:
+            resultFiles = densecap_runner.run_sharded(paths, workDir, self.opt, **kwargs)
+            byName = {}
+            for path in paths:
+                byName[os.path.basename(path)] = keys[path]
+            stored = 0
+            for resultFile in resultFiles:
+                for entry in densecap_results.iter_images(resultFile):
+                    key = byName.get(os.path.basename(entry['img_name']))
+                    if key is not None:
+                        self.store(key, entry)
+                        stored += 1
+            return stored
+        finally:
+            shutil.rmtree(workDir, ignore_errors=True)
+
+#Densecap results for every image in 'paths', written to outputFile in the usual
+#{"opt": ..., "results": [...]} layout. Only images missing from the cache are processed
+#Extra arguments (workers, retries, command, densecapDir, ...) go to densecap_runner.run_sharded
+def run_densecap(paths, outputFile, opt=None, cacheDir=CACHE_DIR, **kwargs):
+    cache = DensecapCache(opt, cacheDir)
+    keys = {}
+    for path in paths:
+        keys[path] = image_key(path)
+    missing = [path for path in paths if keys[path] not in cache]
+    # Identical images only need processing once
+    seen = set()
+    uncached = []
+    for path in missing:
+        if keys[path] not in seen:
+            seen.add(keys[path])
+            uncached.append(path)
+    print("%d of %d images cached, processing %d" % (
+        len(paths) - len(missing), len(paths), len(uncached)))
+    if uncached:
+        cache.process(uncached, keys, **kwargs)
+    write_results(cache, paths, keys, outputFile)
+    return outputFile
+
+#Entries are written one at a time so the merged file never has to sit in memory
+def write_results(cache, paths, keys, outputFile):
+    tmpFile = outputFile + '.tmp'
+    with open(tmpFile, 'w') as f:
+        f.write('{"opt": %s, "results": [' % js.dumps(cache.opt, sort_keys=True))
+        first = True
+        for path in paths:
+            if keys[path] not in cache:
+                print("No densecap result for %s" % path)
+                continue
+            if not first:
+                f.write(', ')
+            first = False
+            js.dump(cache.lookup(keys[path], os.path.basename(path)), f)
+        f.write(']}')
+    os.rename(tmpFile, outputFile)
@@ -2,7 +2,6 @@
 # boxes are given as xy coordinate of upper left corner and width/height
 # We want to give an id to every phrase, box and score, and store each in a dictionary
 
-from pycocotools.coco import COCO
 import json as js
 import numpy as np
 import subprocess
@@ -10,47 +9,113 @@ import re
 import math
 import os
 import code
+from collections import OrderedDict
 
 import salience
+import vocabulary
+from coco_index import CaptionIndex
+from densecap_results import DensecapResults
+import densecap_cache
+from densecap_runner import DEFAULT_OPT
 
 annFile = 'annotations/captions_train2014.json'
-coco = COCO(annFile)
+_coco = None
+
+VOCAB_FILE = 'annotations/vocab.txt'
 
 START = '\''
 STOP = '.'
 
 ############################### MS COCO PROCESSING #####################################
 
+def coco_ann_file(train):
+    if train:
+        return 'annotations/captions_train2014.json'
+    return 'annotations/captions_val2014.json'
+
+#Selects the train or val 2014 captions. Nothing is read until the first lookup
+def set_coco_dataset(train):
+    global annFile, _coco
+    annFile = coco_ann_file(train)
+    if _coco is not None:
+        _coco.close()
+    _coco = None
+
+#Caption index for the current dataset - built from annFile on first use, see coco_index.py
+def coco():
+    global _coco
+    if _coco is None:
+        _coco = CaptionIndex(annFile)
+    return _coco
+
 #Get some number of imgIDs from MS-COCO
 def get_coco_imgs(number):
-    imgIDs = sorted(coco.getImgIds())
-    numImages = imgIDs[:number]
-    return numImages
+    return coco().img_ids(number)
     
+#(width, height) of a set of image Ids from MS-COCO, None if unknown
+def get_coco_image_sizes(imgIDs):
+    return coco().image_sizes(imgIDs)
+
+#Image sizes in densecap's box coordinates: run_model.lua scales every image so that its
+#longer side is imageSize before proposing boxes. sizes are (width, height) pairs, e.g.
+#from get_coco_image_sizes; None stays None
+def densecap_image_sizes(sizes, imageSize=DEFAULT_OPT['image_size']):
+    scaled = []
+    for size in sizes:
+        if size is None:
+            scaled.append(None)
+        else:
+            scale = float(imageSize) / max(size[0], size[1])
+            scaled.append((int(size[0] * scale + 0.5), int(size[1] * scale + 0.5)))
+    return scaled
+
 #Retrieves set of captions for a set of image Ids from MS-COCO
 def coco_to_captions(imgIDs):
-    numAnnIDs = coco.getAnnIds(imgIDs)
-    return coco.loadAnns(numAnnIDs)
+    return coco().captions(imgIDs)
 
-#Returns a single caption associated with each image from the set of annotations
-#images have multiple captions which we may be able to take advantage of later
+#Returns up to caption_count captions for each image from the set of annotations,
+#every caption of the image if caption_count is None (5 for MS-COCO)
 #We also add <START> and <STOP> symbols - we use escaped characters \' and \" respectively
+#Images keep the order they first appear in _captions (coco_to_captions follows imgIDs)
 def get_coco_captions(_captions, caption_count=1):
-    capDict = {}
+    capDict = OrderedDict()
     for x in _captions:
         if not x['image_id'] in capDict:
             capDict[x['image_id']] = [START + x['caption']]
-        elif len(capDict[x['image_id']]) < caption_count:
+        elif caption_count is None or len(capDict[x['image_id']]) < caption_count:
             capDict[x['image_id']].append(START + x['caption'])
     return capDict
 
 #Returns a sorted list of unique words from the set of annotations
-def get_coco_lexicon(_captions):
-    words = []
+#With no annotations given, streams every caption of the current dataset
+def get_coco_lexicon(_captions=None):
+    if _captions is None:
+        _captions = coco().iter_captions()
+    words = set()
     for x in _captions:
-        for word in re.split('[(\'\.)\s,]', x['caption']):
-            words.append(word)
-    return sorted(set(words))
+        words.update(re.split('[(\'\.)\s,]', x['caption']))
+    return sorted(words)
+
+#Counts word frequencies over the captions of the first 'number' train and val images
+#(every image if None) in one pass and saves the pruned vocabulary, so train and test
+#share word IDs. Words seen fewer than minCount times become <UNK> - see vocabulary.py
+def save_full_coco_lexicon(number=None, minCount=5, maxSize=None, path=VOCAB_FILE):
+    builder = vocabulary.VocabularyBuilder()
+    for train in (1, 0):
+        index = CaptionIndex(coco_ann_file(train))
+        if number is None:
+            anns = index.iter_captions()
+        else:
+            anns = index.captions(index.img_ids(number))
+        builder.add_all(x['caption'] for x in anns)
+        index.close()
+    vocab = builder.build(minCount, maxSize)
+    vocab.save(path)
+    print "Saved %d word vocabulary to %s" % (vocab.size, path)
+    return vocab
+
+def load_coco_vocabulary(path=VOCAB_FILE):
+    return vocabulary.load_vocabulary(path)
 
 ################################# DENSECAP PROCESSING ###########################################
 #Still assumes densecap is in the folder next to ImageCaptionGeneration
@@ -58,31 +123,42 @@ def get_coco_lexicon(_captions):
 #/ImageCaptionGeneration
 #    /annotations <= contains MS-COCO 2014 annotations
 #    /images <= contains MS-COCO 2014 training images
-#    /densecap_images <= input dir to densecap processing
 #    /results
 #        /boxes <= holds visually annotated images after densecap
+#        /cache <= per-image densecap results, keyed by image content and densecap options
 
 # TAKES SET OF IMAGE IDs FROM MS COCO
 
+def coco_image_name(imgID, train):
+    if train:
+        return 'COCO_train2014_%s.jpg'%(str(imgID).zfill(12))
+    return 'COCO_val2014_%s.jpg'%(str(imgID).zfill(12))
+
 #Automatically executes densecap on a set of image Ids from MS-COCO
-#automatically writes results to /results
+#automatically writes results to results/train_results.json or results/val_results.json
 #need to be in /densecap to execute "run_model.lua" because I can't figure
 #out how to install lua modules. 
-def coco_to_densecap(imgIDs):
-    print "Cleaning processing folder..."
-    deleteCommand = 'rm -rf densecap_images && mkdir densecap_images'
-    subprocess.call(deleteCommand, shell=True)
-    for x in imgIDs:
-        command = 'cp images/COCO_train2014_%s.jpg densecap_images'%(str(x).zfill(12))
-        print str(x) + " Executing: "+ command
-        subprocess.call(command, shell=True)
-    os.chdir("../densecap")
-    dense_command = "th run_model.lua -input_dir ../ImageCaptionGeneration/densecap_images -output_vis_dir ../ImageCaptionGeneration/results -output_dir ../ImageCaptionGeneration/results/boxes -gpu -1"
-    subprocess.call(dense_command, shell=True)
-    os.chdir("../ImageCaptionGeneration")
+#Results are cached by image content and densecap options, so only new images are
+#sent to densecap - see densecap_cache.py. Those are split into shards processed by
+#'workers' parallel densecap processes - see densecap_runner.py
+#'command' replaces "th run_model.lua", as an argv list or a shell-style string
+def coco_to_densecap(imgIDs, train=1, opt=None, command=None, workers=None):
+    paths = ['images/' + coco_image_name(x, train) for x in imgIDs]
+    if train:
+        outputFile = 'results/train_results.json'
+    else:
+        outputFile = 'results/val_results.json'
+    densecap_cache.run_densecap(paths, outputFile, opt, command=command, workers=workers,
+                                boxesDir='results/boxes')
+
+#Opens densecap results for streaming and random access by img_name
+#Only the requested images are decoded, see densecap_results.py
+def open_results(_json):
+    return DensecapResults(_json)
 
 #Used to retrieve densecap processing results
 #Takes a path to _json filename. Should be "results/results.json" in the local directory.
+#Loads everything at once - prefer open_results for large result files
 def json_to_dict(_json):
     json = open(_json, 'r')
     result = js.load(json)
@@ -138,59 +214,93 @@ def string_to_vector(word, invertDict):
 def vector_to_string(vector, wordDict):
     return wordDict[np.argmax(vector)]
 
-def extract_phrase_vectors(phrase_count, phraseLength, imgCount, image_props, invertDict):
-    one_hot_list = [[[[]] * phraseLength] * phrase_count] * imgCount
+#Network inputs are int32 word IDs rather than one-hot vectors - the network does the
+#embedding lookup itself. Padding and unknown words get an ID one past the end of the
+#lexicon, which the network maps to an all-zero input, just like the empty one-hot vector
+def pad_id(invertDict):
+    return len(invertDict)
+
+#Length of every ID sequence along the last axis: the position after its last non-pad ID
+def sequence_lengths(id_array, padID):
+    real = np.asarray(id_array) != padID
+    width = real.shape[-1]
+    lengths = width - np.argmax(real[..., ::-1], axis=-1)
+    return np.where(real.any(axis=-1), lengths, 0).astype(np.int32)
+
+#ID of a word - words missing from the lexicon map to <UNK> if it has one, else None
+def word_id(word, invertDict):
+    if word in invertDict:
+        return invertDict[word]
+    return invertDict.get(vocabulary.UNK)
+
+#Returns an int32 array of shape (imgCount, phrase_count, phraseLength)
+#Phrases are chosen by salience.select_phrases: confident, central and not overlapping
+#dims optionally holds every image's (width, height) in box coordinates, for entries
+#without a 'dim', see densecap_image_sizes
+def extract_phrase_vectors(phrase_count, phraseLength, imgCount, image_props, invertDict,
+                           dims=None):
+    id_array = np.full((imgCount, phrase_count, phraseLength), pad_id(invertDict), dtype=np.int32)
+    selected = salience.select_phrases([image_props[x] for x in range(0, imgCount)], phrase_count,
+                                       dims=dims)
     for x in range(0, imgCount):
-        salient = salience.salient_phrases(
-            image_props, x, lambda: salience.k_top_scores(image_props[x], phrase_count))
-        phraseI = 0
-        for phrase in salient:
-            count = 0
-            #print ("Phrase ", phrase)
-            for word in phrase.split():
-                #print word
-                if count >= phraseLength:
-                    #print "Break phrase"
-                    break
-                elif word in invertDict:
-                    #print "Add word"
-                    one_hot_list[x][phraseI][count] = string_to_vector(word, invertDict)
-                else:
-                    #print "Fill void"
-                    one_hot_list[x][phraseI][count] = empty_one_hot_vector(len(invertDict))
-                #print count
-                count = count + 1
-            while count < phraseLength:  #Padding
-                one_hot_list[x][phraseI][count] = empty_one_hot_vector(len(invertDict))
-                count = count + 1
-            #print count
-            #print phraseI
-            phraseI = phraseI + 1
-    return one_hot_list
-
-#Remember that one day we will need to generalize this yet again for captionCount
+        phrases_to_ids(selected[x], phraseLength, invertDict, id_array[x])
+    return id_array
+
+#Phrase IDs for a single densecap image entry, shaped (phrase_count, phraseLength)
+def extract_image_phrase_vectors(phrase_count, phraseLength, image, invertDict):
+    return extract_phrase_vectors(phrase_count, phraseLength, 1, {0: image}, invertDict)[0]
+
+#Writes the word IDs of each phrase into a row of id_array
+def phrases_to_ids(phrases, phraseLength, invertDict, id_array):
+    phraseI = 0
+    for phrase in phrases:
+        count = 0
+        for word in vocabulary.tokenize(phrase):
+            if count >= phraseLength:
+                break
+            elif word_id(word, invertDict) is not None:
+                id_array[phraseI, count] = word_id(word, invertDict)
+            count = count + 1
+        phraseI = phraseI + 1
+    return id_array
+
+#Returns an int32 array of shape (imgCount, phraseLength)
+#Only one caption per image is kept - see extract_caption_pairs for all of them
 def extract_caption_vectors(phraseLength, imgCount, invertDict, captions):
-    one_hot_list = [[[]] * phraseLength] * imgCount
+    id_array = np.full((imgCount, phraseLength), pad_id(invertDict), dtype=np.int32)
     imgID = 0
     for cap in captions:
         for caption in captions[cap]:
-            count = 0
-            for word in re.split('[(\'\.\s)]', caption): 
-                #print word
-                if count >= phraseLength:
-                    #print "break cap"
-                    break
-                elif word in invertDict:
-                    #print "To one-hot"
-                    one_hot_list[imgID][count] = (string_to_vector(word, invertDict))
-                else:
-                    #print "Caption split deviant"
-                    one_hot_list[imgID][count] = (empty_one_hot_vector(len(invertDict)))
-                count = count + 1
-            while count < phraseLength:    #Padding
-                one_hot_list[imgID][count] = (empty_one_hot_vector(len(invertDict)))
-                count = count + 1
+            caption_to_ids(caption, phraseLength, invertDict, id_array[imgID])
         imgID = imgID + 1
-    return one_hot_list
+    return id_array
 
+#Every caption of every image, shaped (captionCount, phraseLength), and the row of its image
+#(in the order of 'captions') as an int32 (captionCount,) array. Images are stored once and
+#referenced by index rather than repeating their phrases per caption
+def extract_caption_pairs(phraseLength, invertDict, captions):
+    count = sum(len(captions[cap]) for cap in captions)
+    id_array = np.full((count, phraseLength), pad_id(invertDict), dtype=np.int32)
+    image_index = np.zeros(count, dtype=np.int32)
+    row = 0
+    for imgRow, cap in enumerate(captions):
+        for caption in captions[cap]:
+            caption_to_ids(caption, phraseLength, invertDict, id_array[row])
+            image_index[row] = imgRow
+            row = row + 1
+    return id_array, image_index
 
+#Writes the word IDs of a caption into row, followed by <STOP> if there is room
+def caption_to_ids(caption, phraseLength, invertDict, row):
+    row[:] = pad_id(invertDict)
+    count = 0
+    for word in vocabulary.tokenize(caption): 
+        if count >= phraseLength:
+            break
+        elif word_id(word, invertDict) is not None:
+            row[count] = word_id(word, invertDict)
+        count = count + 1
+    #Captions end in <STOP> so the network learns when to stop generating
+    if count < phraseLength and STOP in invertDict:
+        row[count] = invertDict[STOP]
+    return row
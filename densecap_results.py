@@ -0,0 +1,174 @@
+# Densecap writes one results.json holding every processed image:
+#   {"opt": {...}, "results": [{"img_name": ..., "boxes": [...], "captions": [...],
+#                               "scores": [...]}, ...]}
+# With ~1000 boxes per image this gets far too large to js.load for big image sets.
+# DensecapResults memory-maps the file, streams the 'results' entries one image at a time,
+# and keeps a persisted byte-offset index by img_name for random access to single images.
+
+import json as js
+import mmap
+import os
+import re
+
+# Bump when the index layout changes so old indexes are rebuilt
+INDEX_VERSION = 1
+
+_STRUCTURE = re.compile(br'[\[\]{}"]')
+_STRING_END = re.compile(br'["\\]')
+
+#Yields the (start, end) byte span of every entry of the top level 'results' array
+#Only brackets, braces and strings are looked at, numbers are skipped by the regex
+def scan_results(data):
+    depth = 0
+    lastKey = None
+    resultsDepth = None
+    entryStart = None
+    pos = 0
+    while True:
+        match = _STRUCTURE.search(data, pos)
+        if match is None:
+            return
+        pos = match.end()
+        char = data[match.start():pos]
+        if char == b'"':
+            start = pos
+            while True:
+                end = _STRING_END.search(data, pos)
+                if data[end.start():end.end()] == b'\\':
+                    pos = end.end() + 1
+                    continue
+                pos = end.end()
+                break
+            if depth == 1:
+                lastKey = data[start:pos - 1]
+        elif char in (b'{', b'['):
+            depth += 1
+            if resultsDepth is None:
+                if char == b'[' and depth == 2 and lastKey == b'results':
+                    resultsDepth = depth
+            elif depth == resultsDepth + 1:
+                entryStart = match.start()
+        else:
+            if resultsDepth is not None:
+                if depth == resultsDepth + 1:
+                    yield entryStart, pos
+                elif depth == resultsDepth:
+                    return
+            depth -= 1
+
+#Streams image entries one at a time without building an index
+def iter_images(_json):
+    with open(_json, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for start, end in scan_results(data):
+                yield js.loads(data[start:end].decode('utf-8'))
+        finally:
+            data.close()
+
+class DensecapResults(object):
+
+    def __init__(self, _json, indexFile=None):
+        self.path = _json
+        if indexFile is None:
+            indexFile = _json + '.index'
+        self.index_file = indexFile
+        self._file = open(_json, 'rb')
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._offsets = None
+        self._names = None
+
+    def _source_stamp(self):
+        stat = os.fstat(self._file.fileno())
+        return '%d:%d:%d' % (INDEX_VERSION, stat.st_size, int(stat.st_mtime))
+
+    #img_name -> (start, end), loaded from disk or built with one streaming pass
+    @property
+    def offsets(self):
+        if self._offsets is None:
+            if not self._load_index():
+                self.build_index()
+        return self._offsets
+
+    def _load_index(self):
+        if not os.path.exists(self.index_file):
+            return False
+        with open(self.index_file, 'r') as f:
+            try:
+                index = js.load(f)
+            except ValueError:
+                return False
+        if index.get('source') != self._source_stamp():
+            return False
+        self._names = index['names']
+        self._offsets = dict(zip(self._names, [tuple(o) for o in index['offsets']]))
+        return True
+
+    #Densecap puts img_name first, so we only decode a short prefix of each entry
+    def build_index(self):
+        names = []
+        offsets = []
+        for start, end in scan_results(self._data):
+            names.append(self._entry_name(start, end))
+            offsets.append((start, end))
+        self._names = names
+        self._offsets = dict(zip(names, offsets))
+        tmpFile = self.index_file + '.tmp'
+        with open(tmpFile, 'w') as f:
+            js.dump({'source': self._source_stamp(), 'names': names, 'offsets': offsets}, f)
+        os.rename(tmpFile, self.index_file)
+
+    def _entry_name(self, start, end):
+        head = self._data[start:min(end, start + 4096)].decode('utf-8', 'ignore')
+        match = re.search(r'"img_name"\s*:\s*"((?:[^"\\]|\\.)*)"', head)
+        if match is not None:
+            return js.loads('"%s"' % match.group(1))
+        return self._read(start, end)['img_name']
+
+    def _read(self, start, end):
+        return js.loads(self._data[start:end].decode('utf-8'))
+
+    def close(self):
+        self._data.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __contains__(self, name):
+        return name in self.offsets
+
+    #Image names in file order
+    def names(self):
+        self.offsets
+        return list(self._names)
+
+    #Streams every image entry in file order
+    def __iter__(self):
+        for start, end in scan_results(self._data):
+            yield self._read(start, end)
+
+    #Random access to a single image's entry
+    def __getitem__(self, name):
+        start, end = self.offsets[name]
+        return self._read(start, end)
+
+    def get(self, name, default=None):
+        if name not in self:
+            return default
+        return self[name]
+
+    def get_boxes(self, name):
+        return self[name]['boxes']
+
+    def get_captions(self, name):
+        return self[name]['captions']
+
+    def get_scores(self, name):
+        return self[name]['scores']
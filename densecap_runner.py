@@ -0,0 +1,202 @@
+# Runs densecap over many images in parallel.
+# The image list is split into shards, each shard is staged into its own input directory
+# with hardlinks (symlinks or copies as fallbacks) and processed by its own
+# 'th run_model.lua' process. Up to 'workers' shards run at once, failed shards are
+# retried, and the per-shard results.json files can be merged into one results file.
+
+from __future__ import print_function
+
+import json as js
+import multiprocessing
+import os
+import shlex
+import shutil
+import subprocess
+import time
+
+import densecap_results
+
+DENSECAP_DIR = '../densecap'
+DENSECAP_COMMAND = ['th', 'run_model.lua']
+
+try:
+    _STRING_TYPES = basestring
+except NameError:
+    _STRING_TYPES = str
+
+# Options of run_model.lua that change what it outputs
+DEFAULT_OPT = {
+    'checkpoint': 'data/models/densecap/densecap-pretrained-vgg16.t7',
+    'image_size': 720,
+    'rpn_nms_thresh': 0.7,
+    'final_nms_thresh': 0.3,
+    'num_proposals': 1000,
+}
+
+#Command line for one densecap run over input_dir, writing results.json to output_vis_dir
+#command replaces DENSECAP_COMMAND, as an argv list or a shell-style string ("sh stub.sh")
+def densecap_command(inputDir, outputVisDir, opt, command=None, outputDir=None):
+    if isinstance(command, _STRING_TYPES):
+        command = shlex.split(command)
+    args = list(command or DENSECAP_COMMAND)
+    args += ['-input_dir', os.path.abspath(inputDir),
+             '-output_vis_dir', os.path.abspath(outputVisDir), '-gpu', '-1']
+    if outputDir is not None:
+        args += ['-output_dir', os.path.abspath(outputDir)]
+    for key in sorted(opt):
+        args += ['-' + key, str(opt[key])]
+    return args
+
+#Splits items into at most shardCount contiguous, nearly equal shards
+def partition(items, shardCount):
+    shardCount = max(1, min(shardCount, len(items)))
+    size, extra = divmod(len(items), shardCount)
+    shards = []
+    start = 0
+    for i in range(shardCount):
+        end = start + size + (1 if i < extra else 0)
+        shards.append(items[start:end])
+        start = end
+    return shards
+
+#Links every image into 'directory' under its own file name
+def stage(paths, directory):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for path in paths:
+        target = os.path.join(directory, os.path.basename(path))
+        if os.path.lexists(target):
+            os.remove(target)
+        try:
+            os.link(path, target)
+        except OSError:
+            try:
+                os.symlink(os.path.abspath(path), target)
+            except OSError:
+                shutil.copyfile(path, target)
+
+class Shard(object):
+    def __init__(self, index, paths, workDir):
+        self.index = index
+        self.paths = paths
+        self.directory = os.path.join(workDir, 'shard_%04d' % index)
+        self.attempts = 0
+        self.process = None
+        self.log = None
+
+    @property
+    def input_dir(self):
+        return os.path.join(self.directory, 'images')
+
+    @property
+    def output_dir(self):
+        return os.path.join(self.directory, 'results')
+
+    @property
+    def results_file(self):
+        return os.path.join(self.output_dir, 'results.json')
+
+    def start(self, opt, command, densecapDir, threads, boxesDir):
+        self.attempts += 1
+        if os.path.isdir(self.output_dir):
+            shutil.rmtree(self.output_dir)
+        os.makedirs(self.output_dir)
+        env = dict(os.environ)
+        # Each worker gets its share of the cores instead of every torch process
+        # trying to use all of them
+        env['OMP_NUM_THREADS'] = str(threads)
+        self.log = open(os.path.join(self.directory, 'densecap.log'), 'a')
+        args = densecap_command(self.input_dir, self.output_dir, opt, command, boxesDir)
+        self.process = subprocess.Popen(args, cwd=densecapDir, env=env,
+                                        stdout=self.log, stderr=subprocess.STDOUT)
+
+    #None while running, otherwise whether the shard produced results
+    def poll(self):
+        status = self.process.poll()
+        if status is None:
+            return None
+        self.log.close()
+        return status == 0 and os.path.exists(self.results_file)
+
+#Runs densecap over 'paths' with a pool of worker processes
+#Returns the per-shard results.json files in shard order. Raises RuntimeError if a
+#shard still fails after 'retries' extra attempts
+def run_sharded(paths, workDir, opt=None, workers=None, shardSize=None, retries=2,
+                command=None, densecapDir=DENSECAP_DIR, boxesDir=None, pollInterval=1.0):
+    opt = DEFAULT_OPT if opt is None else opt
+    workers = workers or multiprocessing.cpu_count()
+    if shardSize:
+        shardCount = (len(paths) + shardSize - 1) // shardSize
+    else:
+        shardCount = workers
+    shards = [Shard(i, chunk, workDir) for i, chunk in enumerate(partition(list(paths), shardCount))]
+    for shard in shards:
+        stage(shard.paths, shard.input_dir)
+    threads = max(1, multiprocessing.cpu_count() // workers)
+
+    pending = list(shards)
+    running = []
+    finished = 0
+    doneImages = 0
+    started = time.time()
+    try:
+        while pending or running:
+            while pending and len(running) < workers:
+                shard = pending.pop(0)
+                shard.start(opt, command, densecapDir, threads, boxesDir)
+                running.append(shard)
+            time.sleep(pollInterval)
+            for shard in list(running):
+                ok = shard.poll()
+                if ok is None:
+                    continue
+                running.remove(shard)
+                if ok:
+                    finished += 1
+                    doneImages += len(shard.paths)
+                    elapsed = time.time() - started
+                    print("Shard %d done: %d/%d shards, %d/%d images, %.2f images/sec" % (
+                        shard.index, finished, len(shards), doneImages, len(paths),
+                        doneImages / max(elapsed, 1e-6)))
+                elif shard.attempts <= retries:
+                    print("Shard %d failed (attempt %d), retrying" % (shard.index,
+                                                                      shard.attempts))
+                    pending.append(shard)
+                else:
+                    raise RuntimeError("Shard %d failed after %d attempts, see %s" % (
+                        shard.index, shard.attempts,
+                        os.path.join(shard.directory, 'densecap.log')))
+    finally:
+        # On failure or interrupt the shards still running are killed and reaped, so no
+        # densecap process outlives the run and no log stays open
+        for shard in running:
+            if shard.process.poll() is None:
+                shard.process.kill()
+            shard.process.wait()
+        for shard in shards:
+            if shard.log is not None:
+                shard.log.close()
+    return [shard.results_file for shard in shards]
+
+#Concatenates the 'results' of several densecap outputs into one file, streaming
+#one image at a time
+def merge_results(resultFiles, outputFile, opt=None):
+    opt = DEFAULT_OPT if opt is None else opt
+    tmpFile = outputFile + '.tmp'
+    with open(tmpFile, 'w') as f:
+        f.write('{"opt": %s, "results": [' % js.dumps(opt, sort_keys=True))
+        first = True
+        for resultFile in resultFiles:
+            for entry in densecap_results.iter_images(resultFile):
+                if not first:
+                    f.write(', ')
+                first = False
+                js.dump(entry, f)
+        f.write(']}')
+    os.rename(tmpFile, outputFile)
+    return outputFile
+
+#Sharded densecap run over 'paths' merged into a single results file
+def run_densecap(paths, outputFile, workDir, opt=None, workers=None, **kwargs):
+    resultFiles = run_sharded(paths, workDir, opt, workers, **kwargs)
+    return merge_results(resultFiles, outputFile, opt)
@@ -0,0 +1,327 @@
+# Held-out caption evaluation: corpus BLEU-1..4 and CIDEr against every reference caption
+# Scores follow the MS-COCO caption evaluation code (coco-caption): BLEU uses clipped
+# n-gram counts, the closest reference length for the brevity penalty and is computed
+# over the whole corpus; CIDEr is the mean over n = 1..4 of the tf-idf cosine between the
+# candidate and each reference - candidate weights clipped at the reference's - with a
+# gaussian length penalty (sigma 6), times 10. Document frequencies come from the whole
+# dataset even when only part of it is evaluated.
+# METEOR needs the Java scorer and WordNet, so it is not computed here.
+#
+# References are the whole MS-COCO captions of the dataset's image_ids, read from the
+# caption file it was preprocessed from (see coco_index.py) - the dataset's own caption
+# rows are cut to phrase_dimension words. Datasets without image_ids or an available
+# caption file fall back to those rows.
+#
+# Everything that only depends on the references - n-gram counts, their clipping maxima,
+# document frequencies, tf-idf vectors and norms - is computed once per dataset and pickled
+# next to it (references.pkl), keyed on the caption arrays and vocabulary. An evaluation
+# then only counts the candidates' n-grams.
+#
+# Words are word IDs. References' <unk> and candidates' <unk> or unknown words get
+# distinct IDs, so they never count as matches. An n-gram is a single integer, its words
+# (shifted past those two IDs) as digits in base vocabulary size + 3 - integers hash and
+# unpickle several times faster than tuples.
+
+from __future__ import print_function
+
+import hashlib
+import json as js
+import math
+import os
+import sys
+import time
+from collections import Counter, OrderedDict
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import numpy as np
+
+import vocabulary
+
+MAX_N = 4
+CIDER_SIGMA = 6.0
+# Bump when References' contents change so cached files are rebuilt
+CACHE_VERSION = 2
+CACHE_FILE = 'references.pkl'
+REFERENCE_UNK = -1
+CANDIDATE_UNK = -2
+# Same smoothing as coco-caption's BLEU
+TINY = 1e-15
+SMALL = 1e-9
+
+# Added to word IDs in n-gram keys so that REFERENCE_UNK and CANDIDATE_UNK stay positive
+ID_OFFSET = 3
+
+#n-gram -> count for n = 1..MAX_N, as a list indexed by n - 1. base is vocabulary size
+#plus ID_OFFSET
+def ngram_counts(tokens, base):
+    grams = [token + ID_OFFSET for token in tokens]
+    counts = [Counter(grams)]
+    for n in range(1, MAX_N):
+        grams = [gram * base + tokens[i + n] + ID_OFFSET for i, gram in enumerate(grams[:-1])]
+        counts.append(Counter(grams))
+    return counts
+
+#coco-caption's "closest" reference length, the shorter one on ties
+def closest_length(lengths, length):
+    return min(lengths, key=lambda reference: (abs(reference - length), reference))
+
+#BLEU-1..MAX_N from corpus totals of clipped matches and candidate n-grams
+def corpus_bleu(matches, totals, candidateLength, referenceLength):
+    penalty = 1.0
+    if candidateLength < referenceLength:
+        penalty = math.exp(1.0 - referenceLength / float(max(candidateLength, TINY)))
+    scores = []
+    logPrecision = 0.0
+    for n in range(MAX_N):
+        logPrecision += math.log((matches[n] + TINY) / (totals[n] + SMALL))
+        scores.append(penalty * math.exp(logPrecision / (n + 1)))
+    return scores
+
+class References(object):
+
+    #references holds the reference captions of every image, each a list of word IDs
+    #below vocabSize
+    def __init__(self, references, vocabSize):
+        self.images = len(references)
+        self.base = vocabSize + ID_OFFSET
+        self.lengths = []
+        self.clip = []
+        counts = []
+        frequency = {}
+        for captions in references:
+            captionCounts = [ngram_counts(caption, self.base) for caption in captions]
+            clip = []
+            for n in range(MAX_N):
+                top = {}
+                for caption in captionCounts:
+                    for gram, count in caption[n].items():
+                        if count > top.get(gram, 0):
+                            top[gram] = count
+                clip.append(top)
+                for gram in top:
+                    frequency[gram] = frequency.get(gram, 0) + 1
+            self.lengths.append([len(caption) for caption in captions])
+            self.clip.append(clip)
+            counts.append(captionCounts)
+        # Document frequency: number of images with the n-gram in any of their references,
+        # kept as CIDEr's idf log(images) - log(document frequency)
+        self.log_images = math.log(float(max(self.images, 1)))
+        self.idf = dict((gram, self.log_images - math.log(images))
+                        for gram, images in frequency.items())
+        self.vectors = [[self.tfidf(caption) for caption in captionCounts]
+                        for captionCounts in counts]
+
+    def __len__(self):
+        return self.images
+
+    #CIDEr tf-idf vectors and their norms, one per n
+    def tfidf(self, counts):
+        vectors = []
+        norms = []
+        for n in range(MAX_N):
+            vector = dict((gram, count * self.idf.get(gram, self.log_images))
+                          for gram, count in counts[n].items())
+            vectors.append(vector)
+            norms.append(math.sqrt(sum(value * value for value in vector.values())))
+        return vectors, norms
+
+    def cider(self, image, counts, length):
+        vectors, norms = self.tfidf(counts)
+        total = 0.0
+        for (references, referenceNorms), referenceLength in zip(self.vectors[image],
+                                                                 self.lengths[image]):
+            penalty = math.exp(-(length - referenceLength) ** 2 / (2 * CIDER_SIGMA ** 2))
+            similarity = 0.0
+            for n in range(MAX_N):
+                if norms[n] and referenceNorms[n]:
+                    reference = references[n]
+                    dot = 0.0
+                    for gram, value in vectors[n].items():
+                        weight = reference.get(gram, 0.0)
+                        dot += min(value, weight) * weight
+                    similarity += dot / (norms[n] * referenceNorms[n]) * penalty
+            total += similarity / MAX_N
+        return 10.0 * total / max(len(self.lengths[image]), 1)
+
+    #Scores candidates (lists of word IDs) of the given image rows, default 0..len - 1
+    #Returns corpus Bleu_1..Bleu_4 and CIDEr in coco-caption's naming, plus the CIDEr of
+    #every candidate under 'cider_per_image'
+    def score(self, candidates, images=None):
+        images = range(len(candidates)) if images is None else images
+        matches = [0] * MAX_N
+        totals = [0] * MAX_N
+        candidateLength = 0
+        referenceLength = 0
+        cider = np.zeros(len(candidates))
+        for row, (image, candidate) in enumerate(zip(images, candidates)):
+            counts = ngram_counts(candidate, self.base)
+            clip = self.clip[image]
+            for n in range(MAX_N):
+                matches[n] += sum(min(count, clip[n].get(gram, 0))
+                                  for gram, count in counts[n].items())
+                totals[n] += max(len(candidate) - n, 0)
+            candidateLength += len(candidate)
+            referenceLength += closest_length(self.lengths[image], len(candidate))
+            cider[row] = self.cider(image, counts, len(candidate))
+        scores = OrderedDict(('Bleu_%d' % (n + 1), score) for n, score in
+                             enumerate(corpus_bleu(matches, totals, candidateLength,
+                                                   referenceLength)))
+        scores['CIDEr'] = float(cider.mean()) if len(cider) else 0.0
+        scores['cider_per_image'] = cider
+        return scores
+
+#Reference word IDs of every dataset image: the caption rows up to <STOP> or padding,
+#grouped by caption_images (one caption per image without it). Rows were truncated to
+#phrase_dimension words by preprocessing, so long references lose their ends - only for
+#datasets coco_references can't be used on
+def dataset_references(data):
+    captions = np.asarray(data.captions)
+    captionImages = data.arrays.get('caption_images')
+    if captionImages is None:
+        captionImages = np.arange(len(captions))
+    end = (captions == vocabulary.STOP_ID) | (captions >= len(data.vocab))
+    lengths = np.where(end.any(axis=1), end.argmax(axis=1), captions.shape[1])
+    captions = np.where(captions == vocabulary.UNK_ID, REFERENCE_UNK, captions)
+    references = [[] for image in range(len(data))]
+    for row, image in enumerate(captionImages):
+        references[image].append(captions[row, :lengths[row]].tolist())
+    return references
+
+#Reference word IDs from caption strings, e.g. densecap_processing.get_coco_captions values
+def caption_references(captionLists, encoder):
+    return [[encode(caption, encoder, REFERENCE_UNK) for caption in captions]
+            for captions in captionLists]
+
+#Reference word IDs of every dataset image from all MS-COCO captions of its image_ids in
+#annFile, whole and in annotation file order
+def coco_references(data, annFile):
+    import dataset
+    from coco_index import CaptionIndex
+    imgIDs = [int(imgID) for imgID in data.arrays['image_ids']]
+    index = CaptionIndex(annFile)
+    try:
+        annotations = index.captions(imgIDs)
+    finally:
+        index.close()
+    captions = dict((imgID, []) for imgID in imgIDs)
+    for annotation in annotations:
+        captions[annotation['image_id']].append(annotation['caption'])
+    missing = [imgID for imgID in imgIDs if not captions[imgID]]
+    if missing:
+        raise dataset.DatasetError("%s: %d images (e.g. %d) have no captions in %s" % (
+            data.directory, len(missing), missing[0], annFile))
+    return caption_references([captions[imgID] for imgID in imgIDs], data.encoder)
+
+#Caption file coco_references reads for a dataset: annFile, else the one in its manifest
+#None if the dataset has no image_ids or neither the file nor its index exists
+def reference_annotations(data, annFile=None):
+    annFile = annFile or data.annotations
+    if annFile is None or 'image_ids' not in data.arrays:
+        return None
+    from coco_index import CaptionIndex
+    if not (os.path.exists(annFile) or os.path.exists(CaptionIndex(annFile).index_file)):
+        return None
+    return annFile
+
+#Word IDs of a caption string, unknown words and <unk> mapped to 'unknown'
+def encode(caption, encoder, unknown=CANDIDATE_UNK):
+    ids = []
+    for word in vocabulary.tokenize(caption):
+        index = encoder.get(word)
+        ids.append(unknown if index is None or index == vocabulary.UNK_ID else index)
+    return ids
+
+#Identifies the references a dataset's cache was built from: its image_ids and caption
+#file, or its caption rows without one
+def references_key(data, annFile=None):
+    digest = hashlib.sha1()
+    digest.update(js.dumps([CACHE_VERSION, data.vocab]).encode('utf-8'))
+    if annFile is not None:
+        stat = os.stat(annFile) if os.path.exists(annFile) else None
+        digest.update(js.dumps([os.path.abspath(annFile), stat and stat.st_size,
+                                stat and int(stat.st_mtime)]).encode('utf-8'))
+        digest.update(np.ascontiguousarray(data.arrays['image_ids']).tobytes())
+        return digest.hexdigest()
+    digest.update(np.ascontiguousarray(data.captions).tobytes())
+    captionImages = data.arrays.get('caption_images')
+    if captionImages is not None:
+        digest.update(np.ascontiguousarray(captionImages).tobytes())
+    return digest.hexdigest()
+
+#References of a dataset, from its cache file when it is current
+#annFile overrides the caption file recorded in the dataset, see reference_annotations
+def load_references(data, cacheFile=None, annFile=None):
+    cacheFile = cacheFile or os.path.join(data.directory, CACHE_FILE)
+    annFile = reference_annotations(data, annFile)
+    key = references_key(data, annFile)
+    if os.path.exists(cacheFile):
+        with open(cacheFile, 'rb') as f:
+            cached = pickle.load(f)
+        if cached.get('key') == key:
+            return cached['references']
+    if annFile is None:
+        print("%s: no MS-COCO captions for its images, scoring against its caption rows "
+              "(truncated to %d words)" % (data.directory, data.captions.shape[1]),
+              file=sys.stderr)
+        references = References(dataset_references(data), len(data.vocab))
+    else:
+        references = References(coco_references(data, annFile), len(data.vocab))
+    tmpFile = cacheFile + '.tmp'
+    with open(tmpFile, 'wb') as f:
+        pickle.dump({'key': key, 'references': references}, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmpFile, cacheFile)
+    return references
+
+class Evaluator(object):
+
+    #phrases are the (images, phrase_count, phrase_dimension) inputs the references belong
+    #to. Only the first 'images' are evaluated if given
+    def __init__(self, references, phrases, encoder, images=None, batchSize=64, beamWidth=3):
+        self.references = references
+        self.phrases = phrases
+        self.encoder = encoder
+        self.images = min(images or len(references), len(references))
+        self.batch_size = batchSize
+        self.beam_width = beamWidth
+
+    #decode maps a batch of phrases to caption strings, e.g. CaptionEngine.decode
+    #Returns the scores with the time spent decoding and scoring
+    def evaluate(self, decode):
+        started = time.time()
+        captions = []
+        for start in range(0, self.images, self.batch_size):
+            captions.extend(decode(np.asarray(self.phrases[start:start + self.batch_size])))
+        decoded = time.time()
+        scores = self.references.score([encode(caption, self.encoder) for caption in captions])
+        scores.pop('cider_per_image')
+        scores['images'] = self.images
+        scores['decode_s'] = decoded - started
+        scores['score_s'] = time.time() - decoded
+        return scores
+
+    #Evaluates a training LSTMNet, see LSTMNet.train_network
+    def __call__(self, ann, session):
+        return self.evaluate(lambda phrases: ann.decode(session, phrases, self.beam_width))
+
+#Evaluator over a dataset directory, e.g. the val2014 'test' dataset
+#vocab is the word list of the model being evaluated. Phrases and references are word IDs
+#of the dataset's vocabulary, so a different one would silently give meaningless scores
+#annFile is the MS-COCO caption file of its images if not the one it was preprocessed from
+def load_evaluator(directory, images=None, batchSize=64, beamWidth=3, vocab=None,
+                   annFile=None):
+    import dataset
+    data = dataset.load_dataset(directory)
+    if vocab is not None and list(vocab) != list(data.vocab):
+        raise dataset.DatasetError("%s has a different vocabulary (%d words) than the model "
+                                   "(%d words) - preprocess it with the same --vocab" %
+                                   (directory, len(data.vocab), len(vocab)))
+    return Evaluator(load_references(data, annFile=annFile), data.phrases, data.encoder, images,
+                     batchSize, beamWidth)
+
+def format_scores(scores):
+    return ' '.join('%s %.4f' % (name, scores[name]) for name in
+                    ['Bleu_%d' % (n + 1) for n in range(MAX_N)] + ['CIDEr'])
@@ -0,0 +1,159 @@
+# Background input pipeline for LSTMNet training
+# A daemon thread walks a shuffled permutation of row indices, gathers each batch from the
+# (possibly memory-mapped) input arrays and puts it in a small bounded queue. The training
+# loop only pops finished batches, so batch assembly overlaps with session.run.
+# Every epoch's permutation is derived from (seed, epoch), so runs are reproducible and
+# can be resumed from any (epoch, step).
+#
+# With per-row sequence lengths, batches are length-bucketed: each window of
+# bucketSize shuffled rows is sorted by length and cut into batches, and the batch order
+# is shuffled again. Arrays with a time axis are trimmed to the longest row of the
+# batch, so short captions are not padded out to the maximum length.
+#
+# An array can also be reached through an index array, e.g. one phrase tensor per image
+# shared by all of that image's captions: rows are then array[index[rows]], and the
+# array itself is never repeated in memory.
+
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import numpy as np
+
+#Row order for one epoch. Only depends on the seed and the epoch number
+def epoch_permutation(size, seed, epoch, shuffle=True):
+    if not shuffle:
+        return np.arange(size)
+    return np.random.RandomState([seed, epoch]).permutation(size)
+
+#Row indices of every batch of an epoch. Incomplete trailing batches are dropped
+#Without lengths this is just the epoch permutation cut into batches
+def epoch_batches(size, batchSize, seed, epoch, shuffle=True, lengths=None, bucketSize=None):
+    order = epoch_permutation(size, seed, epoch, shuffle)
+    steps = size // batchSize
+    if lengths is None:
+        return [order[step * batchSize:(step + 1) * batchSize] for step in range(steps)]
+    # Whole batches per window, so every epoch has exactly 'steps' full batches
+    bucketSize = max(1, (bucketSize or batchSize * 50) // batchSize) * batchSize
+    batches = []
+    for start in range(0, size, bucketSize):
+        window = order[start:start + bucketSize]
+        window = window[np.argsort(lengths[window], kind='mergesort')]
+        batches.extend(window[i:i + batchSize] for i in range(0, len(window), batchSize))
+    batches = [batch for batch in batches if len(batch) == batchSize]
+    if shuffle:
+        np.random.RandomState([seed, epoch, 1]).shuffle(batches)
+    return batches
+
+class _Failure(object):
+    def __init__(self, error):
+        self.error = error
+
+class BatchPrefetcher(object):
+
+    #arrays are indexed along their first dimension in lockstep
+    #capacity is the number of finished batches buffered ahead of the consumer
+    #lengths (one per row) turns on length bucketing. timeAxes gives, per array, the axis
+    #to trim to the batch's longest row, or None to leave the array whole
+    #indexes gives, per array, an index array mapping rows to that array's rows, or None
+    #Incomplete batches are dropped, so there must be at least batchSize rows
+    def __init__(self, arrays, batchSize, seed=0, capacity=2, shuffle=True,
+                 startEpoch=0, startStep=0, lengths=None, timeAxes=None, bucketSize=None,
+                 indexes=None):
+        self.arrays = arrays
+        self.batch_size = batchSize
+        self.seed = seed or 0
+        self.shuffle = shuffle
+        self.indexes = indexes or [None] * len(arrays)
+        self.data_size = len(self.indexes[0] if self.indexes[0] is not None else arrays[0])
+        if self.data_size < batchSize:
+            # The producer would loop over empty epochs forever and next() never return
+            raise ValueError("%d rows do not fill a single batch of %d" %
+                             (self.data_size, batchSize))
+        self.lengths = None if lengths is None else np.asarray(lengths)
+        self.time_axes = timeAxes or [None] * len(arrays)
+        self.bucket_size = bucketSize
+        self.epoch = startEpoch
+        self.step = startStep
+        # Seconds the producer spent gathering the last batch returned by next()
+        self.assembly_seconds = 0.0
+        self._queue = queue.Queue(maxsize=capacity)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._produce, args=(startEpoch, startStep))
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def steps_per_epoch(self):
+        return self.data_size // self.batch_size
+
+    def batches(self, epoch):
+        return epoch_batches(self.data_size, self.batch_size, self.seed, epoch, self.shuffle,
+                             self.lengths, self.bucket_size)
+
+    def indices(self, epoch, step):
+        return self.batches(epoch)[step]
+
+    def gather(self, indices):
+        batch = []
+        longest = None
+        if self.lengths is not None:
+            longest = max(1, int(self.lengths[indices].max()))
+        for array, axis, index in zip(self.arrays, self.time_axes, self.indexes):
+            rows = array[indices if index is None else index[indices]]
+            if axis is not None and longest is not None:
+                rows = rows[(slice(None),) * axis + (slice(0, longest),)]
+            batch.append(np.ascontiguousarray(rows))
+        return batch
+
+    def _produce(self, epoch, step):
+        try:
+            while not self._stop.is_set():
+                batches = self.batches(epoch)
+                while step < len(batches) and not self._stop.is_set():
+                    started = time.time()
+                    batch = self.gather(batches[step])
+                    self._put((epoch, step, time.time() - started, batch))
+                    step += 1
+                epoch += 1
+                step = 0
+        except Exception as error:
+            self._put(_Failure(error))
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    #Blocks until the next batch is ready. Returns a list with one array per input array
+    def next(self):
+        item = self._queue.get()
+        if isinstance(item, _Failure):
+            raise item.error
+        self.epoch, self.step, self.assembly_seconds, batch = item
+        # Position of the batch after this one, for checkpointing
+        self.step += 1
+        if self.step >= self.steps_per_epoch:
+            self.epoch += 1
+            self.step = 0
+        return batch
+
+    __next__ = next
+
+    def __iter__(self):
+        return self
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
@@ -0,0 +1,284 @@
+# TensorFlow-free caption decoding
+# export_network dumps what decoding needs from a trained LSTMNet - the padded word
+# embedding, every LSTM layer's kernel and bias, weights['out'] and biases['out'] - plus the
+# vocabulary and shapes into one compressed .npz file. CaptionEngine loads that file and
+# runs the same single-step LSTM as LSTMNet.build_step_graph in NumPy, so captions can be
+# served without importing TensorFlow or building the training graph.
+#
+# Weights can be stored as int8 with one float32 scale per output channel (symmetric,
+# scale = max|w| / 127), about 4x smaller. They stay int8 in memory and are scaled after
+# each product.
+#
+# python numpy_engine.py export <dataset dir> <checkpoint dir> <engine.npz> [int8]
+#   restores the newest checkpoint, exports it and checks the engine against TensorFlow
+
+from __future__ import print_function
+
+import json as js
+import sys
+from collections import namedtuple
+
+import numpy as np
+
+from beam_search import beam_search
+
+FORMAT = 'captiongen-engine'
+VERSION = 1
+QUANTIZED_SUFFIX = '.int8'
+SCALE_SUFFIX = '.scale'
+
+# Same field layout as rnn_cell.LSTMStateTuple, so beam_search.map_state handles both
+LSTMState = namedtuple('LSTMState', ('c', 'h'))
+
+#Symmetric int8 quantization with one scale per output channel (along 'axis')
+def quantize_per_channel(weights, axis):
+    weights = np.asarray(weights, dtype=np.float32)
+    reduce = tuple(i for i in range(weights.ndim) if i != axis % weights.ndim)
+    scale = np.abs(weights).max(axis=reduce, keepdims=True) / 127.0
+    scale[scale == 0] = 1.0
+    return np.round(weights / scale).astype(np.int8), scale.astype(np.float32)
+
+#Float32 or int8 + scale weights, used through matmul and take
+class Weights(object):
+
+    def __init__(self, values, scale=None):
+        self.values = values
+        self.scale = scale
+
+    @property
+    def quantized(self):
+        return self.scale is not None
+
+    #x @ W - the per-column scale is applied to the product
+    def matmul(self, x):
+        if self.scale is None:
+            return np.dot(x, self.values)
+        return np.dot(x, self.values.astype(np.float32)) * self.scale
+
+    #Rows of W - the per-row scale is applied to the rows
+    def take(self, ids):
+        if self.scale is None:
+            return self.values[ids]
+        return self.values[ids].astype(np.float32) * self.scale[ids]
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + (0 if self.scale is None else self.scale.nbytes)
+
+def stable_softmax(logits):
+    logits = logits - logits.max(axis=1, keepdims=True)
+    exp = np.exp(logits)
+    return exp / exp.sum(axis=1, keepdims=True)
+
+def sigmoid(x):
+    return 0.5 * (np.tanh(0.5 * x) + 1.0)
+
+class CaptionEngine(object):
+
+    #meta holds the shapes, special IDs and vocabulary, arrays the named weights
+    def __init__(self, meta, arrays):
+        self.meta = meta
+        self.phrase_count = meta['phrase_count']
+        self.phrase_dimension = meta['phrase_dimension']
+        self.layer_size = meta['layer_size']
+        self.num_layers = meta['num_layers']
+        self.forget_bias = meta['forget_bias']
+        self.start_id = meta['start_id']
+        self.stop_id = meta['stop_id']
+        self.pad_id = meta['pad_id']
+        self.words = meta['vocab']
+        self.embedding = arrays['embedding']
+        self.kernels = [arrays['layer_%d/kernel' % layer] for layer in range(self.num_layers)]
+        self.biases = [arrays['layer_%d/bias' % layer].values for layer in range(self.num_layers)]
+        self.out_weights = arrays['out/weights']
+        self.out_biases = arrays['out/biases'].values
+
+    @property
+    def quantized(self):
+        return self.out_weights.quantized
+
+    @property
+    def nbytes(self):
+        return sum(weights.nbytes for weights in
+                   [self.embedding, self.out_weights] + self.kernels) + \
+            sum(bias.nbytes for bias in self.biases + [self.out_biases])
+
+    def zero_state(self, batch):
+        zeros = np.zeros((batch, self.layer_size), dtype=np.float32)
+        return tuple(LSTMState(zeros, zeros) for layer in range(self.num_layers))
+
+    #One BasicLSTMCell step: [x, h] @ kernel + bias split into gates i, j, f, o
+    def lstm_layer(self, layer, x, state):
+        gates = self.kernels[layer].matmul(np.concatenate([x, state.h], axis=1)) + \
+            self.biases[layer]
+        i, j, f, o = np.split(gates, 4, axis=1)
+        c = state.c * sigmoid(f + self.forget_bias) + sigmoid(i) * np.tanh(j)
+        h = np.tanh(c) * sigmoid(o)
+        return h, LSTMState(c, h)
+
+    #Same contract as LSTMNet.step: word t of every phrase and the previous word of every
+    #row in, (probabilities, state) out
+    def step(self, phraseWords, previousWords, state):
+        phraseWords = np.asarray(phraseWords)
+        phrases = self.embedding.take(phraseWords).reshape(len(phraseWords), -1)
+        x = np.concatenate([phrases, self.embedding.take(np.asarray(previousWords))], axis=1)
+        newState = []
+        for layer in range(self.num_layers):
+            x, layerState = self.lstm_layer(layer, x, state[layer])
+            newState.append(layerState)
+        logits = self.out_weights.matmul(x) + self.out_biases
+        return stable_softmax(logits), tuple(newState)
+
+    #word -> ID, for encoding densecap phrases
+    @property
+    def encoder(self):
+        return dict((word, index) for index, word in enumerate(self.words))
+
+    def words_for(self, ids):
+        return ' '.join(self.words[i] for i in ids)
+
+    #Greedy captions for a batch of phrases (batch, phrase_count, phrase_dimension)
+    def sample(self, phrases, maxLength=None):
+        phrases = np.asarray(phrases, dtype=np.int32)
+        batch = len(phrases)
+        maxLength = maxLength or self.phrase_dimension
+        state = self.zero_state(batch)
+        words = np.full(batch, self.start_id, dtype=np.int32)
+        finished = np.zeros(batch, dtype=bool)
+        sequences = [[] for image in range(batch)]
+        for t in range(maxLength):
+            if t < phrases.shape[2]:
+                phraseWords = phrases[:, :, t]
+            else:
+                phraseWords = np.full((batch, self.phrase_count), self.pad_id, dtype=np.int32)
+            probs, state = self.step(phraseWords, words, state)
+            words = np.argmax(probs, axis=1).astype(np.int32)
+            finished |= words == self.stop_id
+            for image in np.flatnonzero(~finished):
+                sequences[image].append(words[image])
+            if finished.all():
+                break
+        return [self.words_for(sequence) for sequence in sequences]
+
+    #Beam search captions for a batch of phrases, see beam_search.py
+    def decode(self, phrases, beamWidth=3, maxLength=None, alpha=0.6):
+        phrases = np.asarray(phrases, dtype=np.int32)
+        sequences = beam_search(self.step, self.zero_state(len(phrases) * beamWidth), phrases,
+                                self.start_id, self.stop_id, self.pad_id, beamWidth, maxLength,
+                                alpha)
+        return [self.words_for(sequence) for sequence in sequences]
+
+def load_engine(path):
+    with np.load(path) as data:
+        meta = js.loads(str(data['meta']))
+        if meta.get('format') != FORMAT or meta.get('version') != VERSION:
+            raise ValueError("%s is not a version %d %s file" % (path, VERSION, FORMAT))
+        arrays = {}
+        for name in meta['arrays']:
+            if name + QUANTIZED_SUFFIX in data.files:
+                arrays[name] = Weights(data[name + QUANTIZED_SUFFIX], data[name + SCALE_SUFFIX])
+            else:
+                arrays[name] = Weights(data[name])
+    return CaptionEngine(meta, arrays)
+
+#Writes the engine file. arrays maps names to float32 weights; with quantize the 2D ones
+#are stored as int8 - the embedding per word row, kernels and output weights per column
+def save_engine(path, meta, arrays, quantize=False):
+    meta = dict(meta, format=FORMAT, version=VERSION, arrays=sorted(arrays),
+                quantized=bool(quantize))
+    data = {'meta': np.array(js.dumps(meta))}
+    for name, values in arrays.items():
+        values = np.asarray(values, dtype=np.float32)
+        if quantize and values.ndim == 2:
+            q, scale = quantize_per_channel(values, 0 if name == 'embedding' else 1)
+            data[name + QUANTIZED_SUFFIX] = q
+            data[name + SCALE_SUFFIX] = scale
+        else:
+            data[name] = values
+    with open(path, 'wb') as f:
+        np.savez_compressed(f, **data)
+    return path
+
+#LSTM kernel and bias variables of every layer, in layer order. variables must be the
+#trainable ones - the optimizer's slots (.../Linear/Matrix/Adam) share the cell's scope
+def lstm_variables(variables, num_layers):
+    layers = []
+    for layer in range(num_layers):
+        cell = [variable for variable in variables
+                if 'RNN/' in variable.name and 'Cell%d/' % layer in variable.name]
+        kernel = [variable for variable in cell if len(variable.get_shape()) == 2]
+        bias = [variable for variable in cell if len(variable.get_shape()) == 1]
+        if len(kernel) != 1 or len(bias) != 1:
+            raise ValueError("Can't find the LSTM variables of layer %d in %s" %
+                             (layer, [variable.name for variable in cell]))
+        layers.append((kernel[0], bias[0]))
+    return layers
+
+#Dumps a trained LSTMNet for CaptionEngine
+def export_network(ann, session, path, quantize=False):
+    import tensorflow as tf
+    params = ann.parameters
+    inputs = ann.inputs
+    layers = lstm_variables(tf.trainable_variables(), params.num_layers)
+    fetches = {'embedding': ann._embedding, 'out/weights': ann._weights['out'],
+               'out/biases': ann._biases['out']}
+    for layer, (kernel, bias) in enumerate(layers):
+        fetches['layer_%d/kernel' % layer] = kernel
+        fetches['layer_%d/bias' % layer] = bias
+    arrays = session.run(fetches)
+    # The network keeps (word_dimension, layer_size), the engine multiplies by (layer_size,
+    # word_dimension)
+    arrays['out/weights'] = np.ascontiguousarray(arrays['out/weights'].T)
+    meta = {'phrase_count': inputs.phrase_count, 'phrase_dimension': inputs.phrase_dimension,
+            'layer_size': params.layer_size, 'num_layers': params.num_layers,
+            'forget_bias': 1.0, 'start_id': int(ann.start_id), 'stop_id': int(ann.stop_id),
+            'pad_id': int(inputs.pad_id),
+            'vocab': [ann.decoder[i] for i in range(inputs.word_dimension)]}
+    return save_engine(path, meta, arrays, quantize)
+
+#Largest absolute difference between the TF step graph and the engine's step
+#probabilities over 'steps' steps of the given phrases, both fed their own state
+def compare_with_network(engine, ann, session, phrases, steps=None):
+    phrases = np.asarray(phrases, dtype=np.int32)
+    steps = steps or phrases.shape[2]
+    words = np.full(len(phrases), engine.start_id, dtype=np.int32)
+    tfState = ann.zero_step_state(len(phrases))
+    state = engine.zero_state(len(phrases))
+    worst = 0.0
+    for t in range(steps):
+        expected, tfState = ann.step(session, phrases[:, :, t], words, tfState)
+        probs, state = engine.step(phrases[:, :, t], words, state)
+        worst = max(worst, float(np.abs(expected - probs).max()))
+        words = np.argmax(expected, axis=1).astype(np.int32)
+    return worst
+
+#Tolerances of compare_with_network for float32 and int8 engines
+TOLERANCE = 1e-4
+INT8_TOLERANCE = 2e-2
+
+def export_checkpoint(datasetDir, logDir, path, quantize=False, checkImages=8):
+    import tensorflow as tf
+    import dataset
+    import recurrent_network as rn
+    data = dataset.load_dataset(datasetDir)
+    ann = rn.LSTMNet(data.network_input(), data.network_parameters(),
+                     [data.decoder, data.encoder])
+    with tf.Session() as session:
+        checkpoint = tf.train.latest_checkpoint(logDir)
+        if checkpoint is None:
+            raise IOError("No checkpoint found in %s" % logDir)
+        tf.train.Saver().restore(session, checkpoint)
+        export_network(ann, session, path, quantize)
+        engine = load_engine(path)
+        worst = compare_with_network(engine, ann, session, data.phrases[:checkImages])
+    tolerance = INT8_TOLERANCE if quantize else TOLERANCE
+    print("Exported %s to %s (%.1f MB of weights), max probability difference %.2g" %
+          (checkpoint, path, engine.nbytes / 1e6, worst))
+    if worst > tolerance:
+        raise ValueError("Engine differs from TensorFlow by %.3g, more than %.1g" %
+                         (worst, tolerance))
+    return engine
+
+if __name__ == '__main__':
+    export_checkpoint(sys.argv[2], sys.argv[3], sys.argv[4],
+                      len(sys.argv) > 5 and sys.argv[5] == 'int8')
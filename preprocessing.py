@@ -0,0 +1,173 @@
+# Multi-process preprocessing of densecap phrases and COCO captions into network inputs
+# The image set is cut into chunks of chunkSize images. A process pool encodes each chunk
+# (saliency selection, tokenization, word IDs - see densecap_processing) and writes it to
+# its own shard file in shardDir. Shards are written atomically and a plan file records
+# what they were built from, so an interrupted run only encodes the chunks that are
+# missing when restarted with the same inputs. Once every shard exists they are
+# concatenated in image order.
+#
+# Workers open the densecap results themselves (memory-mapped, see densecap_results.py),
+# so only image names and caption strings are sent to them.
+
+from __future__ import print_function
+
+import hashlib
+import json as js
+import multiprocessing
+import os
+import sys
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+import densecap_processing as dp
+from densecap_results import DensecapResults
+
+PLAN = 'plan.json'
+# Bump when the shard contents change so old shards are rebuilt
+SHARD_VERSION = 4
+
+# Per-process state set up by _init_worker
+_worker = {}
+
+def _init_worker(resultsFile, encoder, phraseCount, phraseLength):
+    _worker['results'] = DensecapResults(resultsFile)
+    _worker['encoder'] = encoder
+    _worker['phrase_count'] = phraseCount
+    _worker['phrase_length'] = phraseLength
+
+def shard_path(shardDir, chunk):
+    return os.path.join(shardDir, 'shard-%05d.npz' % chunk)
+
+#Encodes one chunk and writes its shard. chunkArgs is (chunk, shardDir, imgIDs, names,
+#captions, sizes) with one caption list and (width, height) or None per image
+def encode_chunk(chunkArgs):
+    chunk, shardDir, imgIDs, names, captions, sizes = chunkArgs
+    encoder = _worker['encoder']
+    phraseCount = _worker['phrase_count']
+    phraseLength = _worker['phrase_length']
+    image_props = dict((i, _worker['results'][name]) for i, name in enumerate(names))
+    phrases = dp.extract_phrase_vectors(phraseCount, phraseLength, len(names), image_props,
+                                        encoder, sizes)
+    captionIDs, captionImages = dp.extract_caption_pairs(phraseLength, encoder,
+                                                         OrderedDict(enumerate(captions)))
+    path = shard_path(shardDir, chunk)
+    tmpFile = path + '.tmp'
+    with open(tmpFile, 'wb') as f:
+        np.savez(f, phrases=phrases, captions=captionIDs, caption_images=captionImages,
+                 image_ids=np.asarray(imgIDs, dtype=np.int64))
+    os.rename(tmpFile, path)
+    return chunk, len(names)
+
+#Identifies everything the shards depend on. Shards built under another key are stale
+def plan_key(names, captions, sizes, resultsFile, encoder, phraseCount, phraseLength,
+             chunkSize):
+    digest = hashlib.sha1()
+    stat = os.stat(resultsFile)
+    digest.update(js.dumps([SHARD_VERSION, phraseCount, phraseLength, chunkSize, stat.st_size,
+                            int(stat.st_mtime), sorted(encoder.items())]).encode('utf-8'))
+    for name, imageCaptions, size in zip(names, captions, sizes):
+        digest.update(js.dumps([name, imageCaptions, size]).encode('utf-8'))
+    return digest.hexdigest()
+
+#Chunks that still have to be encoded. Stale shards from a different plan are removed
+def pending_chunks(shardDir, key, chunks):
+    planFile = os.path.join(shardDir, PLAN)
+    plan = None
+    if os.path.exists(planFile):
+        with open(planFile, 'r') as f:
+            plan = js.load(f)
+    if plan is None or plan.get('key') != key:
+        for name in os.listdir(shardDir):
+            if name.startswith('shard-'):
+                os.remove(os.path.join(shardDir, name))
+        with open(planFile, 'w') as f:
+            js.dump({'key': key, 'chunks': chunks}, f)
+    return [chunk for chunk in range(chunks) if not os.path.exists(shard_path(shardDir, chunk))]
+
+class Progress(object):
+
+    def __init__(self, totalImages, doneImages=0, stream=sys.stderr):
+        self.total = totalImages
+        self.done = doneImages
+        self.resumed = doneImages
+        self.started = time.time()
+        self.stream = stream
+
+    def update(self, images):
+        self.done += images
+        elapsed = time.time() - self.started
+        rate = (self.done - self.resumed) / elapsed if elapsed > 0 else 0.0
+        eta = (self.total - self.done) / rate if rate > 0 else float('nan')
+        print("Preprocessed %d/%d images (%.0f images/s, %.0fs left)" %
+              (self.done, self.total, rate, eta), file=self.stream)
+
+#Concatenates the shards in chunk order into (phrases, captions, caption_images, image_ids)
+#caption_images are shifted from rows of their shard to rows of the merged phrases
+def merge_shards(shardDir, chunks):
+    parts = []
+    images = 0
+    for chunk in range(chunks):
+        with np.load(shard_path(shardDir, chunk)) as shard:
+            parts.append((shard['phrases'], shard['captions'],
+                          shard['caption_images'] + images, shard['image_ids']))
+        images += len(parts[-1][0])
+    return tuple(np.concatenate([part[i] for part in parts]) for i in range(4))
+
+#imgIDs and names line up with the densecap entries in resultsFile, captions holds the
+#caption list of every image (e.g. densecap_processing.get_coco_captions values) and sizes
+#their (width, height) in box coordinates, see densecap_processing.densecap_image_sizes.
+#Entries without a 'dim' or size are scored against the extent of their boxes
+#Returns int32 (images, phraseCount, phraseLength) phrase IDs, int32 (captions, phraseLength)
+#caption IDs with the int32 phrases row of every caption, and the image ID of every
+#phrases row. Every caption of an image is kept, its phrases are stored once
+def preprocess(imgIDs, names, captions, resultsFile, encoder, phraseCount, phraseLength,
+               shardDir, chunkSize=1000, workers=None, sizes=None):
+    imgIDs = list(imgIDs)
+    names = list(names)
+    captions = [list(imageCaptions) for imageCaptions in captions]
+    sizes = [None] * len(names) if sizes is None else \
+        [None if size is None else [int(size[0]), int(size[1])] for size in sizes]
+    if not len(imgIDs) == len(names) == len(captions) == len(sizes):
+        raise ValueError("%d image IDs, %d names, %d caption lists and %d sizes" %
+                         (len(imgIDs), len(names), len(captions), len(sizes)))
+    if not names:
+        raise ValueError("No images to preprocess")
+    if not os.path.isdir(shardDir):
+        os.makedirs(shardDir)
+    # Build the results index once here rather than in every worker
+    with DensecapResults(resultsFile) as results:
+        results.offsets
+    chunks = (len(names) + chunkSize - 1) // chunkSize
+    key = plan_key(names, captions, sizes, resultsFile, encoder, phraseCount, phraseLength,
+                   chunkSize)
+    pending = pending_chunks(shardDir, key, chunks)
+    tasks = [(chunk, shardDir, imgIDs[chunk * chunkSize:(chunk + 1) * chunkSize],
+              names[chunk * chunkSize:(chunk + 1) * chunkSize],
+              captions[chunk * chunkSize:(chunk + 1) * chunkSize],
+              sizes[chunk * chunkSize:(chunk + 1) * chunkSize]) for chunk in pending]
+    progress = Progress(len(names), len(names) - sum(len(task[3]) for task in tasks))
+    if len(pending) < chunks:
+        print("Resuming: %d of %d shards already in %s" % (chunks - len(pending), chunks,
+                                                          shardDir), file=sys.stderr)
+    initArgs = (resultsFile, encoder, phraseCount, phraseLength)
+    workers = workers or multiprocessing.cpu_count()
+    if workers == 1 or len(tasks) <= 1:
+        _init_worker(*initArgs)
+        for task in tasks:
+            chunk, images = encode_chunk(task)
+            progress.update(images)
+        _worker['results'].close()
+    elif tasks:
+        pool = multiprocessing.Pool(min(workers, len(tasks)), _init_worker, initArgs)
+        try:
+            for chunk, images in pool.imap_unordered(encode_chunk, tasks):
+                progress.update(images)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    return merge_shards(shardDir, chunks)
@@ -5,18 +5,37 @@ gotta be bad to get good
 from __future__ import print_function
 
 import densecap_processing as dp
+from input_pipeline import BatchPrefetcher
+from beam_search import beam_search
+from checkpointing import AsyncCheckpointer
+import evaluation
 import tensorflow as tf
-from tensorflow.python.ops import rnn, rnn_cell
+from tensorflow.python.ops import rnn_cell
+from tensorflow.python.client import timeline
 import numpy as np
 
 import code
+import csv
+import json as js
+import os
+import sys
+import time
+import matplotlib
+# No display (training boxes, ssh) - plots are only written to files
+if not os.environ.get('DISPLAY') and sys.platform != 'darwin':
+    matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 
+try:
+    import resource
+except ImportError:
+    resource = None
+
 # To make input, we need to create a tensor
 # Our tensor will include:
 # -Vector for each phrase in an image
 # -Higher dimensional representation of number of words in each sequence
-# -Vector representation of each word
+# -Integer ID of each word - the network embeds the IDs itself
 
 class NetworkInput(object):
 
@@ -34,36 +53,225 @@ class NetworkInput(object):
     def captions(self, value):
         self.inputs[1] = value
 
-    def __init__(self, batchSize, phraseCount, phraseDim, wordDim, inputs, numEpochs, displayStep):
+    #seed fixes the shuffle order of every epoch, see input_pipeline.py
+    #lengths holds the length (including <STOP>) of every caption, computed from the
+    #captions if not given. Batches are bucketed by it and the LSTM stops at each length
+    #captionImages gives the phrases row of every caption, so an image with several
+    #captions keeps a single copy of its phrases. Without it caption i belongs to image i
+    #Training examples are (image, caption) pairs - one per caption
+    def __init__(self, batchSize, phraseCount, phraseDim, wordDim, inputs, numEpochs, displayStep,
+                 seed=0, lengths=None, captionImages=None):
         self.phrase_count = phraseCount
         self.phrase_dimension = phraseDim
         self.word_dimension = wordDim
-        self.inputs = [np.asarray(inputs[0], dtype=np.float32), 
-                       np.asarray(inputs[1], dtype=np.float32)] 
+        self.inputs = [np.asarray(inputs[0], dtype=np.int32), 
+                       np.asarray(inputs[1], dtype=np.int32)] 
         self.batch_size = batchSize
         self.num_epochs = numEpochs
         self.display_step = displayStep
+        self.seed = seed
+        if lengths is None:
+            lengths = dp.sequence_lengths(self.inputs[1], self.pad_id)
+        self.lengths = np.asarray(lengths, dtype=np.int32)
+        if captionImages is None:
+            if len(self.captions) != len(self.phrases):
+                raise ValueError("%d captions for %d images need captionImages" % 
+                                 (len(self.captions), len(self.phrases)))
+            captionImages = np.arange(len(self.captions))
+        self.caption_images = np.asarray(captionImages, dtype=np.int32)
+        if len(self.caption_images) != len(self.captions):
+            raise ValueError("%d caption image indices for %d captions" % 
+                             (len(self.caption_images), len(self.captions)))
+
+    #Number of (image, caption) training pairs
+    @property
+    def caption_count(self):
+        return len(self.captions)
 
+    #ID used for empty word slots, see densecap_processing.pad_id
+    @property
+    def pad_id(self):
+        return self.word_dimension
+
+#loss picks the training loss of the output projection:
+# 'softmax' - full softmax cross entropy, cost grows linearly with the vocabulary
+# 'sampled' - sampled softmax over numSampled negative words per step
+# 'nce'     - noise contrastive estimation with numSampled noise words
+#The full softmax is always used for evaluation (cost) and generation
+#towers splits every batch between that many copies of the network run in parallel,
+#see LSTMNet. The batch size must be a multiple of it
 class NetworkParameters(object):
-    def __init__(self, layerSize, numLayers, learningRate):
+    LOSSES = ('softmax', 'sampled', 'nce')
+
+    def __init__(self, layerSize, numLayers, learningRate, initScale=0.1, embeddingSize=None,
+                 loss='softmax', numSampled=64, towers=1):
+        if loss not in self.LOSSES:
+            raise ValueError("loss must be one of %s, got %r" % (self.LOSSES, loss))
         self.layer_size = layerSize
         self.num_layers = numLayers
         self.learning_rate = learningRate
+        self.init_scale = initScale
+        self.embedding_size = embeddingSize or layerSize
+        self.loss = loss
+        self.num_sampled = numSampled
+        self.towers = towers
         self.data_type = tf.float32
 
+#Averages the (gradient, variable) lists of every tower, variable by variable
+#Sparse gradients (embedding lookups) are averaged by concatenating their slices
+def average_gradients(towerGrads):
+    if len(towerGrads) == 1:
+        return towerGrads[0]
+    averaged = []
+    for gradsAndVars in zip(*towerGrads):
+        variable = gradsAndVars[0][1]
+        grads = [grad for grad, unused in gradsAndVars if grad is not None]
+        if not grads:
+            averaged.append((None, variable))
+        elif isinstance(grads[0], tf.IndexedSlices):
+            averaged.append((tf.IndexedSlices(
+                tf.concat(0, [grad.values for grad in grads]) / len(grads),
+                tf.concat(0, [grad.indices for grad in grads]), grads[0].dense_shape), variable))
+        else:
+            averaged.append((tf.add_n(grads) / len(grads), variable))
+    return averaged
+
+#Peak resident set size of this process in MB, None where it can't be read
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on OS X
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+#Training metrics
+#costHistory keeps the summed cost every display_step epochs. Every training step is also
+#recorded with its wall time split into
+#  batch_wait_s - time the training loop blocked on the input pipeline
+#  assembly_s   - time the pipeline thread spent gathering that batch (overlaps training)
+#  run_s        - session.run, including copying the fed batch into tensors (the pipeline
+#                 hands over contiguous int32 arrays, the copy is not separately visible)
+#along with examples/sec and peak RSS. Steps are appended to logFile as they happen,
+#JSON lines or CSV depending on its extension.
+#Every traceEvery steps (0 = never) a full TensorFlow trace of the step is written to
+#traceDir in Chrome trace format (open in chrome://tracing)
+#Held-out scores (see evaluation.py) are kept in evaluations and appended to evalFile
 class NetworkResults(object):
-    def __init__(self):
+    FIELDS = ['epoch', 'step', 'global_step', 'examples', 'cost', 'batch_wait_s', 
+              'assembly_s', 'run_s', 'step_s', 'examples_per_sec', 'peak_rss_mb']
+
+    def __init__(self, logFile=None, traceEvery=0, traceDir=None, evalFile=None):
         self.costHistory = {}
+        self.steps = []
+        self.evaluations = []
+        self.eval_file = evalFile
+        self.log_file = logFile
+        self.trace_every = traceEvery
+        self.trace_dir = traceDir
+        self._log = None
+        self._writer = None
 
     def record_point(self, key, val):
         self.costHistory[key] = val
-        
-    def plot_results(self):
-        plt.plot(self.costHistory.keys(), self.costHistory.values())
-        plt.xticks(range(len(self.costHistory)), sorted(self.costHistory.keys()))
-        plt.xlabel('epochs')
-        plt.ylabel('cost')
-        plt.show()
+
+    def record_step(self, epoch, step, globalStep, examples, cost, batchWait, assembly, run):
+        seconds = batchWait + run
+        record = {'epoch': epoch, 'step': step, 'global_step': globalStep, 
+                  'examples': examples, 'cost': float(cost), 'batch_wait_s': batchWait,
+                  'assembly_s': assembly, 'run_s': run, 'step_s': seconds, 
+                  'examples_per_sec': examples / seconds if seconds > 0 else None, 
+                  'peak_rss_mb': peak_rss_mb()}
+        self.steps.append(record)
+        if self.log_file is not None:
+            self._write(record)
+        return record
+
+    def record_evaluation(self, epoch, globalStep, scores):
+        record = dict(scores, epoch=epoch, global_step=globalStep)
+        self.evaluations.append(record)
+        if self.eval_file is not None:
+            with open(self.eval_file, 'a') as f:
+                f.write(js.dumps(record, sort_keys=True) + '\n')
+        return record
+
+    def _write(self, record):
+        if self._log is None:
+            directory = os.path.dirname(self.log_file)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            self._log = open(self.log_file, 'a')
+            if self.log_file.endswith('.csv'):
+                self._writer = csv.DictWriter(self._log, self.FIELDS)
+                if self._log.tell() == 0:
+                    self._writer.writeheader()
+        if self._writer is not None:
+            self._writer.writerow(record)
+        else:
+            self._log.write(js.dumps(record, sort_keys=True) + '\n')
+        self._log.flush()
+
+    #(options, run_metadata) for session.run - a full trace on every trace_every'th step
+    def trace_options(self, step):
+        if not self.trace_every or step % self.trace_every != 0:
+            return None, None
+        return tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), tf.RunMetadata()
+
+    def write_trace(self, runMetadata, step):
+        if not os.path.isdir(self.trace_dir):
+            os.makedirs(self.trace_dir)
+        path = os.path.join(self.trace_dir, 'step_%d.json' % step)
+        with open(path, 'w') as f:
+            f.write(timeline.Timeline(runMetadata.step_stats).generate_chrome_trace_format())
+        return path
+
+    #Mean seconds per step of each part and overall examples/sec
+    def summary(self):
+        if not self.steps:
+            return {}
+        summary = dict((field, float(np.mean([record[field] for record in self.steps])))
+                       for field in ('batch_wait_s', 'assembly_s', 'run_s', 'step_s'))
+        summary['steps'] = len(self.steps)
+        summary['examples_per_sec'] = (sum(record['examples'] for record in self.steps) /
+                                       sum(record['step_s'] for record in self.steps))
+        summary['peak_rss_mb'] = peak_rss_mb()
+        return summary
+
+    def close(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+            self._writer = None
+
+    #Cost per epoch and, once steps are recorded, time per step and throughput
+    #Written to path if given; show opens a window as before
+    def plot_results(self, path=None, show=False):
+        rows = 2 if self.steps else 1
+        figure = plt.figure(figsize=(8, 4 * rows))
+        axes = figure.add_subplot(rows, 1, 1)
+        epochs = sorted(self.costHistory.keys())
+        axes.plot(epochs, [self.costHistory[epoch] for epoch in epochs])
+        axes.set_xlabel('epochs')
+        axes.set_ylabel('cost')
+        if self.steps:
+            axes = figure.add_subplot(rows, 1, 2)
+            steps = range(len(self.steps))
+            bottom = np.zeros(len(self.steps))
+            for field in ('batch_wait_s', 'run_s'):
+                values = np.array([record[field] for record in self.steps])
+                axes.fill_between(steps, bottom, bottom + values, label=field)
+                bottom += values
+            axes.set_xlabel('steps')
+            axes.set_ylabel('seconds')
+            axes.legend(loc='upper left')
+            throughput = axes.twinx()
+            throughput.plot(steps, [record['examples_per_sec'] for record in self.steps], 'k')
+            throughput.set_ylabel('examples/sec')
+        figure.tight_layout()
+        if path is not None:
+            figure.savefig(path)
+        if show:
+            plt.show()
+        plt.close(figure)
         
 
 class LSTMNet(object):
@@ -104,10 +312,20 @@ class LSTMNet(object):
     def _y(self):
         return self.placeholder_y
 
+    @property
+    def _lengths(self):
+        return self.placeholder_lengths
+
+    #Full softmax cross entropy - used for evaluation whatever the training loss
     @property
     def cost(self):
         return self._cost
 
+    #Loss minimized by the optimizer, see NetworkParameters.loss
+    @property
+    def train_cost(self):
+        return self._train_cost
+
     @property
     def final_state(self):
         return self._final_state
@@ -120,6 +338,23 @@ class LSTMNet(object):
     def optimizer(self):
         return self._optimizer
 
+    #Single step inference graph, see build_step_graph
+    @property
+    def step_state(self):
+        return self._step_state
+
+    @property
+    def step_probabilities(self):
+        return self._step_probs
+
+    @property
+    def start_id(self):
+        return self.encoder[dp.START]
+
+    @property
+    def stop_id(self):
+        return self.encoder[dp.STOP]
+
     @property
     def train_op(self):
         return self._train
@@ -134,11 +369,11 @@ class LSTMNet(object):
 
     @property
     def data_size(self):
-        return len(self.inputs.phrases)
+        return self.inputs.caption_count
 
     @property 
     def training_iterations(self):
-        return self.data_size / self.inputs.batch_size
+        return self.data_size // self.inputs.batch_size
 
     def __init__(self, inputs, params, codex):
         with tf.variable_scope("Model", reuse=None):
@@ -146,13 +381,22 @@ class LSTMNet(object):
 
             self._input = inputs
             self._parameters = params
-            self._results = NetworkResults()
+            self._results = NetworkResults(os.path.join(self.log_path, 'metrics.jsonl'),
+                                           traceDir=os.path.join(self.log_path, 'traces'),
+                                           evalFile=os.path.join(self.log_path,
+                                                                 'evaluation.jsonl'))
 
             self._decoder = codex[0]
             self._encoder = codex[1]
 
+            # Position of the next batch: epoch and step within it. Saved with every
+            # checkpoint so a resumed run continues with the same batch sequence
             self.epochs = 0
-            self.epoch_iteration = 0
+            self.epoch_step = 0
+            self.pipeline = None
+            self.checkpointer = None
+            self.evaluator = None
+            self.evaluate_steps = None
 
 
 
@@ -160,103 +404,302 @@ class LSTMNet(object):
 
             # tf Graph input - placeholders must be fed training data on execution
             # 'None' as a dimension allows that dimension to be any length
-            self.placeholder_x = tf.placeholder(params.data_type, 
-            [inputs.phrase_count, inputs.phrase_dimension, inputs.word_dimension])
-            #self.placeholder_x = tf.placeholder(params.data_type, 
-            #[inputs.batch_size, inputs.phrase_count, inputs.phrase_dimension, inputs.word_dimension])
-
-            self.placeholder_y = tf.placeholder(params.data_type, 
-                                [inputs.phrase_dimension, inputs.word_dimension])
-            #self.placeholder_y = tf.placeholder(params.data_type, 
-            #[inputs.batch_size, inputs.phrase_dimension, inputs.word_dimension])
-
-            #x = tf.reshape(self._x, [ inputs.batch_size*inputs.phrase_dimension, -1])
-            #x = tf.split(0, inputs.batch_size, x) 
-            x = tf.reshape(self._x, [-1, inputs.word_dimension])
-            x = tf.split(0, inputs.phrase_dimension, x) 
-
-            with tf.variable_scope("RNN"):
-                lstm_cell = rnn_cell.BasicLSTMCell(
-                    params.layer_size, forget_bias=1.0, state_is_tuple=True)
-                layer_cell = rnn_cell.MultiRNNCell(
-                    [lstm_cell] * params.num_layers, state_is_tuple=True)
-
-                # Save a snapshot of the initial state for generating sequences later
-                self._initial_state = layer_cell.zero_state(
-                    inputs.phrase_dimension, params.data_type)
-
-                outputs, state = rnn.rnn(
-                    layer_cell, x, initial_state = self._initial_state, dtype=params.data_type)
-
-                #Used as recurrent input to LSTM layers during sequence generation
-                #Represents (c, h) values for params.num_layer of stacked LSTM cells
-                # value of outputs[-1] - therefore directly used to compute probabilities
-                self._final_state = state
+            # Inputs are word IDs, see densecap_processing.extract_phrase_vectors
+            # The leading dimension is the batch - any number of images per step
+            # The word dimension is the longest caption of the batch, up to phrase_dimension
+            self.placeholder_x = tf.placeholder(tf.int32, [None, inputs.phrase_count, None])
+
+            self.placeholder_y = tf.placeholder(tf.int32, [None, None])
+            # Caption length of every image, the LSTM does no work past it
+            self.placeholder_lengths = tf.placeholder(tf.int32, [None])
+            batch_size = tf.shape(self._x)[0]
+            if inputs.batch_size % params.towers:
+                raise ValueError("batch size %d does not split into %d towers" % 
+                                 (inputs.batch_size, params.towers))
+
+            # Word embeddings replace the one-hot input vectors. The extra all-zero row is
+            # looked up by inputs.pad_id, so padding still contributes nothing to the LSTM
+            embedding = tf.Variable(tf.random_uniform(
+                [inputs.word_dimension, params.embedding_size], 
+                -params.init_scale, params.init_scale, dtype=params.data_type))
+            padded_embedding = tf.concat(0, [embedding, 
+                tf.zeros([1, params.embedding_size], dtype=params.data_type)])
+            self._embedding = padded_embedding
 
             # Define weights according to dimensionality of hidden layers
             # Randomly initializing weights and biases ensures feature differentiation
+            # The output projection is stored (word_dimension, layer_size), the layout the
+            # sampled losses take, and multiplied with transpose_b - no per-step transpose
             weights = {
-                'out': tf.Variable(tf.random_normal([params.layer_size, inputs.word_dimension]))}
+                'out': tf.Variable(tf.random_normal([inputs.word_dimension, params.layer_size]))}
             biases = {'out': tf.Variable(tf.random_normal([inputs.word_dimension]))}
+            self._weights = weights
+            self._biases = biases
+
+            lstm_cell = rnn_cell.BasicLSTMCell(
+                params.layer_size, forget_bias=1.0, state_is_tuple=True)
+            layer_cell = rnn_cell.MultiRNNCell(
+                [lstm_cell] * params.num_layers, state_is_tuple=True)
+            self._cell = layer_cell
 
-            #outputs [-1] represents the final cell in the LSTM block, given as batch_size
-            #of tensors for handling output
-            #Output in LSTM is a function of the cell state (c) and the hidden state (h)
-            #See LSTMStateTuple output of rnn_cell.BasicLSTMCell (state)
-
-            #This represents the model we apply to the LSTM cell layer
-            #This reconciles the dimensionality of hidden features (layer_size) and LSTM states
-            #with dimensionality of our sequence (phrase_dim, word_dim)
-            #Returns sequence predictions - These values are used for classification
-            self._model =  tf.matmul(outputs[-1], weights['out']) + biases['out']
-
-            #self.probabilities is the final layer of the network
-            #squash all predictions into range 0->1 for sane inference 
-            self._probs = tf.nn.softmax(self._model)
-            #code.interact(local=dict(globals(), **locals()))
-            #self._cost will become a custom machine translation heuristic and other things yo
-            self._cost = tf.reduce_mean(
-                tf.nn.softmax_cross_entropy_with_logits(self._model, self._y))
-            #logits = tf.split(0, inputs.batch_size, tf.reshape(
-            #                self._x, [inputs.batch_size, -1]))
-            #targets = [self._y] * inputs.batch_size
-            #weights = [tf.ones(self.inputs.batch_size * inputs.word_dimension, 
-            #     dtype=params.data_type)] * inputs.batch_size
-
-            #self._cost = tf.reduce_mean(tf.nn.seq2seq.sequence_loss(logits,targets,weights))
+            # Save a snapshot of the initial state for generating sequences later
+            self._initial_state = layer_cell.zero_state(batch_size, params.data_type)
 
             #I don't know what this does. Some variant of backpropagation
             #self._optimizer = tf.train.AdamOptimizer(
             #    learning_rate=params.learning_rate).minimize(self._cost)
             self.globalStep = tf.Variable(0, name='global_step', trainable=False)
-            self._optimizer = tf.train.AdamOptimizer(
-                learning_rate=params.learning_rate).minimize(self._cost, global_step=self.globalStep)
-
-    def train_network(self):
+            optimizer = tf.train.AdamOptimizer(learning_rate=params.learning_rate)
+
+            # Data parallel training: the batch is split evenly between params.towers
+            # copies of the network that share every variable. Their gradients are
+            # averaged and applied in a single Adam update, so one step is still one
+            # global step no matter how many towers computed it
+            if params.towers > 1:
+                splits = zip(tf.split(0, params.towers, self._x), 
+                             tf.split(0, params.towers, self._y),
+                             tf.split(0, params.towers, self._lengths))
+            else:
+                splits = [(self._x, self._y, self._lengths)]
+            towers = []
+            towerGrads = []
+            for tower, (phrases, captions, lengths) in enumerate(splits):
+                with tf.name_scope('tower_%d' % tower):
+                    towers.append(self.build_tower(phrases, captions, lengths, reuse=tower > 0))
+                    towerGrads.append(optimizer.compute_gradients(towers[-1]['train_cost']))
+
+            #Rows of every tower, in batch order
+            self._model = tf.concat(0, [tower['logits'] for tower in towers])
+            self._probs = tf.concat(0, [tower['probabilities'] for tower in towers])
+            self._mask = tf.concat(0, [tower['mask'] for tower in towers])
+            self._final_state = tuple(
+                rnn_cell.LSTMStateTuple(tf.concat(0, [tower['state'][layer].c for tower in towers]),
+                                        tf.concat(0, [tower['state'][layer].h for tower in towers]))
+                for layer in range(params.num_layers))
+            self._cost = tf.add_n([tower['cost'] for tower in towers]) / len(towers)
+            self._train_cost = tf.add_n([tower['train_cost'] for tower in towers]) / len(towers)
+
+            self._optimizer = optimizer.apply_gradients(average_gradients(towerGrads), 
+                                                        global_step=self.globalStep)
+            #Global step after this run's update, fetched with the optimizer
+            with tf.control_dependencies([self._optimizer]):
+                self._trained_step = tf.identity(self.globalStep)
+
+            self.build_step_graph()
+
+    #Forward pass and costs for one batch of (phrases, captions, lengths)
+    #Every tower shares the embedding, output weights and LSTM variables - reuse is set for
+    #all but the first so the LSTM variables are created once under Model/RNN
+    def build_tower(self, phrases, captions, lengths, reuse=False):
+        inputs = self.inputs
+        params = self.parameters
+        batch_size = tf.shape(phrases)[0]
+        steps = tf.shape(captions)[1]
+        x = tf.nn.embedding_lookup(self._embedding, phrases)
+
+        # One-hot targets are built in the graph. tf.one_hot gives pad_id (== depth)
+        # an all-zero row, so padded caption words carry no loss
+        # Rows are ordered image by image: (batch * steps, word_dimension)
+        y = tf.one_hot(tf.reshape(captions, [-1]), inputs.word_dimension, 
+                       dtype=params.data_type)
+
+        # The LSTM steps over word positions. At step t every image in the batch sees
+        # word t of each of its phrases, concatenated:
+        # (batch, phrase_count, steps, embedding) -> 
+        # (batch, steps, phrase_count * embedding)
+        x = tf.transpose(x, [0, 2, 1, 3])
+        x = tf.reshape(x, tf.pack([batch_size, steps, 
+                                   inputs.phrase_count * params.embedding_size]))
+
+        # ...along with the previous caption word (<START> at step 0), so that captions
+        # can be generated one word at a time by feeding back the last prediction
+        start = tf.fill(tf.pack([batch_size, 1]), self.start_id)
+        previous = tf.concat(1, [start, tf.slice(captions, [0, 0], tf.pack([-1, steps - 1]))])
+        previous = tf.nn.embedding_lookup(self._embedding, previous)
+        x = tf.concat(2, [x, previous])
+
+        # Variables live in the "RNN" scope so the single step graph can call the
+        # same cell and share its weights, see build_step_graph
+        # Past an image's length the outputs are zero and its state is carried through
+        with tf.variable_scope("RNN", reuse=reuse or None) as scope:
+            outputs, state = tf.nn.dynamic_rnn(
+                self._cell, x, sequence_length=lengths, 
+                initial_state=self._cell.zero_state(batch_size, params.data_type), scope=scope)
+
+        # Positions that carry a caption word: inside the caption length and not padding
+        mask = tf.reshape(tf.logical_and(
+            tf.less(tf.expand_dims(tf.range(steps), 0), tf.expand_dims(lengths, 1)),
+            tf.not_equal(captions, inputs.pad_id)), [-1])
+
+        #outputs is (batch, steps, layer_size)
+        #Output in LSTM is a function of the cell state (c) and the hidden state (h)
+        #See LSTMStateTuple output of rnn_cell.BasicLSTMCell (state)
+        #Flatten to image by image rows so they line up with y
+        output = tf.reshape(outputs, [-1, params.layer_size])
+
+        #This represents the model we apply to the LSTM cell layer
+        #This reconciles the dimensionality of hidden features (layer_size) and LSTM states
+        #with dimensionality of our sequence (phrase_dim, word_dim)
+        #Returns sequence predictions - These values are used for classification
+        logits = tf.matmul(output, self._weights['out'], transpose_b=True) + self._biases['out']
+
+        #Mean over real caption words only - padding past each length is masked out
+        weight = tf.cast(mask, params.data_type)
+        cost = tf.reduce_sum(tf.nn.softmax_cross_entropy_with_logits(logits, y) * weight) / \
+            tf.maximum(tf.reduce_sum(weight), 1.0)
+
+        #squash all predictions into range 0->1 for sane inference 
+        #Shaped (batch, steps, word_dimension)
+        probabilities = tf.reshape(tf.nn.softmax(logits), 
+                                   tf.pack([-1, steps, inputs.word_dimension]))
+        return {'logits': logits, 'probabilities': probabilities, 'mask': mask, 
+                'state': state, 'cost': cost, 
+                'train_cost': self.build_train_cost(output, captions, mask, cost)}
+
+    #Sampled losses only score the target word and a few sampled words per position,
+    #so a training step no longer computes logits for the whole vocabulary
+    #Masked positions have no target word and are left out
+    def build_train_cost(self, output, captions, mask, cost):
+        if self.parameters.loss == 'softmax':
+            return cost
+        weights = self._weights
+        biases = self._biases
+        targets = tf.reshape(captions, [-1])
+        real = mask
+        labels = tf.reshape(tf.cast(tf.boolean_mask(targets, real), tf.int64), [-1, 1])
+        hidden = tf.boolean_mask(output, real)
+        if self.parameters.loss == 'sampled':
+            loss_fn = tf.nn.sampled_softmax_loss
+        else:
+            loss_fn = tf.nn.nce_loss
+        losses = loss_fn(weights=weights['out'], biases=biases['out'], 
+                         inputs=hidden, labels=labels, 
+                         num_sampled=self.parameters.num_sampled,
+                         num_classes=self.inputs.word_dimension)
+        return tf.reduce_mean(losses)
+
+    #Inference graph that advances the trained LSTM by exactly one word
+    #Feeds: step_phrases (batch, phrase_count) - word t of every phrase
+    #       step_words (batch,) - the previously generated word
+    #       step_state_in - LSTM state after the previous step
+    #Fetches: step_probabilities (batch, word_dimension) and step_state
+    def build_step_graph(self):
+        inputs = self.inputs
+        params = self.parameters
+        self.step_phrases = tf.placeholder(tf.int32, [None, inputs.phrase_count])
+        self.step_words = tf.placeholder(tf.int32, [None])
+        self.step_state_in = tuple(
+            rnn_cell.LSTMStateTuple(tf.placeholder(params.data_type, [None, params.layer_size]),
+                                    tf.placeholder(params.data_type, [None, params.layer_size]))
+            for layer in range(params.num_layers))
+
+        phrases = tf.reshape(tf.nn.embedding_lookup(self._embedding, self.step_phrases), 
+                             [-1, inputs.phrase_count * params.embedding_size])
+        words = tf.nn.embedding_lookup(self._embedding, self.step_words)
+        with tf.variable_scope("RNN", reuse=True):
+            output, self._step_state = self._cell(tf.concat(1, [phrases, words]), 
+                                                  self.step_state_in)
+        logits = tf.matmul(output, self._weights['out'], transpose_b=True) + self._biases['out']
+        self._step_probs = tf.nn.softmax(logits)
+
+    def zero_step_state(self, batch):
+        zeros = np.zeros((batch, self.parameters.layer_size), dtype=np.float32)
+        return tuple(rnn_cell.LSTMStateTuple(zeros, zeros) 
+                     for layer in range(self.parameters.num_layers))
+
+    #Runs one step of the inference graph, returns (probabilities, state)
+    def step(self, session, phraseWords, previousWords, state):
+        feed = {self.step_phrases: phraseWords, self.step_words: previousWords}
+        for placeholder, value in zip(self.step_state_in, state):
+            feed[placeholder.c] = value.c
+            feed[placeholder.h] = value.h
+        return session.run([self.step_probabilities, self.step_state], feed)
+
+    #Checkpoints go to log_path every saveSteps steps or saveSecs seconds without blocking
+    #training, keeping the newest keepCheckpoints - see checkpointing.py
+    #With resume, training continues from the newest checkpoint at the exact batch it stopped
+    #evaluator (e.g. evaluation.Evaluator on the val dataset) is run every evaluateSteps
+    #steps and its scores recorded in results
+    def train_network(self, saveSteps=None, saveSecs=600, keepCheckpoints=5, resume=True,
+                      evaluator=None, evaluateSteps=None):
         init = tf.initialize_all_variables()
-        #Supervisor does nice things, like start queues
-        saves = tf.train.Saver(write_version=tf.train.SaverDef.V2)
-        sv = tf.train.Supervisor(logdir=self.log_path, saver=saves, 
-                                 global_step=self.global_step, save_model_secs=1)      
-        with sv.managed_session() as session:
+        self.evaluator = evaluator
+        self.evaluate_steps = evaluateSteps
+        self.checkpointer = AsyncCheckpointer(self.log_path, saveSteps=saveSteps, 
+                                              saveSecs=saveSecs, keep=keepCheckpoints)
+        with tf.Session() as session:
             session.run(init)
-            while self.epochs < self.inputs.num_epochs:
-                self.run_epoch(session)
-                print(self.sample(session))  # -- get caption
-        self.results.plot_results()
+            if resume:
+                state = self.checkpointer.restore(session)
+                if state is not None:
+                    self.restore_training_state(state, session.run(self.global_step))
+            try:
+                while self.epochs < self.inputs.num_epochs:
+                    self.run_epoch(session)
+                    print(self.sample(session, self.inputs.phrases[0]))  # -- get caption
+            finally:
+                self.close_pipeline()
+                self.results.close()
+                self.checkpointer.close(session, session.run(self.global_step), 
+                                        self.training_state())
+        print(js.dumps(self.results.summary(), sort_keys=True))
+        self.results.plot_results(os.path.join(self.log_path, 'training.png'))
+
+    #Python side of the training state, stored with every checkpoint
+    def training_state(self):
+        return {'epoch': self.epochs, 'epoch_step': self.epoch_step, 'seed': self.inputs.seed,
+                'steps_per_epoch': self.training_iterations,
+                'cost_history': sorted(self.results.costHistory.items())}
+
+    #Checkpoints without a state file (or from a different batch size) fall back to the
+    #position implied by the global step - every step is exactly one batch
+    def restore_training_state(self, state, globalStep):
+        if state.get('steps_per_epoch') == self.training_iterations:
+            self.epochs = state['epoch']
+            self.epoch_step = state['epoch_step']
+        else:
+            self.epochs, self.epoch_step = divmod(int(globalStep), self.training_iterations)
+        if state.get('seed') is not None and state['seed'] != self.inputs.seed:
+            print("Resuming with seed %s from the checkpoint instead of %s" % 
+                  (state['seed'], self.inputs.seed))
+            self.inputs.seed = state['seed']
+        for epoch, cost in state.get('cost_history', []):
+            self.results.record_point(epoch, cost)
+        self.close_pipeline()
+        print("Resuming at epoch %d step %d (global step %d)" % 
+              (self.epochs, self.epoch_step, globalStep))
 
     def run_epoch(self, session):
         """Runs the model on the given data."""
         costs = 0.0
         iters = 0
-        state = session.run(self.initial_state)
-        fetches = {"cost": self.cost, "final_state": self.final_state, 
-                       "eval_op":self.optimizer}
-        print ("Epoch: ", self.epochs)
-        for step in range(self.training_iterations):
-            phrases, captions = self.next_batch()
-            train_dict = {self._x: phrases, self._y: captions}                
-            vals = session.run(fetches, train_dict)
+        fetches = {"cost": self.train_cost, "final_state": self.final_state, 
+                       "eval_op":self.optimizer, "global_step": self._trained_step}
+        epoch = self.epochs
+        print ("Epoch: ", epoch)
+        for step in range(self.epoch_step, self.training_iterations):
+            started = time.time()
+            phrases, captions, lengths = self.next_batch()
+            batched = time.time()
+            train_dict = {self._x: phrases, self._y: captions, self._lengths: lengths}
+            options, metadata = self.results.trace_options(len(self.results.steps))
+            vals = session.run(fetches, train_dict, options=options, run_metadata=metadata)
+            finished = time.time()
+            self.results.record_step(self.epochs, step, int(vals["global_step"]), len(captions),
+                                     vals["cost"], batched - started, 
+                                     self.pipeline.assembly_seconds, finished - batched)
+            if metadata is not None:
+                self.results.write_trace(metadata, int(vals["global_step"]))
+            self.epoch_step = step + 1
+            if self.epoch_step == self.training_iterations:
+                self.epochs += 1
+                self.epoch_step = 0
+            if self.checkpointer is not None:
+                self.checkpointer.maybe_save(session, int(vals["global_step"]), 
+                                             self.training_state())
+            if self.evaluator is not None and self.evaluate_steps and \
+                    int(vals["global_step"]) % self.evaluate_steps == 0:
+                self.evaluate(session, int(vals["global_step"]))
             """Equivalent to:                         Against input x, y (phrases, captions)
             session.run(self.final_state, train_dict) Compute probability distribution
             session.run(self.cost, train_dict)        Calculate loss
@@ -268,62 +711,71 @@ class LSTMNet(object):
             costs += cost
         print ("Cost: ", cost)
          
-        if self.epochs % self.inputs.display_step == 0:
-            self.results.record_point(self.epochs, costs)
-        self.epochs += 1
+        if self.epochs == epoch:
+            self.epochs += 1
+        if epoch % self.inputs.display_step == 0:
+            self.results.record_point(epoch, costs)
         return np.exp(costs)
 
-    def sample(self, session, seed = '\''):
-        state = session.run(self.initial_state)  #See constructor - tensor of 0's
-        for char in seed[:-1]:
-            #x = np.zeros((self.inputs.batch_size, self.inputs.phrase_count, 
-            #              self.inputs.phrase_dimension, self.inputs.word_dimension))
-            x = np.zeros((self.inputs.phrase_count, 
-                          self.inputs.phrase_dimension, self.inputs.word_dimension))
-
-            x[0, 0] = self.encoder[char]
-            feed = {self._x: x, self.initial_state:state}
-            [state] = session.run([self.final_state], feed)
-
-        #Seed state is trained network on <START> = '\''
-        ret = seed
-        char = seed[-1]
-        num = self.inputs.phrase_dimension #For now, fixed length captions
-        for n in range(num):              #Ideally this loop is 'until generate <STOP>'
-            #x = np.zeros((self.inputs.batch_size, self.inputs.phrase_count, 
-            #              self.inputs.phrase_dimension, self.inputs.word_dimension))
-            x = np.zeros((self.inputs.phrase_count, 
-                          self.inputs.phrase_dimension, self.inputs.word_dimension))
-
-            x[0, 0] = self.encoder[char]
-            feed = {self._x: x, self.initial_state:state}
-            [probs, state] = session.run([self.probabilities, self.final_state], feed)
-            p = probs[0]                #We only sample the next word in the sequence   
-            sample = np.argmax(p)          #We can write more complicated sampling functions
-            pred = self.decoder[sample]
-            ret += pred
-            char = pred
-            
-        return ret
-
-    #Retrieve next set of examples based on batch size - or right now, phraseCount
+    #Scores of the evaluator at globalStep, printed and recorded in results
+    def evaluate(self, session, globalStep):
+        scores = self.evaluator(self, session)
+        print("Step %d: %s (%d images, %.1fs)" % (globalStep, evaluation.format_scores(scores),
+                                                  scores['images'],
+                                                  scores['decode_s'] + scores['score_s']))
+        return self.results.record_evaluation(self.epochs, globalStep, scores)
+
+    #Greedy caption for one image's phrases, shaped (phrase_count, phrase_dimension)
+    #Each word costs a single LSTM step, and generation stops at <STOP>
+    def sample(self, session, phrases, seed=dp.START, maxLength=None):
+        phrases = np.asarray(phrases, dtype=np.int32)
+        maxLength = maxLength or self.inputs.phrase_dimension
+        state = self.zero_step_state(1)
+        word = self.encoder[seed]
+        ret = []
+        for n in range(maxLength):
+            if n < self.inputs.phrase_dimension:
+                phraseWords = phrases[np.newaxis, :, n]
+            else:
+                phraseWords = np.full((1, self.inputs.phrase_count), self.inputs.pad_id, 
+                                      dtype=np.int32)
+            probs, state = self.step(session, phraseWords, [word], state)
+            word = np.argmax(probs[0])     #We can write more complicated sampling functions
+            if word == self.stop_id:
+                break
+            ret.append(self.decoder[word])
+        return ' '.join(ret)
+
+    #Beam search captions for a batch of images, phrases shaped 
+    #(batch, phrase_count, phrase_dimension). All beams of all images advance together,
+    #one step graph run per word - see beam_search.py
+    def decode(self, session, phrases, beamWidth=3, maxLength=None, alpha=0.6):
+        phrases = np.asarray(phrases, dtype=np.int32)
+        state = self.zero_step_state(len(phrases) * beamWidth)
+        step_fn = lambda phraseWords, words, state: self.step(session, phraseWords, words, state)
+        sequences = beam_search(step_fn, state, phrases, self.start_id, self.stop_id, 
+                                self.inputs.pad_id, beamWidth, maxLength, alpha)
+        return [' '.join(self.decoder[word] for word in sequence) for sequence in sequences]
+
+    #Batches are assembled on a background thread, see input_pipeline.py
+    #It starts at the current epoch and step so shuffling stays reproducible across restarts
+    def open_pipeline(self):
+        if self.pipeline is None:
+            self.pipeline = BatchPrefetcher(
+                [self.inputs.phrases, self.inputs.captions, self.inputs.lengths], 
+                self.inputs.batch_size, seed=self.inputs.seed, startEpoch=self.epochs,
+                startStep=self.epoch_step, lengths=self.inputs.lengths, 
+                timeAxes=[2, 1, None], indexes=[self.inputs.caption_images, None, None])
+        return self.pipeline
+
+    def close_pipeline(self):
+        if self.pipeline is not None:
+            self.pipeline.close()
+            self.pipeline = None
+
+    #Retrieve next set of examples based on batch size
+    #Returns (batch, phrase_count, steps) phrases, (batch, steps) captions and (batch,) lengths
+    #where steps is the longest caption length in the batch
     def next_batch(self):
-        start = self.epoch_iteration
-        self.epoch_iteration += self.inputs.batch_size
-        end = self.epoch_iteration
-        phrase_batch = self.inputs.phrases[start:end]
-        caption_batch = self.inputs.captions[start:end]
-    
-        if(self.epoch_iteration >= self.data_size):
-            self.epoch_iteration = 0
-            #Google has it shuffling inputs here          Could affect prediction/classification?
-            #to avoid fitting the order of images in the training set?
-            #code.interact(local=dict(globals(), **locals()))
-            shuffleIndices = np.arange(self.data_size)
-            np.random.shuffle(shuffleIndices)
-            self.inputs.phrases = self.inputs.phrases[shuffleIndices]
-            self.inputs.captions = self.inputs.captions[shuffleIndices]
-
-        return phrase_batch[0], caption_batch[0]
-        
-        
+        phrase_batch, caption_batch, lengths = self.open_pipeline().next()
+        return phrase_batch, caption_batch, lengths
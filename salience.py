@@ -1,4 +1,7 @@
 import densecap_processing as dp
+import numpy as np
+import math
+from collections import OrderedDict
 
 #Takes a saliency function to return training phrases for a given image
 #Our network architecture may not require a fixed number of target phrases
@@ -25,38 +28,244 @@ def k_top_scores(image, k):
 #very large boxes with highly inaccurate descriptions
 #Might be useful to use on the phrases ranked highest (top 10?) by the densecap algorithm
 def false_color_salience(image, k):
-    imgWidth = image['dim'][0]
-    imgHeight = image['dim'][1]
-    imgCenter = [imgWidth/2, imgHeight/2]
-    cornerDist = math.sqrt(math.pow(imgWidth - imgCenter[0], 2) + math.pow(imgHeight - imgCenter[1], 2))
-    salience = {}
-    count = 0
-    #print(image['img_name'])
-    #print("Width: ", imgWidth)
-    #print("Height: ", imgHeight)
-    #print("Corner Distance: ", cornerDist)
-    #print("Center: ", imgCenter)
-    maxWeight = 0
-    for box in image['boxes']:
-        #print(count)
-        #print(box)
-        #print(image['captions'][image['boxes'].index(box)])
-        x = box[0]
-        y = box[1]
-        width = box[2]
-        height = box[3]
-        weight = 0
-        for _x in range(int(math.floor(x)), int(math.floor(x + width))):
-            for _y in range(int(math.floor(y)), int(math.floor(y + height))):
-                pDis = math.sqrt(math.pow(imgCenter[0] - _x, 2) + math.pow(imgCenter[1] - _y, 2))
-                weight += 1 - (pDis / (cornerDist + 1))
-        salience[count] = weight
-        #print(weight)
-        count = count + 1
-    phraseIndices = sorted(salience, key=salience.get)
-    #print(sorted(salience, key=salience.get))
-    #print(phraseIndices)
-    #print(phraseIndices[-k:])
-    phraseIndices.reverse()
-    #print(phraseIndices[:k])
-    return phraseIndices[:k]                    
+    scores = box_salience(image['boxes'], image['dim'])
+    return rank_salience(scores, k)
+
+#Scores many images at once. Images sharing a 'dim' are scored together against one
+#cached summed-area table. Returns a list of top-k index lists, one per image
+def false_color_salience_batch(images, k):
+    groups = {}
+    for i, image in enumerate(images):
+        groups.setdefault(tuple(image['dim']), []).append(i)
+    ranked = [None] * len(images)
+    for dim, members in groups.items():
+        boxes = [np.asarray(images[i]['boxes'], dtype=np.float64).reshape(-1, 4) for i in members]
+        scores = box_salience(np.concatenate(boxes), dim)
+        splits = np.cumsum([len(b) for b in boxes])[:-1]
+        for i, imgScores in zip(members, np.split(scores, splits)):
+            ranked[i] = rank_salience(imgScores, k)
+    return ranked
+
+#################### BATCHED PHRASE SELECTION ####################
+# Densecap's best scored phrases are often the same region described several times
+# ("a man wearing a hat" on five nearly identical boxes). select_phrase_indices picks
+# phrases for many images at once: each box is scored by its densecap confidence (as a
+# probability) times its spatial salience relative to the image's most salient box, and
+# greedy non-maximum suppression drops boxes overlapping an already chosen one by more
+# than iouThreshold. Everything runs on padded (images, boxes) arrays.
+
+# Images padded at a time by select_phrase_indices, bounds the padded arrays' memory
+SELECTION_CHUNK = 1024
+
+#Densecap entries as padded arrays: boxes (N, B, 4), scores (N, B) and a (N, B) mask of
+#real boxes, B being the largest box count
+def pad_images(images):
+    counts = np.array([len(image['scores']) for image in images], dtype=np.intp)
+    width = int(counts.max()) if len(images) else 0
+    boxes = np.zeros((len(images), width, 4))
+    scores = np.full((len(images), width), -np.inf)
+    for i, image in enumerate(images):
+        if counts[i]:
+            boxes[i, :counts[i]] = np.asarray(image['boxes'], dtype=np.float64).reshape(-1, 4)
+            scores[i, :counts[i]] = image['scores']
+    valid = np.arange(width)[np.newaxis, :] < counts[:, np.newaxis]
+    return boxes, scores, valid
+
+#Image size of every entry in box coordinates, (N, 2), and a (N,) mask of the sizes that
+#are known: the entry's 'dim' or else dims (None where missing), e.g. from
+#densecap_processing.densecap_image_sizes. Without either the extent of the image's boxes
+#stands in for it
+def image_dims(images, boxes, valid, dims=None):
+    extent = np.where(valid[:, :, np.newaxis], boxes[:, :, :2] + boxes[:, :, 2:], 0)
+    sizes = np.ceil(extent.max(axis=1)) if boxes.shape[1] else np.zeros((len(images), 2))
+    known = np.zeros(len(images), dtype=bool)
+    for i, image in enumerate(images):
+        size = image.get('dim')
+        if size is None and dims is not None:
+            size = dims[i]
+        if size is not None:
+            sizes[i] = size[:2]
+            known[i] = True
+    return np.maximum(sizes, 1), known
+
+#Salience of every padded box (0 for padding). Known sizes share one cached summed-area
+#table per distinct size, inferred ones are scored on a coarse grid, see
+#approximate_salience
+def padded_salience(boxes, valid, dims, known=None):
+    salience = np.zeros(valid.shape)
+    known = np.ones(len(dims), dtype=bool) if known is None else np.asarray(known, dtype=bool)
+    if known.any():
+        rows = np.flatnonzero(known)
+        sizes, group = np.unique(dims[rows], axis=0, return_inverse=True)
+        for size in range(len(sizes)):
+            mask = np.zeros(valid.shape, dtype=bool)
+            mask[rows[group == size]] = valid[rows[group == size]]
+            salience[mask] = box_salience(boxes[mask], tuple(sizes[size]))
+    if not known.all():
+        salience[~known] = np.where(valid[~known],
+                                    approximate_salience(boxes[~known], dims[~known]), 0)
+    return salience
+
+#Densecap confidence times relative spatial salience, -inf for padding
+#salienceWeight = 0 ranks by confidence alone
+def combined_scores(boxes, scores, valid, dims, salienceWeight=1.0, known=None):
+    confidence = 1.0 / (1.0 + np.exp(-np.where(valid, scores, 0)))
+    if salienceWeight:
+        salience = padded_salience(boxes, valid, dims, known)
+        top = np.maximum(salience.max(axis=1, keepdims=True), 1e-12)
+        confidence = confidence * (np.maximum(salience, 0) / top) ** salienceWeight
+    return np.where(valid, confidence, -np.inf)
+
+#Intersection over union of [x, y, width, height] boxes a (N, P, 4) and b (N, Q, 4), (N, P, Q)
+def box_iou(a, b):
+    a = a[:, :, np.newaxis, :]
+    b = b[:, np.newaxis, :, :]
+    width = np.minimum(a[..., 0] + a[..., 2], b[..., 0] + b[..., 2]) - \
+        np.maximum(a[..., 0], b[..., 0])
+    height = np.minimum(a[..., 1] + a[..., 3], b[..., 1] + b[..., 3]) - \
+        np.maximum(a[..., 1], b[..., 1])
+    inter = np.maximum(width, 0) * np.maximum(height, 0)
+    union = a[..., 2] * a[..., 3] + b[..., 2] * b[..., 3] - inter
+    return inter / np.maximum(union, 1e-12)
+
+#Greedy NMS over candidates already sorted best first, for every image at once
+#Returns the (N, C) mask of kept candidates. Candidate r is only compared with the ones
+#before it, and the loop stops once every image has k kept candidates
+def suppress(boxes, valid, k, iouThreshold):
+    keep = np.zeros(valid.shape, dtype=bool)
+    keep[:, 0] = valid[:, 0]
+    kept = keep[:, 0].astype(np.intp)
+    wanted = np.minimum(k, valid.sum(axis=1))
+    for r in range(1, valid.shape[1]):
+        if (kept >= wanted).all():
+            break
+        overlap = box_iou(boxes[:, r:r + 1], boxes[:, :r])[:, 0] > iouThreshold
+        keep[:, r] = valid[:, r] & ~(keep[:, :r] & overlap).any(axis=1)
+        kept += keep[:, r]
+    return keep
+
+#select_phrase_indices on padded arrays: boxes (N, B, 4), scores (N, B), valid (N, B),
+#image dims (N, 2) and the mask of known dims (default all), see pad_images and image_dims
+def select_padded(boxes, scores, valid, dims, k, iouThreshold=0.5, salienceWeight=1.0,
+                  candidates=None, known=None):
+    selected = np.full((len(boxes), k), -1, dtype=np.intp)
+    if not boxes.shape[1]:
+        return selected
+    combined = combined_scores(boxes, scores, valid, dims, salienceWeight, known)
+    pool = min(boxes.shape[1], max(k, candidates or 8 * k))
+    if pool < boxes.shape[1]:
+        order = np.argpartition(-combined, pool - 1, axis=1)[:, :pool]
+        rows = np.arange(len(boxes))[:, np.newaxis]
+        order = order[rows, np.argsort(-combined[rows, order], axis=1, kind='mergesort')]
+    else:
+        order = np.argsort(-combined, axis=1, kind='mergesort')
+    rows = np.arange(len(boxes))[:, np.newaxis]
+    poolValid = valid[rows, order]
+    keep = suppress(boxes[rows, order], poolValid, k, iouThreshold)
+    # Kept candidates, then suppressed ones, then padding - each best first
+    rank = np.where(keep, 0, np.where(poolValid, 1, 2))
+    pick = np.argsort(rank, axis=1, kind='mergesort')[:, :k]
+    chosen = np.where(poolValid[rows, pick], order[rows, pick], -1)
+    selected[:, :chosen.shape[1]] = chosen
+    return selected
+
+#Box indices of the k phrases chosen for every image, (N, k) with -1 where an image has
+#fewer than k boxes. Surviving boxes come first, best first; if suppression leaves fewer
+#than k, the best suppressed boxes fill the remaining slots
+#Only the 'candidates' best boxes of each image (default 8k) take part in suppression
+#dims optionally gives every image's (width, height), see image_dims
+def select_phrase_indices(images, k, iouThreshold=0.5, salienceWeight=1.0, candidates=None,
+                          dims=None):
+    selected = np.full((len(images), k), -1, dtype=np.intp)
+    for start in range(0, len(images), SELECTION_CHUNK):
+        chunk = images[start:start + SELECTION_CHUNK]
+        boxes, scores, valid = pad_images(chunk)
+        sizes, known = image_dims(chunk, boxes, valid,
+                                  None if dims is None else dims[start:start + SELECTION_CHUNK])
+        selected[start:start + len(chunk)] = select_padded(
+            boxes, scores, valid, sizes, k, iouThreshold, salienceWeight, candidates, known)
+    return selected
+
+#Phrase strings chosen for every image, see select_phrase_indices
+def select_phrases(images, k, **kwargs):
+    indices = select_phrase_indices(images, k, **kwargs)
+    return [[image['captions'][i] for i in row if i >= 0]
+            for image, row in zip(images, indices)]
+
+#Highest salience first. Ties keep the order of the original sort-then-reverse
+def rank_salience(scores, k):
+    order = np.argsort(scores, kind='mergesort')[::-1]
+    return order[:k].tolist()
+
+#Pixel (_x, _y) of a box contributes 1 - dist(center, pixel) / (cornerDist + 1). The weight
+#map only depends on the image size, so we build its integral image once per 'dim' and
+#every box sum becomes four lookups. A COCO-sized table is ~2.5 MB, so only the
+#SALIENCE_CACHE_SIZE most recently used sizes are kept
+SALIENCE_CACHE_SIZE = 32
+_salience_tables = OrderedDict()
+
+def salience_table(dim):
+    imgWidth = dim[0]
+    imgHeight = dim[1]
+    key = (imgWidth, imgHeight)
+    table = _salience_tables.pop(key, None)
+    if table is None:
+        imgCenter = [imgWidth/2, imgHeight/2]
+        cornerDist = math.sqrt(math.pow(imgWidth - imgCenter[0], 2) + math.pow(imgHeight - imgCenter[1], 2))
+        _x = np.arange(int(math.ceil(imgWidth)), dtype=np.float64)
+        _y = np.arange(int(math.ceil(imgHeight)), dtype=np.float64)
+        pDis = np.sqrt((imgCenter[0] - _x[np.newaxis, :]) ** 2 + (imgCenter[1] - _y[:, np.newaxis]) ** 2)
+        weights = 1 - (pDis / (cornerDist + 1))
+        table = np.zeros((len(_y) + 1, len(_x) + 1), dtype=np.float64)
+        table[1:, 1:] = weights.cumsum(axis=0).cumsum(axis=1)
+    _salience_tables[key] = table
+    while len(_salience_tables) > SALIENCE_CACHE_SIZE:
+        _salience_tables.popitem(last=False)
+    return table
+
+#Drops every cached salience table, e.g. to time selection from a cold start
+def clear_cache():
+    _salience_tables.clear()
+
+#Salience of every [x, y, width, height] box in one vectorized pass
+#Boxes are clipped to the image, densecap never proposes regions outside of it
+def box_salience(boxes, dim):
+    table = salience_table(dim)
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    height, width = table.shape[0] - 1, table.shape[1] - 1
+    x0 = np.clip(np.floor(boxes[:, 0]), 0, width).astype(np.intp)
+    y0 = np.clip(np.floor(boxes[:, 1]), 0, height).astype(np.intp)
+    x1 = np.clip(np.floor(boxes[:, 0] + boxes[:, 2]), 0, width).astype(np.intp)
+    y1 = np.clip(np.floor(boxes[:, 1] + boxes[:, 3]), 0, height).astype(np.intp)
+    x1 = np.maximum(x0, x1)
+    y1 = np.maximum(y0, y1)
+    return table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0]
+
+#Grid cells per side of approximate_salience
+SALIENCE_CELLS = 64
+
+#Salience of padded boxes (N, B, 4) from a SALIENCE_CELLS x SALIENCE_CELLS grid over each
+#image instead of its pixels, box edges rounded to the nearest grid line. For sizes
+#inferred from box extents, which differ for nearly every image: a full table per image
+#would cost far more to build than it saves, and would crowd the real sizes out of the
+#cache. Cells carry the weight of their center pixel times their area, so scores are on
+#the scale of box_salience
+def approximate_salience(boxes, dims, cells=SALIENCE_CELLS):
+    width = dims[:, 0, np.newaxis]
+    height = dims[:, 1, np.newaxis]
+    centers = (np.arange(cells) + 0.5) / cells - 0.5
+    dx = centers[np.newaxis, :] * width
+    dy = centers[np.newaxis, :] * height
+    cornerDist = np.sqrt((width / 2) ** 2 + (height / 2) ** 2)[:, :, np.newaxis]
+    pDis = np.sqrt(dx[:, np.newaxis, :] ** 2 + dy[:, :, np.newaxis] ** 2)
+    cellArea = (width * height / cells ** 2)[:, :, np.newaxis]
+    table = np.zeros((len(dims), cells + 1, cells + 1))
+    table[:, 1:, 1:] = ((1 - pDis / (cornerDist + 1)) * cellArea).cumsum(axis=1).cumsum(axis=2)
+    def grid(coordinate, size):
+        return np.clip(np.round(coordinate * cells / size), 0, cells).astype(np.intp)
+    x0 = grid(boxes[:, :, 0], width)
+    y0 = grid(boxes[:, :, 1], height)
+    x1 = np.maximum(x0, grid(boxes[:, :, 0] + boxes[:, :, 2], width))
+    y1 = np.maximum(y0, grid(boxes[:, :, 1] + boxes[:, :, 3], height))
+    rows = np.arange(len(dims))[:, np.newaxis]
+    return table[rows, y1, x1] - table[rows, y0, x1] - table[rows, y1, x0] + table[rows, y0, x0]
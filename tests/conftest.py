@@ -0,0 +1,9 @@
+# The modules under test live at the top of the repository, the synthetic data helpers in
+# benchmarks/fixtures.py. Run from the repository: python -m pytest tests
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+sys.path.insert(0, ROOT)
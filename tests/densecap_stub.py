@@ -0,0 +1,49 @@
+# Stand-in for 'th run_model.lua' with the same command line, for running the densecap
+# pipeline without Torch. Densecap runs from its own directory, so give an absolute path:
+#   python caption_generation.py densecap --command "python $PWD/tests/densecap_stub.py"
+# Writes a results.json with a few made-up boxes for every image of -input_dir into
+# -output_vis_dir. Environment variables make it misbehave for tests:
+#   DENSECAP_STUB_LOG    file that every processed image name is appended to
+#   DENSECAP_STUB_FAIL   exit 1 without results if an image name contains this
+#   DENSECAP_STUB_SLEEP  seconds to wait before writing results
+
+from __future__ import print_function
+
+import json as js
+import os
+import sys
+import time
+
+BOXES = 3
+
+def arguments(argv):
+    args = {}
+    for flag, value in zip(argv[::2], argv[1::2]):
+        args[flag.lstrip('-')] = value
+    return args
+
+def entry(name):
+    return {'img_name': name,
+            'boxes': [[10.0 * i, 5.0 * i, 100.0, 80.0] for i in range(BOXES)],
+            'scores': [2.0 - i for i in range(BOXES)],
+            'captions': ['stub phrase %d' % i for i in range(BOXES)]}
+
+def main(argv):
+    args = arguments(argv)
+    names = sorted(os.listdir(args['input_dir']))
+    log = os.environ.get('DENSECAP_STUB_LOG')
+    if log:
+        with open(log, 'a') as f:
+            f.writelines(name + '\n' for name in names)
+    fail = os.environ.get('DENSECAP_STUB_FAIL')
+    if fail and any(fail in name for name in names):
+        print("densecap stub: failing on %s" % fail)
+        return 1
+    time.sleep(float(os.environ.get('DENSECAP_STUB_SLEEP', 0)))
+    with open(os.path.join(args['output_vis_dir'], 'results.json'), 'w') as f:
+        js.dump({'opt': {'stub': True}, 'results': [entry(name) for name in names]}, f)
+    print("densecap stub: %d images" % len(names))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
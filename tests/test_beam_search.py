@@ -0,0 +1,70 @@
+# beam_search on a toy first-order language model
+# Word IDs: 0 <unk>, 1 <START>, 2 <STOP>, 3 and 4 real words, 5 padding
+
+from __future__ import print_function
+
+from collections import namedtuple
+
+import numpy as np
+
+from beam_search import beam_search, length_penalty
+
+START, STOP, PAD = 1, 2, 5
+# Next word distribution given the previous word. Greedy decoding takes 3 and then keeps
+# repeating it, while 4 <STOP> is the most probable caption overall
+TRANSITIONS = np.array([
+    [0.0, 0.0, 1.0, 0.0, 0.0],
+    [0.0, 0.0, 0.0, 0.6, 0.4],
+    [0.0, 0.0, 1.0, 0.0, 0.0],
+    [0.0, 0.0, 0.3, 0.36, 0.34],
+    [0.0, 0.0, 1.0, 0.0, 0.0]])
+
+State = namedtuple('State', ('image', 'steps'))
+
+def markov_step(phraseWords, previousWords, state):
+    return TRANSITIONS[previousWords], State(state.image, state.steps + 1)
+
+#The image of every row is read off the second phrase, see test_batched_images_stay_separate
+def initial_state(phrases, beamWidth):
+    return State(np.repeat(phrases[:, 1, 0], beamWidth), np.zeros(len(phrases) * beamWidth))
+
+def decode(step_fn, phrases, beamWidth, **kwargs):
+    return beam_search(step_fn, initial_state(phrases, beamWidth), phrases, START, STOP, PAD,
+                       beamWidth, **kwargs)
+
+def test_greedy_follows_the_most_probable_word():
+    phrases = np.zeros((1, 2, 4), dtype=np.int32)
+    assert decode(markov_step, phrases, 1, alpha=0.0) == [[3, 3, 3, 3]]
+
+def test_beam_finds_the_most_probable_caption():
+    phrases = np.zeros((1, 2, 4), dtype=np.int32)
+    sequences, scores = decode(markov_step, phrases, 2, alpha=0.0, returnScores=True)
+    assert sequences == [[4]]
+    assert np.isclose(scores[0].max(), np.log(0.4))
+
+def test_length_penalty_normalizes_scores():
+    phrases = np.zeros((1, 2, 4), dtype=np.int32)
+    sequences, scores = decode(markov_step, phrases, 2, alpha=0.6, returnScores=True)
+    # The length counts <STOP>
+    assert np.isclose(scores[0].max(), np.log(0.4) / length_penalty(2, 0.6))
+
+#Every image's beams keep their own rows: phrases and state stay lined up through the
+#beam reordering, and images decode the same batched as alone
+def test_batched_images_stay_separate():
+    phrases = np.zeros((3, 2, 5), dtype=np.int32)
+    phrases[:, 1, :] = (np.arange(3) + 3)[:, np.newaxis]
+    phrases[1, 0, :] = 3
+    def step_fn(phraseWords, previousWords, state):
+        assert (state.image == phraseWords[:, 1]).all()
+        probs = TRANSITIONS[previousWords].copy()
+        # Images whose phrases mention word 3 say it once and stop
+        mentions = (phraseWords[:, 0] == 3) & (previousWords == START)
+        probs[mentions] = [0.0, 0.0, 0.0, 1.0, 0.0]
+        probs[(phraseWords[:, 0] == 3) & (previousWords == 3)] = [0.0, 0.0, 1.0, 0.0, 0.0]
+        return probs, State(state.image, state.steps + 1)
+    batched = decode(step_fn, phrases, 3, alpha=0.0)
+    assert batched == [[4], [3], [4]]
+    assert batched == [decode(step_fn, phrases[i:i + 1], 3, alpha=0.0)[0] for i in range(3)]
+
+def test_empty_batch():
+    assert decode(markov_step, np.zeros((0, 2, 4), dtype=np.int32), 3) == []
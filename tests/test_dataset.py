@@ -0,0 +1,78 @@
+# Dataset directories: round trip and the checks load_dataset makes
+
+from __future__ import print_function
+
+import json as js
+import os
+
+import numpy as np
+import pytest
+
+import dataset
+
+WORDS = ['<unk>', "'", '.', 'a', 'dog']
+
+def save(directory, **arrays):
+    full = {'phrases': np.arange(24).reshape(2, 3, 4) % 5,
+            'captions': np.ones((3, 4), dtype=np.int32),
+            'caption_images': np.array([0, 0, 1], dtype=np.int32)}
+    full.update(arrays)
+    full = dict((name, array) for name, array in full.items() if array is not None)
+    dataset.save_dataset(directory, full, WORDS, {'batch_size': 2, 'phrase_count': 3},
+                         {'layer_size': 8, 'unknown': 1})
+    return directory
+
+def edit_manifest(directory, edit):
+    path = os.path.join(directory, dataset.MANIFEST)
+    with open(path) as f:
+        manifest = js.load(f)
+    edit(manifest)
+    with open(path, 'w') as f:
+        js.dump(manifest, f)
+
+def test_round_trip(tmpdir):
+    data = dataset.load_dataset(save(str(tmpdir.join('train'))))
+    assert len(data) == 2
+    assert data.phrases.dtype == np.int32 and isinstance(data.phrases, np.memmap)
+    assert (data.phrases == np.arange(24).reshape(2, 3, 4) % 5).all()
+    assert data.vocab == WORDS and data.encoder['dog'] == 4 and data.decoder[3] == 'a'
+    assert data.manifest['input'] == {'batch_size': 2, 'phrase_count': 3}
+    assert data.manifest['parameters'] == {'layer_size': 8}
+    assert data.annotations is None
+    assert not isinstance(dataset.load_dataset(data.directory, mmap=False).phrases, np.memmap)
+
+def test_missing_manifest(tmpdir):
+    with pytest.raises(dataset.DatasetError):
+        dataset.load_dataset(str(tmpdir))
+
+def test_wrong_format_or_version(tmpdir):
+    directory = save(str(tmpdir.join('train')))
+    edit_manifest(directory, lambda manifest: manifest.update(version=dataset.VERSION + 1))
+    with pytest.raises(dataset.DatasetError):
+        dataset.load_dataset(directory)
+    edit_manifest(directory, lambda manifest: manifest.update(version=dataset.VERSION,
+                                                              format='other'))
+    with pytest.raises(dataset.DatasetError):
+        dataset.load_dataset(directory)
+
+def test_missing_required_array(tmpdir):
+    directory = str(tmpdir.join('train'))
+    dataset.save_dataset(directory, {'phrases': np.zeros((2, 3, 4))}, WORDS, {}, {})
+    with pytest.raises(dataset.DatasetError):
+        dataset.load_dataset(directory)
+
+def test_array_must_match_manifest(tmpdir):
+    directory = save(str(tmpdir.join('train')))
+    np.save(os.path.join(directory, 'captions.npy'), np.ones((4, 4), dtype=np.int32))
+    with pytest.raises(dataset.DatasetError):
+        dataset.load_dataset(directory)
+
+def test_caption_rows_must_match_images(tmpdir):
+    with pytest.raises(dataset.DatasetError):
+        dataset.load_dataset(save(str(tmpdir.join('a')), caption_images=None))
+    with pytest.raises(dataset.DatasetError):
+        dataset.load_dataset(save(str(tmpdir.join('b')),
+                                  caption_images=np.array([0, 1], dtype=np.int32)))
+    with pytest.raises(dataset.DatasetError):
+        dataset.load_dataset(save(str(tmpdir.join('c')),
+                                  caption_images=np.array([0, 2, 1], dtype=np.int32)))
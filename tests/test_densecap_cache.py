@@ -0,0 +1,96 @@
+# Sharded densecap runs and the result cache, with tests/densecap_stub.py as densecap
+
+from __future__ import print_function
+
+import json as js
+import os
+import sys
+import time
+
+import pytest
+
+import densecap_cache
+import densecap_results
+import densecap_runner
+
+STUB = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                     'densecap_stub.py')]
+
+#Image files with distinct contents unless given the same 'content'
+def write_images(directory, names, content=None):
+    if not directory.check():
+        directory.mkdir()
+    paths = []
+    for name in names:
+        path = directory.join(name)
+        path.write(content or 'pixels of ' + name)
+        paths.append(str(path))
+    return paths
+
+#Image names densecap was run on, in the order the stub saw them
+def stub_log(tmpdir):
+    log = tmpdir.join('stub.log')
+    return sorted(log.read().split()) if log.check() else []
+
+def run_cached(tmpdir, paths):
+    output = str(tmpdir.join('results.json'))
+    densecap_cache.run_densecap(paths, output, cacheDir=str(tmpdir.join('cache')), workers=2,
+                                command=STUB, densecapDir=str(tmpdir), pollInterval=0.05)
+    with open(output) as f:
+        return js.load(f)
+
+def test_run_sharded_splits_images(tmpdir, monkeypatch):
+    monkeypatch.setenv('DENSECAP_STUB_LOG', str(tmpdir.join('stub.log')))
+    paths = write_images(tmpdir.join('images'), ['%d.jpg' % i for i in range(5)])
+    resultFiles = densecap_runner.run_sharded(paths, str(tmpdir.join('work')), workers=2,
+                                              shardSize=2, command=STUB,
+                                              densecapDir=str(tmpdir), pollInterval=0.05)
+    names = [[entry['img_name'] for entry in densecap_results.iter_images(resultFile)]
+             for resultFile in resultFiles]
+    assert names == [['0.jpg', '1.jpg'], ['2.jpg', '3.jpg'], ['4.jpg']]
+    assert stub_log(tmpdir) == ['%d.jpg' % i for i in range(5)]
+
+def test_only_uncached_images_reach_densecap(tmpdir, monkeypatch):
+    monkeypatch.setenv('DENSECAP_STUB_LOG', str(tmpdir.join('stub.log')))
+    images = tmpdir.join('images')
+    paths = write_images(images, ['a.jpg', 'b.jpg', 'c.jpg'])
+    # Same bytes as a.jpg under another name: processed once, reported under both names
+    paths += write_images(images, ['copy.jpg'], content='pixels of a.jpg')
+    results = run_cached(tmpdir, paths)
+    assert [entry['img_name'] for entry in results['results']] == \
+        ['a.jpg', 'b.jpg', 'c.jpg', 'copy.jpg']
+    assert results['results'][0]['captions'] == results['results'][3]['captions']
+    assert stub_log(tmpdir) == ['a.jpg', 'b.jpg', 'c.jpg']
+
+    tmpdir.join('stub.log').remove()
+    paths += write_images(images, ['d.jpg', 'e.jpg'])
+    results = run_cached(tmpdir, paths)
+    assert len(results['results']) == 6
+    assert stub_log(tmpdir) == ['d.jpg', 'e.jpg']
+
+    tmpdir.join('stub.log').remove()
+    run_cached(tmpdir, paths)
+    assert stub_log(tmpdir) == []
+
+#A shard failing for good kills the shards still running, reaps them and closes every log
+def test_failed_run_cleans_up(tmpdir, monkeypatch):
+    monkeypatch.setenv('DENSECAP_STUB_FAIL', 'bad')
+    monkeypatch.setenv('DENSECAP_STUB_SLEEP', '60')
+    shards = []
+    Shard = densecap_runner.Shard
+    class RecordedShard(Shard):
+        def __init__(self, *args):
+            Shard.__init__(self, *args)
+            shards.append(self)
+    monkeypatch.setattr(densecap_runner, 'Shard', RecordedShard)
+    paths = write_images(tmpdir.join('images'), ['bad.jpg', 'good.jpg'])
+    started = time.time()
+    with pytest.raises(RuntimeError) as error:
+        densecap_runner.run_sharded(paths, str(tmpdir.join('work')), workers=2, shardSize=1,
+                                    retries=0, command=STUB, densecapDir=str(tmpdir),
+                                    pollInterval=0.05)
+    assert 'Shard 0 failed' in str(error.value)
+    assert time.time() - started < 30
+    assert len(shards) == 2
+    assert all(shard.process.returncode is not None for shard in shards)
+    assert all(shard.log.closed for shard in shards)
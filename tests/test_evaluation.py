@@ -0,0 +1,71 @@
+# BLEU and CIDEr on examples small enough to work out by hand
+
+from __future__ import print_function
+
+import math
+import os
+
+import numpy as np
+
+import dataset
+import evaluation
+import fixtures
+
+def test_exact_match_scores_one():
+    references = evaluation.References([[[3, 4, 5]]], 6)
+    scores = references.score([[3, 4, 5]])
+    for n in range(1, 5):
+        assert np.isclose(scores['Bleu_%d' % n], 1.0 if n <= 3 else 1e-6 ** 0.25)
+
+#Candidate "3 4" against the reference "3 4 5": brevity penalty exp(1 - 3/2), unigram and
+#bigram precision 1, no trigrams or 4-grams - coco-caption smooths those to 1e-15 / 1e-9
+def test_bleu_brevity_penalty_and_smoothing():
+    references = evaluation.References([[[3, 4, 5]]], 6)
+    scores = references.score([[3, 4]])
+    penalty = math.exp(-0.5)
+    assert np.isclose(scores['Bleu_1'], penalty)
+    assert np.isclose(scores['Bleu_2'], penalty)
+    assert np.isclose(scores['Bleu_3'], penalty * 1e-6 ** (1.0 / 3))
+    assert np.isclose(scores['Bleu_4'], penalty * 1e-12 ** (1.0 / 4))
+
+#Two images with references "3 4" and "3 5": 3 appears in both, so its idf is 0, the other
+#n-grams get log 2. "3 4" matches the first image's unigram and bigram vectors exactly
+#(cosine 1 each, none for n = 3, 4), CIDEr 10 * (1 + 1) / 4, and shares nothing weighted
+#with the second
+def test_cider():
+    references = evaluation.References([[[3, 4]], [[3, 5]]], 6)
+    scores = references.score([[3, 4], [3, 4]])
+    assert np.allclose(scores['cider_per_image'], [5.0, 0.0])
+    assert np.isclose(scores['CIDEr'], 2.5)
+
+#CIDEr-D clips candidate weights at the reference's: "4 4" against "3 4" has unigram
+#weights (4: 2 log 2) . (4: log 2) clipped to log 2 * log 2, cosine 1/2
+def test_cider_clips_repeated_words():
+    references = evaluation.References([[[3, 4]], [[3, 5]]], 6)
+    scores = references.score([[4, 4]], images=[0])
+    assert np.isclose(scores['CIDEr'], 10 * 0.5 / 4)
+
+def test_unknown_words_never_match():
+    encoder = {'a': 3, 'b': 4}
+    references = evaluation.References(evaluation.caption_references([['a zzz b']], encoder), 5)
+    scores = references.score([evaluation.encode('a yyy', encoder)])
+    assert np.isclose(scores['Bleu_1'], 0.5 * math.exp(1 - 3 / 2.0))
+
+#References come from the whole COCO captions of the image_ids, not the truncated rows
+def test_references_from_coco_captions(tmpdir):
+    annFile = fixtures.write_coco_captions(str(tmpdir.join('captions.json')), 4, 20)
+    words = ['<unk>', "'", '.'] + ['a'] + ['w%d' % i for i in range(20)]
+    encoder = dict((word, index) for index, word in enumerate(words))
+    directory = str(tmpdir.join('test'))
+    dataset.save_dataset(directory, {
+        'phrases': np.zeros((4, 2, 3), dtype=np.int32),
+        'captions': np.zeros((4, 3), dtype=np.int32),
+        'image_ids': np.arange(1, 5, dtype=np.int64)}, words, {}, {}, annFile)
+    references = evaluation.load_evaluator(directory, vocab=words).references
+    captions = fixtures.coco_captions(4, 20)['annotations']
+    expected = [[evaluation.encode(c['caption'], encoder) for c in captions if c['image_id'] == i]
+                for i in range(1, 5)]
+    assert [len(lengths) for lengths in references.lengths] == [5] * 4
+    assert references.lengths == [[len(caption) for caption in image] for image in expected]
+    assert max(max(lengths) for lengths in references.lengths) > 3
+    assert os.path.exists(os.path.join(directory, evaluation.CACHE_FILE))
@@ -0,0 +1,67 @@
+# int8 per-channel quantization and the engine file round trip
+
+from __future__ import print_function
+
+import numpy as np
+
+import numpy_engine
+
+WORDS = ['<unk>', "'", '.', 'a', 'dog', 'on', 'grass']
+PHRASE_COUNT = 2
+PHRASE_DIMENSION = 4
+EMBEDDING = 6
+LAYER_SIZE = 8
+
+#Random weights shaped like export_network's, the embedding padded with one row for the
+#pad ID
+def random_engine(seed=0):
+    rng = np.random.RandomState(seed)
+    vocab = len(WORDS)
+    inputs = (PHRASE_COUNT + 1) * EMBEDDING
+    arrays = {'embedding': rng.normal(0, 1, (vocab + 1, EMBEDDING)),
+              'layer_0/kernel': rng.normal(0, 0.3, (inputs + LAYER_SIZE, 4 * LAYER_SIZE)),
+              'layer_0/bias': rng.normal(0, 0.1, 4 * LAYER_SIZE),
+              'out/weights': rng.normal(0, 0.5, (LAYER_SIZE, vocab)),
+              'out/biases': rng.normal(0, 0.1, vocab)}
+    meta = {'phrase_count': PHRASE_COUNT, 'phrase_dimension': PHRASE_DIMENSION,
+            'layer_size': LAYER_SIZE, 'num_layers': 1, 'forget_bias': 1.0,
+            'start_id': 1, 'stop_id': 2, 'pad_id': vocab, 'vocab': WORDS}
+    return meta, arrays
+
+def test_quantize_per_channel_error_is_half_a_step():
+    weights = np.random.RandomState(1).normal(0, 1, (50, 20)).astype(np.float32)
+    weights[:, 3] = 0
+    for axis in (0, 1):
+        q, scale = numpy_engine.quantize_per_channel(weights, axis)
+        assert q.dtype == np.int8 and np.abs(q.astype(np.int32)).max() == 127
+        assert scale.shape == ((50, 1) if axis == 0 else (1, 20))
+        assert (np.abs(q * scale - weights) <= scale / 2 + 1e-7).all()
+    q, scale = numpy_engine.quantize_per_channel(weights, 1)
+    assert (q[:, 3] == 0).all() and scale[0, 3] == 1.0
+
+def test_float_round_trip_is_exact(tmpdir):
+    meta, arrays = random_engine()
+    path = numpy_engine.save_engine(str(tmpdir.join('engine.npz')), meta, arrays)
+    engine = numpy_engine.load_engine(path)
+    assert not engine.quantized
+    assert engine.words == WORDS
+    assert np.array_equal(engine.out_weights.values, arrays['out/weights'].astype(np.float32))
+    assert np.array_equal(engine.embedding.values, arrays['embedding'].astype(np.float32))
+
+def test_int8_round_trip_matches_float(tmpdir):
+    meta, arrays = random_engine()
+    full = numpy_engine.load_engine(
+        numpy_engine.save_engine(str(tmpdir.join('float.npz')), meta, arrays))
+    small = numpy_engine.load_engine(
+        numpy_engine.save_engine(str(tmpdir.join('int8.npz')), meta, arrays, quantize=True))
+    assert small.quantized
+    assert small.out_weights.values.dtype == np.int8
+    assert small.nbytes < full.nbytes / 2
+    phrases = np.random.RandomState(2).randint(0, len(WORDS), (3, PHRASE_COUNT, PHRASE_DIMENSION))
+    state = full.zero_state(3)
+    previous = np.full(3, meta['start_id'])
+    expected, expectedState = full.step(phrases[:, :, 0], previous, state)
+    probabilities, newState = small.step(phrases[:, :, 0], previous, state)
+    assert np.abs(probabilities - expected).max() < 0.02
+    assert np.allclose(probabilities.sum(axis=1), 1.0)
+    assert np.abs(newState[0].h - expectedState[0].h).max() < 0.05
@@ -0,0 +1,87 @@
+# Batched phrase selection against a one-image-at-a-time greedy NMS loop
+
+from __future__ import print_function
+
+import numpy as np
+
+import densecap_processing as dp
+import fixtures
+import salience
+
+#select_phrase_indices for a single image the slow way: rank every box, then keep boxes
+#in order unless they overlap a kept one, suppressed boxes filling up to k
+def naive_selection(image, k, iouThreshold=0.5):
+    boxes = np.asarray(image['boxes'], dtype=np.float64).reshape(-1, 4)
+    confidence = 1.0 / (1.0 + np.exp(-np.asarray(image['scores'], dtype=np.float64)))
+    scores = salience.box_salience(boxes, tuple(image['dim']))
+    combined = confidence * np.maximum(scores, 0) / max(scores.max(), 1e-12)
+    order = list(np.argsort(-combined, kind='mergesort')[:8 * k])
+    kept = []
+    suppressed = []
+    for i in order:
+        if len(kept) == k:
+            break
+        if all(salience.box_iou(boxes[np.newaxis, [i]], boxes[np.newaxis, [j]])[0, 0, 0] <=
+               iouThreshold for j in kept):
+            kept.append(i)
+        else:
+            suppressed.append(i)
+    rest = [i for i in order if i not in kept and i not in suppressed]
+    return (kept + suppressed + rest)[:k]
+
+def test_matches_naive_nms():
+    images = fixtures.densecap_results(60, boxesPerImage=40, seed=3)['results']
+    selected = salience.select_phrase_indices(images, 5)
+    for image, row in zip(images, selected):
+        assert row.tolist() == naive_selection(image, 5)
+
+def test_short_images_are_padded():
+    images = fixtures.densecap_results(3, boxesPerImage=4)['results']
+    images[1] = dict(images[1], boxes=[], scores=[], captions=[])
+    selected = salience.select_phrase_indices(images, 6)
+    assert selected.shape == (3, 6)
+    assert (selected[1] == -1).all()
+    assert sorted(selected[0][:4].tolist()) == [0, 1, 2, 3]
+    assert (selected[0][4:] == -1).all()
+
+def test_overlapping_boxes_are_suppressed():
+    image = {'boxes': [[0, 0, 100, 100], [2, 2, 100, 100], [300, 300, 50, 50]],
+             'scores': [3.0, 2.9, 0.0], 'captions': ['a', 'b', 'c'], 'dim': [640, 480]}
+    assert salience.select_phrase_indices([image], 2, salienceWeight=0).tolist() == [[0, 2]]
+    assert salience.select_phrases([image], 3, salienceWeight=0) == [['a', 'c', 'b']]
+
+def test_given_dims_replace_box_extents():
+    images = fixtures.densecap_results(20, boxesPerImage=30, withDim=False)['results']
+    dimmed = fixtures.densecap_results(20, boxesPerImage=30)['results']
+    dims = [image['dim'] for image in dimmed]
+    assert (salience.select_phrase_indices(images, 5, dims=dims) ==
+            salience.select_phrase_indices(dimmed, 5)).all()
+
+def test_inferred_dims_are_not_cached():
+    salience.clear_cache()
+    images = fixtures.densecap_results(50, boxesPerImage=20, withDim=False)['results']
+    salience.select_phrase_indices(images, 5)
+    assert len(salience._salience_tables) == 0
+    for width in range(salience.SALIENCE_CACHE_SIZE + 5):
+        salience.salience_table((100 + width, 100))
+    assert len(salience._salience_tables) == salience.SALIENCE_CACHE_SIZE
+    salience.clear_cache()
+
+def test_approximate_salience_tracks_exact():
+    boxes, scores, valid = salience.pad_images(
+        fixtures.densecap_results(10, boxesPerImage=50)['results'])
+    dims = np.tile([640.0, 480.0], (10, 1))
+    exact = salience.padded_salience(boxes, valid, dims)
+    approximate = salience.padded_salience(boxes, valid, dims, np.zeros(10, dtype=bool))
+    assert np.abs(exact - approximate).max() < 0.03 * exact.max()
+
+#An entry's own 'dim' is in box coordinates already and wins over given dims
+def test_entry_dim_wins_over_given_dims():
+    images = fixtures.densecap_results(2, boxesPerImage=5)['results']
+    boxes, scores, valid = salience.pad_images(images)
+    dims, known = salience.image_dims(images, boxes, valid, dims=[(100, 100), None])
+    assert dims.tolist() == [[640, 480], [640, 480]] and known.all()
+
+def test_densecap_image_sizes_scale_the_longer_side():
+    assert dp.densecap_image_sizes([(640, 480), (427, 640), None], 720) == \
+        [(720, 540), (480, 720), None]
@@ -0,0 +1,111 @@
+# Word vocabulary shared by the phrase/caption encoders and the network's softmax
+# Token frequencies are counted in one streaming pass over the captions, then rare words are
+# cut by min_count / max_size - they all map to <UNK>. IDs are laid out as
+#   0 <UNK>, 1 <START>, 2 <STOP>, 3.. words by descending frequency
+# and the padding ID is size, one past the last word, so padding stays outside the softmax
+# (see densecap_processing.pad_id and NetworkInput.pad_id).
+# Saved vocabularies are plain text, one "word<TAB>count" line per ID.
+
+import io
+import re
+from collections import Counter
+
+UNK = '<unk>'
+# Same symbols densecap_processing uses for <START> and <STOP>
+START = '\''
+STOP = '.'
+RESERVED = [UNK, START, STOP]
+
+UNK_ID = 0
+START_ID = 1
+STOP_ID = 2
+
+_SPLIT = re.compile('[(\'\\.)\\s,]')
+
+#Lower-cased words of a caption or densecap phrase, punctuation and empty strings dropped
+def tokenize(text):
+    return [word for word in _SPLIT.split(text.lower()) if word]
+
+class Vocabulary(object):
+
+    def __init__(self, words, counts=None):
+        self.words = list(words)
+        self.counts = list(counts) if counts is not None else [0] * len(self.words)
+        self.index = dict((word, i) for i, word in enumerate(self.words))
+
+    #Number of IDs the softmax has to cover
+    @property
+    def size(self):
+        return len(self.words)
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def pad_id(self):
+        return self.size
+
+    def word_id(self, word):
+        return self.index.get(word, UNK_ID)
+
+    def encode(self, text):
+        return [self.word_id(word) for word in tokenize(text)]
+
+    def decode(self, ids):
+        return ' '.join(self.words[i] for i in ids if i < self.size)
+
+    #ID -> word and word -> ID dictionaries, as built by densecap_processing.build_lookup_lexicon
+    @property
+    def index2word(self):
+        return dict(enumerate(self.words))
+
+    @property
+    def word2index(self):
+        return dict(self.index)
+
+    def save(self, path):
+        with io.open(path, 'w', encoding='utf-8') as f:
+            for word, count in zip(self.words, self.counts):
+                f.write(u'%s\t%d\n' % (word, count))
+
+def load_vocabulary(path):
+    words = []
+    counts = []
+    with io.open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            word, count = line.rstrip(u'\n').rsplit(u'\t', 1)
+            words.append(word)
+            counts.append(int(count))
+    if words[:len(RESERVED)] != RESERVED:
+        raise ValueError("%s does not start with the reserved symbols %s" % (path, RESERVED))
+    return Vocabulary(words, counts)
+
+class VocabularyBuilder(object):
+
+    def __init__(self):
+        self.counts = Counter()
+
+    def add(self, text):
+        self.counts.update(tokenize(text))
+
+    def add_all(self, texts):
+        for text in texts:
+            self.add(text)
+        return self
+
+    #Keeps words seen at least minCount times, at most maxSize words including the
+    #reserved symbols. Ties are broken alphabetically so builds are reproducible
+    def build(self, minCount=1, maxSize=None):
+        kept = [(word, count) for word, count in self.counts.items()
+                if count >= minCount and word not in RESERVED]
+        kept.sort(key=lambda item: (-item[1], item[0]))
+        if maxSize is not None:
+            kept = kept[:max(0, maxSize - len(RESERVED))]
+        unknown = sum(self.counts.values()) - sum(count for word, count in kept)
+        words = RESERVED + [word for word, count in kept]
+        counts = [unknown, 0, 0] + [count for word, count in kept]
+        return Vocabulary(words, counts)
+
+#Builds a vocabulary from an iterable of caption strings in one pass
+def build_vocabulary(texts, minCount=1, maxSize=None):
+    return VocabularyBuilder().add_all(texts).build(minCount, maxSize)